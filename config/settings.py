@@ -23,6 +23,15 @@ FINGERPRINT_SETTINGS = {
     'template_file': os.path.join(TEMPLATES_DIR, 'templates.json'),
     'match_threshold': 0.7,  # Minimum similarity score for a match
     'max_features': 1000,  # Maximum number of features to extract
+    'canonical_size': 512,  # Larger images are shrunk to this longer side before processing (None keeps native size)
+    'matcher_backend': 'auto',  # 'brute' (exact distance products), 'flann' (ANN index) or 'auto' (by template size)
+    'preprocess_mode': 'full',  # 'full' (adaptive threshold) or 'fast' (threshold against a downsampled local mean)
+    'crop_to_foreground': False,  # Crop images to the fingerprint before enhancing them
+    'template_memory_mb': 256,  # Templates kept in memory at once, the rest are read from disk on use
+    'prefetch_recent_users': 100,  # Templates of the most recently verified users loaded at startup
+    'stream_accept_frames': 2,  # Streamed verification: frames above match_threshold needed to accept
+    'stream_reject_frames': 5,  # Streamed verification: frames below match_threshold that reject
+    'stream_max_frames': 150,  # Streamed verification: frames read before giving up
 }
 
 # OTP settings
@@ -32,6 +41,17 @@ OTP_SETTINGS = {
     'allowed_chars': '0123456789'
 }
 
+# Headless service settings (src/service.py)
+SERVICE_SETTINGS = {
+    'host': '127.0.0.1',
+    'port': 8080,
+    'workers': None,  # Feature extraction processes (None: one per CPU, 0: in-process)
+    'max_concurrency': None,  # Requests processed at once (None: two per worker)
+    'max_queue': 64,  # Requests waiting for a slot before the service answers 503
+    'require_otp': False,  # Reject /verify requests that carry no OTP
+    'image_root': None,  # Folder 'image_path' requests may read images from (None: uploaded images only)
+}
+
 # GUI settings
 GUI_SETTINGS = {
     'window_size': '800x600',
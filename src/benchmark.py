@@ -0,0 +1,419 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import re
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+import cv2
+import numpy as np
+from fingerprint import FingerprintProcessor, TEMPLATE_FORMATS, SCORE_MODES, keypoint_coordinates
+from preprocess import PREPROCESS_MODES
+from matcher_cache import build_matcher, choose_backend
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+# FVC-style file names: <finger>_<impression>.<ext>, e.g. 101_1.tif
+FVC_NAME = re.compile(r'^(?P<finger>[^_]+)_(?P<impression>\d+)$')
+PERCENTILES = (50, 90, 99)
+
+
+class StageTimer:
+    """Collects wall-clock durations per pipeline stage (attach as processor.stage_timer)"""
+
+    def __init__(self):
+        self.samples = {}
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples.setdefault(stage, []).append(time.perf_counter() - start)
+
+    def record(self, stage, seconds):
+        self.samples.setdefault(stage, []).append(seconds)
+
+    def summary(self):
+        """Count, mean and percentiles in milliseconds for every stage"""
+        summary = {}
+        for stage, samples in self.samples.items():
+            ms = 1000 * np.asarray(samples)
+            summary[stage] = {'count': len(ms), 'mean_ms': float(ms.mean()), 'total_ms': float(ms.sum())}
+            for p in PERCENTILES:
+                summary[stage][f'p{p}_ms'] = float(np.percentile(ms, p))
+        return summary
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process, or None where it cannot be measured
+
+    The peak never decreases, so it covers everything the process has run
+    so far and cannot be attributed to one benchmark configuration.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def load_dataset(dataset_dir):
+    """Group the images of an FVC-style folder by finger: {finger: [paths by impression]}"""
+    fingers = {}
+    for file_name in sorted(os.listdir(dataset_dir)):
+        stem, ext = os.path.splitext(file_name)
+        match = FVC_NAME.match(stem)
+        if ext.lower() not in IMAGE_EXTENSIONS or match is None:
+            continue
+        fingers.setdefault(match.group('finger'), []).append(
+            (int(match.group('impression')), os.path.join(dataset_dir, file_name)))
+    return {finger: [path for _, path in sorted(impressions)]
+            for finger, impressions in fingers.items() if len(impressions) >= 2}
+
+
+def generate_synthetic_dataset(output_dir, fingers=20, impressions=4, size=300, seed=0):
+    """Write an FVC-style dataset of synthetic ridge patterns so the benchmark runs offline.
+
+    Each finger is oriented band-pass noise (a sum of Gabor responses with a
+    spatially varying orientation mix); impressions are small random
+    rotations and shifts of it with added sensor noise.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    center = (size / 2, size / 2)
+    for finger in range(1, fingers + 1):
+        rng = np.random.default_rng(seed * 100003 + finger)
+        noise = rng.standard_normal((size, size)).astype(np.float32)
+        ridges = np.zeros_like(noise)
+        for theta in np.linspace(0, np.pi, 8, endpoint=False):
+            kernel = cv2.getGaborKernel((21, 21), 4.0, theta + rng.uniform(0, 0.3), 9.0, 0.5)
+            weight = cv2.GaussianBlur(rng.random((size, size)).astype(np.float32), (0, 0), size / 8)
+            ridges += cv2.filter2D(noise, -1, kernel) * weight
+        base = cv2.normalize(ridges, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+
+        for impression in range(1, impressions + 1):
+            transform = cv2.getRotationMatrix2D(center, rng.uniform(-8, 8), 1.0)
+            transform[:, 2] += rng.uniform(-size / 30, size / 30, 2)
+            image = cv2.warpAffine(base, transform, (size, size), borderValue=255)
+            image = np.clip(image + rng.normal(0, 8, image.shape), 0, 255).astype(np.uint8)
+            cv2.imwrite(os.path.join(output_dir, f'{finger}_{impression}.png'), image)
+    return output_dir
+
+
+def error_rates(genuine, impostor, threshold):
+    """FAR/FRR at a threshold (scores above it are accepted) and the equal error rate"""
+    genuine = np.asarray(genuine, dtype=np.float64)
+    impostor = np.asarray(impostor, dtype=np.float64)
+    far = float(np.mean(impostor > threshold)) if len(impostor) else 0.0
+    frr = float(np.mean(genuine <= threshold)) if len(genuine) else 0.0
+
+    # Sweep every observed score as a threshold and take the point where FAR and FRR cross
+    eer, eer_threshold = 1.0, None
+    candidates = np.unique(np.concatenate([genuine, impostor, [-1.0]]))
+    best_gap = np.inf
+    for t in candidates:
+        t_far = np.mean(impostor > t) if len(impostor) else 0.0
+        t_frr = np.mean(genuine <= t) if len(genuine) else 0.0
+        if abs(t_far - t_frr) < best_gap:
+            best_gap = abs(t_far - t_frr)
+            eer, eer_threshold = float((t_far + t_frr) / 2), float(t)
+    return {'far': far, 'frr': frr, 'eer': eer, 'eer_threshold': eer_threshold, 'threshold': threshold}
+
+
+def evaluate(processor, dataset, enroll_impressions=1):
+    """Enroll the first impression(s) of every finger and score genuine/impostor attempts.
+
+    With enroll_impressions > 1 the first impressions are consolidated into
+    one template (FingerprintProcessor.consolidate_impressions). Genuine
+    attempts are the remaining impressions against their own finger;
+    impostor attempts are each finger's first remaining impression against
+    every other enrolled finger. Fingers without a remaining impression are
+    skipped. Templates go through the processor's stores like a real
+    enrollment (the 'store' stage), are read back cold from the store
+    ('template_load') and verified with score_against_template, i.e. through
+    the template and matcher caches. Stage latencies are collected through
+    processor.stage_timer.
+    """
+    dataset = {finger: paths for finger, paths in dataset.items() if len(paths) > enroll_impressions}
+    timer = StageTimer()
+    processor.stage_timer = timer
+
+    # Enrollment: extract and store the first impression(s) of every finger
+    enroll_start = time.perf_counter()
+    templates = {}
+    for finger, paths in dataset.items():
+        if enroll_impressions > 1:
+            descriptors, keypoints = processor.consolidate_impressions(
+                [processor.process_image(path) for path in paths[:enroll_impressions]])
+        else:
+            keypoints, descriptors = processor.process_image(paths[0])
+        if descriptors is not None:
+            with timer.time('store'):
+                processor.store_template(finger, descriptors, keypoints)
+            templates[finger] = descriptors
+    enroll_seconds = time.perf_counter() - enroll_start
+
+    backends = {}
+    for finger in templates:
+        # Storing dropped the cached copies, so this reads the template back from the store
+        with timer.time('template_load'):
+            view = processor.matching_view(processor.template_db[finger])
+        # Brute force or FLANN depending on matcher_backend (and template size for 'auto'), counted below
+        backend = choose_backend(len(view), processor.matcher_backend, processor.norm)
+        backends[backend] = backends.get(backend, 0) + 1
+        with timer.time('matcher_build'):
+            processor.matcher_cache.get(finger, view)
+
+    # Verification: extraction of each probe plus matching against the claimed finger
+    probes = {}
+    genuine, impostor = [], []
+    quality_rejected = 0
+    verify_start = time.perf_counter()
+
+    def score(path, finger):
+        nonlocal quality_rejected
+        if path not in probes:
+            keypoints, descriptors = processor.process_image(path)
+            probes[path] = (keypoint_coordinates(keypoints), descriptors)
+            if processor.last_quality is not None and not processor.last_quality.passed:
+                quality_rejected += 1
+        probe_keypoints, probe = probes[path]
+        if probe is None or finger not in templates:
+            return 0.0
+        # The stored template and its cached matcher, match_fingerprints times itself as the 'match' stage
+        return processor.score_against_template(finger, probe, probe_keypoints) or 0.0
+
+    for finger, paths in dataset.items():
+        for path in paths[enroll_impressions:]:
+            genuine.append(score(path, finger))
+    for finger, paths in dataset.items():
+        for other in templates:
+            if other != finger:
+                impostor.append(score(paths[enroll_impressions], other))
+    verify_seconds = time.perf_counter() - verify_start
+    processor.stage_timer = None
+
+    template_bytes = [template.nbytes for template in templates.values()]
+    keypoints = [len(template) for template in templates.values()]
+    attempts = len(genuine) + len(impostor)
+    report = {
+        'template_format': processor.template_format,
+        'score_mode': processor.score_mode,
+        'max_features': processor.max_features,
+        'canonical_size': processor.canonical_size,
+        'preprocess_mode': processor.preprocessor.mode,
+        'crop_roi': processor.preprocessor.crop_roi,
+        'matcher_backend': processor.matcher_backend,
+        'matchers_built': backends,  # {resolved backend: templates}, what the matcher_build stage timed
+        'enroll_impressions': enroll_impressions,
+        'fingers': len(dataset),
+        'images': sum(len(paths) for paths in dataset.values()),
+        'genuine_attempts': len(genuine),
+        'impostor_attempts': len(impostor),
+        'quality_rejected_probes': quality_rejected,
+        'enroll_per_second': len(templates) / enroll_seconds if enroll_seconds else 0.0,
+        'verify_per_second': attempts / verify_seconds if verify_seconds else 0.0,
+        'mean_template_bytes': float(np.mean(template_bytes)) if template_bytes else 0.0,
+        'mean_template_keypoints': float(np.mean(keypoints)) if keypoints else 0.0,
+        'bytes_per_keypoint': float(np.sum(template_bytes) / np.sum(keypoints)) if keypoints else 0.0,
+        'mean_genuine_score': float(np.mean(genuine)) if genuine else 0.0,
+        'mean_impostor_score': float(np.mean(impostor)) if impostor else 0.0,
+        'stages': timer.summary(),
+    }
+    report.update(error_rates(genuine, impostor, processor.match_threshold))
+    return report
+
+
+def run_benchmark(dataset_dir, formats=('sift',), score_modes=('ratio',), feature_caps=(1000,),
+                  canonical_size=None, enroll_impressions=(1,), preprocess_modes=('full',), crop_roi=(False,)):
+    """Run evaluate() for every template format, score mode, keypoint cap, preprocessing variant and
+    enrollment count on the same dataset"""
+    dataset = load_dataset(dataset_dir)
+    if not dataset:
+        raise ValueError(f"No FVC-style images (<finger>_<impression>.<ext>) found in {dataset_dir}")
+    results = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        for template_format in formats:
+            for score_mode in score_modes:
+                for max_features in feature_caps:
+                    for preprocess_mode in preprocess_modes:
+                        for crop in crop_roi:
+                            # Each configuration enrolls into stores of its own
+                            processor = FingerprintProcessor(tempfile.mkdtemp(dir=data_dir), autoload=False,
+                                                             template_format=template_format,
+                                                             score_mode=score_mode, max_features=max_features,
+                                                             canonical_size=canonical_size,
+                                                             preprocess_mode=preprocess_mode, crop_roi=crop)
+                            for impressions in enroll_impressions:
+                                results.append(evaluate(processor, dataset, impressions))
+    return {
+        'dataset': os.path.abspath(dataset_dir),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'process_peak_rss_bytes': peak_rss_bytes(),  # Whole run, not per result
+        'results': results,
+    }
+
+
+def median_ms(fn, repeats):
+    """Median wall-clock time of fn() in milliseconds"""
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return float(1000 * np.median(samples))
+
+
+def benchmark_matchers(dataset_dir, formats=('sift',), sizes=(50, 100, 200, 400, 800, 1600, 3200),
+                       candidates=10, repeats=5, canonical_size=None, seed=0):
+    """Time the FLANN and brute-force matcher backends against template size
+
+    Descriptors are extracted (uncapped) from every image of the dataset;
+    templates and probes of each size are drawn from disjoint halves of
+    that pool, the probe as large as the template. For each size this
+    reports FLANN build and query time, brute-force search time, and one
+    probe against `candidates` cached matchers of each backend, as
+    identification re-ranks its candidates. crossover_rows is the
+    smallest size at which FLANN wins, counting the build (first
+    verification of a user) and counting only the query (matcher cached).
+    """
+    paths = [path for finger_paths in load_dataset(dataset_dir).values() for path in finger_paths]
+    rng = np.random.default_rng(seed)
+    results = []
+    # Nothing is stored, but the processors must not create their stores in ./data
+    with tempfile.TemporaryDirectory() as data_dir:
+        for template_format in formats:
+            processor = FingerprintProcessor(data_dir, autoload=False, template_format=template_format,
+                                             max_features=0, canonical_size=canonical_size)
+            pool = [processor.process_image(path)[1] for path in paths]
+            pool = [processor.matching_view(descriptors) for descriptors in pool if descriptors is not None]
+            half = len(pool) // 2
+            template_pool, probe_pool = np.concatenate(pool[:half]), np.concatenate(pool[half:])
+            rows = []
+            for size in sizes:
+                if size > min(len(template_pool), len(probe_pool)):
+                    break
+                templates = [template_pool[rng.choice(len(template_pool), size, replace=False)]
+                             for _ in range(candidates)]
+                probe = probe_pool[rng.choice(len(probe_pool), size, replace=False)]
+                flann = [build_matcher(template, norm=processor.norm, backend='flann') for template in templates]
+                brute = [build_matcher(template, norm=processor.norm, backend='brute') for template in templates]
+                row = {
+                    'rows': size,
+                    'flann_build_ms': median_ms(lambda: build_matcher(templates[0], norm=processor.norm,
+                                                                      backend='flann'), repeats),
+                    'flann_query_ms': median_ms(lambda: flann[0].knn(probe, k=2), repeats),
+                    'brute_ms': median_ms(lambda: build_matcher(templates[0], norm=processor.norm,
+                                                                backend='brute').knn(probe, k=2), repeats),
+                    f'flann_cached_{candidates}_ms': median_ms(
+                        lambda: [matcher.knn(probe, k=2) for matcher in flann], repeats),
+                    f'brute_cached_{candidates}_ms': median_ms(
+                        lambda: [matcher.knn(probe, k=2) for matcher in brute], repeats),
+                }
+                row['flann_ms'] = row['flann_build_ms'] + row['flann_query_ms']
+                rows.append(row)
+            results.append({
+                'template_format': template_format,
+                'descriptor_pool': len(template_pool) + len(probe_pool),
+                'sizes': rows,
+                'crossover_rows': {
+                    'uncached': next((row['rows'] for row in rows if row['flann_ms'] < row['brute_ms']), None),
+                    'cached': next((row['rows'] for row in rows if row['flann_query_ms'] < row['brute_ms']), None),
+                },
+            })
+    return {
+        'dataset': os.path.abspath(dataset_dir),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {
+            'python': platform.python_version(),
+            'opencv': cv2.__version__,
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'process_peak_rss_bytes': peak_rss_bytes(),  # Whole run, not per format
+        'candidates': candidates,
+        'matchers': results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark speed and accuracy of the fingerprint pipeline")
+    parser.add_argument('dataset', nargs='?',
+                        help="Folder of FVC-style images (<finger>_<impression>.<ext>)")
+    parser.add_argument('--synthetic', type=int, metavar='FINGERS',
+                        help="Generate a synthetic dataset with this many fingers instead of reading one")
+    parser.add_argument('--impressions', type=int, default=4, help="Impressions per synthetic finger")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the synthetic dataset")
+    parser.add_argument('--formats', default='sift',
+                        help=f"Comma-separated template formats to compare ({', '.join(TEMPLATE_FORMATS)})")
+    parser.add_argument('--score-modes', default='ratio',
+                        help=f"Comma-separated score modes to compare ({', '.join(SCORE_MODES)})")
+    parser.add_argument('--max-features', default='1000',
+                        help="Comma-separated keypoint caps to compare (0 for no cap)")
+    parser.add_argument('--enroll-impressions', default='1',
+                        help="Comma-separated numbers of impressions consolidated into each template")
+    parser.add_argument('--canonical-size', type=int,
+                        help="Resize images so their longer side has this many pixels")
+    parser.add_argument('--preprocess-modes', default='full',
+                        help=f"Comma-separated preprocessing modes to compare ({', '.join(PREPROCESS_MODES)})")
+    parser.add_argument('--crop', choices=('off', 'on', 'both'), default='off',
+                        help="Crop images to the fingerprint before enhancing them ('both' compares the two)")
+    parser.add_argument('--matchers', action='store_true',
+                        help="Measure the FLANN / brute-force matcher crossover instead of the pipeline")
+    parser.add_argument('--matcher-sizes', default='50,100,200,400,800,1600,3200',
+                        help="Comma-separated template sizes (descriptors) for --matchers")
+    parser.add_argument('--output', help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    if args.dataset is None and args.synthetic is None:
+        parser.error("give a dataset folder or --synthetic FINGERS")
+
+    formats = [f.strip() for f in args.formats.split(',') if f.strip()]
+    score_modes = [m.strip() for m in args.score_modes.split(',') if m.strip()]
+    feature_caps = [int(n) for n in args.max_features.split(',') if n.strip()]
+    enroll_impressions = [int(n) for n in args.enroll_impressions.split(',') if n.strip()]
+    preprocess_modes = [m.strip() for m in args.preprocess_modes.split(',') if m.strip()]
+    crop_roi = {'off': [False], 'on': [True], 'both': [False, True]}[args.crop]
+    if args.matchers:
+        benchmark = benchmark_matchers
+        options = dict(sizes=[int(n) for n in args.matcher_sizes.split(',') if n.strip()],
+                       canonical_size=args.canonical_size, seed=args.seed)
+    else:
+        benchmark = run_benchmark
+        options = dict(score_modes=score_modes, feature_caps=feature_caps, canonical_size=args.canonical_size,
+                       enroll_impressions=enroll_impressions, preprocess_modes=preprocess_modes, crop_roi=crop_roi)
+    if args.synthetic is not None:
+        with tempfile.TemporaryDirectory() as dataset_dir:
+            generate_synthetic_dataset(dataset_dir, args.synthetic, args.impressions, seed=args.seed)
+            report = benchmark(dataset_dir, formats, **options)
+        report['dataset'] = f'synthetic:{args.synthetic}x{args.impressions}:seed={args.seed}'
+    else:
+        report = benchmark(args.dataset, formats, **options)
+
+    text = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    main()
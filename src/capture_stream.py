@@ -0,0 +1,177 @@
+import logging
+import os
+import queue
+import threading
+from collections import namedtuple
+import cv2
+import numpy as np
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+
+# One frame that made it through the extraction pipeline; descriptors is None if
+# the quality gate rejected it (quality holds the reason) or nothing was found
+FrameFeatures = namedtuple('FrameFeatures', ['index', 'keypoints', 'descriptors', 'quality'])
+
+# Outcome of FingerprintProcessor.verify_stream. decided is False when the
+# source ran out (or max_frames was reached) before the evidence was conclusive.
+StreamResult = namedtuple('StreamResult', ['is_match', 'score', 'decided', 'frames_read', 'frames_skipped',
+                                           'frames_rejected', 'frames_scored', 'seconds'])
+
+logger = logging.getLogger('capture_stream')
+
+# Queued for a frame the difference check skipped, so the queue bounds how far
+# the reader runs ahead in frames and not only in extracted frames
+_SKIPPED = object()
+
+
+def video_frames(source):
+    """Yield the frames of a video file, or of a camera given its device index"""
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video source {source}")
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                return
+            yield frame
+    finally:
+        capture.release()
+
+
+def directory_frames(directory, extensions=IMAGE_EXTENSIONS):
+    """Yield the images of a directory in file name order, skipping unreadable files"""
+    names = sorted(name for name in os.listdir(directory) if name.lower().endswith(extensions))
+    for name in names:
+        frame = cv2.imread(os.path.join(directory, name))
+        if frame is None:
+            logger.warning("Could not read frame %s", name)
+            continue
+        yield frame
+
+
+def frames_from(source):
+    """Frame iterator for a camera index, an image directory, a video file or any iterable of images"""
+    if isinstance(source, int):
+        return video_frames(source)
+    if isinstance(source, (str, os.PathLike)):
+        return directory_frames(source) if os.path.isdir(source) else video_frames(os.fspath(source))
+    return iter(source)
+
+
+class FrameDiff:
+    """Tells whether a frame differs enough from the last accepted one to be worth processing.
+
+    Frames are compared as size x size grayscale thumbnails; a frame is kept
+    when the mean absolute difference exceeds min_change gray levels. A
+    finger resting on a scanner produces runs of near-identical frames that
+    would give the same descriptors and the same score again.
+    """
+
+    def __init__(self, min_change=2.0, size=32):
+        self.min_change = min_change
+        self.size = size
+        self._last = None
+
+    def changed(self, frame):
+        """True (and remember the frame) if frame is the first one or differs from the last kept one"""
+        if len(frame.shape) == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        thumbnail = cv2.resize(frame, (self.size, self.size), interpolation=cv2.INTER_AREA)
+        if self._last is not None and float(np.mean(cv2.absdiff(thumbnail, self._last))) <= self.min_change:
+            return False
+        self._last = thumbnail
+        return True
+
+
+class FrameExtractor:
+    """Extracts features from a frame iterator in a background thread.
+
+    Reading a frame, the frame-difference check, preprocessing and feature
+    extraction run in the thread while the caller matches the previous
+    frame; at most max_buffered frames (extracted or skipped) wait in
+    between, so the thread never reads far past the frame being matched.
+    Use it as a context manager: leaving the block stops the thread after
+    its current frame, so a caller that has reached a decision does not pay
+    for the rest of the stream. The processor's OpenCV objects are used by the
+    thread only, the caller must not extract with the same processor until
+    the block is left.
+    """
+
+    def __init__(self, processor, frames, min_change=2.0, max_frames=None, max_buffered=2):
+        self.processor = processor
+        self.source = frames
+        self.frames = frames_from(frames)
+        self.diff = FrameDiff(min_change) if min_change is not None else None
+        self.max_frames = max_frames
+        self.frames_read = 0
+        self.frames_skipped = 0
+        self.frames_rejected = 0
+        self._queue = queue.Queue(maxsize=max_buffered)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='frame-extractor', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Stop the thread and wait for it to finish its current frame"""
+        self._stop.set()
+        while self._thread.is_alive():
+            # Unblock a put() the consumer will never take
+            try:
+                self._queue.get(timeout=0.05)
+            except queue.Empty:
+                pass
+        self._thread.join()
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if item is _SKIPPED:
+                continue
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.05)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        try:
+            for frame in self.frames:
+                if self._stop.is_set():
+                    break
+                index = self.frames_read
+                self.frames_read += 1
+                if frame is None or (self.diff is not None and not self.diff.changed(frame)):
+                    self.frames_skipped += 1
+                    if not self._put(_SKIPPED):
+                        break
+                else:
+                    keypoints, descriptors = self.processor.process_frame(frame)
+                    if descriptors is None:
+                        self.frames_rejected += 1
+                    if not self._put(FrameFeatures(index, keypoints, descriptors, self.processor.last_quality)):
+                        break
+                if self.max_frames is not None and self.frames_read >= self.max_frames:
+                    break
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+        finally:
+            # Sources opened here (videos, cameras) are released as soon as they are no longer needed
+            if self.frames is not self.source and hasattr(self.frames, 'close'):
+                self.frames.close()
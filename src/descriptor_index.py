@@ -0,0 +1,552 @@
+import logging
+import os
+import zlib
+from collections import namedtuple
+import cv2
+import numpy as np
+from template_store import TemplateStore
+
+logger = logging.getLogger('descriptor_index')
+
+# Two-level coarse quantizer: centroids are sorted by group, group g owning
+# centroids[group_starts[g]:group_starts[g + 1]]; a centroid's position is its list id
+Quantizer = namedtuple('Quantizer', ['centroids', 'centroid_norms', 'group_centers', 'group_norms',
+                                     'group_starts', 'trained_rows', 'checksum'])
+
+# What a search reads. Writers build a new snapshot and publish it with one
+# assignment, so a search never sees a half-applied add, remove or retrain.
+# lists maps list id -> (vectors, labels, rows, squared norms); user_ids maps
+# label -> user_id and alive[label] is False once that user was removed.
+_Snapshot = namedtuple('_Snapshot', ['quantizer', 'lists', 'user_ids', 'alive'])
+
+# Rows of one saved assignment before the list ids: template checksum, quantizer checksum
+ASSIGNMENT_HEADER_ROWS = 2
+
+# Vectors are transformed and assigned in blocks of this many rows
+ASSIGN_BLOCK_ROWS = 16384
+
+# k-means runs on at most this many sampled rows
+MAX_TRAIN_SAMPLE = 1 << 17
+
+
+class DescriptorIndex:
+    """Inverted-file (IVF) nearest-neighbour index over all enrolled descriptors.
+
+    Descriptors are assigned to the nearest of `nlist` k-means centroids and
+    kept in per-centroid posting lists, each row labelled with its owner. A
+    query only scans the `nprobe` closest lists. The number of lists grows
+    with the corpus (about rows_per_list rows each, retrained whenever the
+    corpus has doubled since training), so the rows scanned per query stay
+    roughly constant. The centroids themselves are clustered into about
+    sqrt(nlist) groups, and finding the closest lists only compares against
+    the centroids of the `group_probe` closest groups.
+
+    The trained quantizer is saved to <name>.quantizer.npz and the list
+    assignment of every user's descriptors to a TemplateStore named <name>,
+    so reopening the index never re-clusters or re-assigns descriptors. An
+    assignment is saved with checksums of the template and the quantizer
+    it was computed from and is recomputed when either has changed, e.g.
+    after a re-enrollment by a process that never loaded the index.
+
+    The index works in float32 L2 space; `transform` maps stored templates
+    and queries into it (e.g. unpacking binary descriptors to 0/1 vectors,
+    whose squared L2 distance is their Hamming distance). Lists are kept as
+    uint8 when that is lossless (SIFT values are integers up to 255, unpacked
+    bits are 0/1), a quarter of the float32 size.
+
+    Searches read an immutable snapshot and may run concurrently with each
+    other and with one writer (load/add/remove).
+    """
+
+    def __init__(self, data_dir='data', name='descriptor_index', nlist=None, nprobe=8, rows_per_list=256,
+                 group_probe=4, train_size_per_list=16, transform=None):
+        self.data_dir = data_dir
+        self.name = name
+        self.nlist = nlist  # Fixed number of lists, None to size them by rows_per_list
+        self.nprobe = nprobe
+        self.rows_per_list = rows_per_list
+        self.group_probe = group_probe
+        # Train once this many descriptors per list are available, and sample as many per list
+        self.train_size_per_list = train_size_per_list
+        self.transform = transform
+        self.quantizer_path = os.path.join(data_dir, f'{name}.quantizer.npz')
+        self.assignment_store = TemplateStore(data_dir, name=name)
+        self.loaded = False
+        self._reset()
+
+    def _reset(self):
+        self._snapshot = _Snapshot(None, {}, [], np.zeros(0, dtype=bool))
+        self._label_of = {}         # user_id -> live label
+        self._label_rows = []       # label -> number of rows
+        self._checksums = {}        # user_id -> checksum of the indexed template
+        self._buffers = {}          # list id -> [vectors, labels, rows, norms, count], grown in place
+        self._dtype = np.uint8      # Storage type of list vectors, float32 once a batch is not integral
+        self.total_rows = 0         # Rows in the lists, including those of removed users
+        self.dead_rows = 0
+
+    @property
+    def quantizer(self):
+        return self._snapshot.quantizer
+
+    @property
+    def trained(self):
+        return self._snapshot.quantizer is not None
+
+    def __len__(self):
+        return len(self._label_of)
+
+    def __contains__(self, user_id):
+        return user_id in self._label_of
+
+    def nbytes(self):
+        """Memory held by the posting lists, including room for appends"""
+        return sum(array.nbytes for buffer in self._buffers.values() for array in buffer[:4])
+
+    def load(self, templates, batch_rows=1 << 18):
+        """Build the in-memory lists from (user_id, descriptors) pairs (or a dict) and the saved assignments
+
+        Templates are consumed in batches, so an iterator keeps only one
+        batch of them in memory besides the lists.
+        """
+        self._reset()
+        self._load_quantizer()
+        self.assignment_store.open()
+        if hasattr(templates, 'items'):
+            templates = templates.items()
+
+        batch, rows = [], 0
+        for user_id, descriptors in templates:
+            if descriptors is None or len(descriptors) == 0:
+                continue
+            batch.append((user_id, descriptors))
+            rows += len(descriptors)
+            if rows >= batch_rows:
+                self._add_batch(batch, reuse_saved=True)
+                batch, rows = [], 0
+        self._add_batch(batch, reuse_saved=True)
+        if not self._maybe_train():
+            self._trim()
+        self.loaded = True
+        logger.info("Loaded descriptor index: %s users, %s rows in %s lists (%.1f MB).",
+                    len(self), self.total_rows, len(self._buffers), self.nbytes() / 1e6)
+
+    def add(self, user_id, descriptors):
+        """Add (or replace) the descriptors of one user"""
+        self.add_many([(user_id, descriptors)])
+
+    def add_many(self, entries):
+        """Add (or replace) the descriptors of several users, saving their assignments in one write"""
+        entries = list(dict(entries).items())  # The last entry of a user wins
+        for user_id, descriptors in entries:
+            if descriptors is None or len(descriptors) == 0:
+                self.remove(user_id)
+        self._add_batch([(user_id, descriptors) for user_id, descriptors in entries
+                         if descriptors is not None and len(descriptors) > 0])
+        if not self._maybe_train():
+            self._maybe_compact()
+
+    def remove(self, user_id):
+        """Drop a user's descriptors from future search results"""
+        label = self._drop(user_id)
+        if label is None:
+            return
+        alive = self._snapshot.alive.copy()
+        alive[label] = False
+        self._snapshot = self._snapshot._replace(alive=alive)
+        self.assignment_store.delete(user_id)
+        self._maybe_compact()
+
+    def _drop(self, user_id):
+        """Forget user_id's label and count its rows as dead; the caller publishes the new alive mask"""
+        label = self._label_of.pop(user_id, None)
+        self._checksums.pop(user_id, None)
+        if label is not None:
+            self.dead_rows += self._label_rows[label]
+        return label
+
+    def _vectors(self, descriptors):
+        if self.transform is not None:
+            descriptors = self.transform(descriptors)
+        return np.asarray(descriptors, dtype=np.float32)
+
+    def _add_batch(self, entries, reuse_saved=False):
+        """Append entries to the lists; saved assignments are reused if still valid, the rest are computed"""
+        if not entries:
+            return
+        snapshot = self._snapshot
+        quantizer = snapshot.quantizer
+        dropped, checksums, vectors, assignments, to_assign = [], [], [], [], []
+        for user_id, descriptors in entries:
+            dropped.append(self._drop(user_id))
+            checksum = template_checksum(descriptors)
+            assignment = None
+            if quantizer is not None and reuse_saved:
+                assignment = _saved_assignment(self.assignment_store.get(user_id), len(descriptors),
+                                               checksum, quantizer.checksum)
+            if assignment is None:
+                to_assign.append(len(vectors))
+            checksums.append(checksum)
+            vectors.append(self._vectors(descriptors))
+            assignments.append(assignment)
+
+        if quantizer is None:
+            assignments = [np.zeros(len(user_vectors), dtype=np.int32) for user_vectors in vectors]
+        elif to_assign:
+            computed = self._assign(quantizer, np.concatenate([vectors[i] for i in to_assign]))
+            bounds = np.cumsum([len(vectors[i]) for i in to_assign])[:-1]
+            for i, assignment in zip(to_assign, np.split(computed, bounds)):
+                assignments[i] = assignment
+            self.assignment_store.put_many(
+                (entries[i][0], _assignment_record(assignments[i], checksums[i], quantizer.checksum))
+                for i in to_assign)
+
+        # New labels continue after the last one; rows remember their position in the template
+        first = len(snapshot.user_ids)
+        for label, ((user_id, _), checksum, user_vectors) in enumerate(zip(entries, checksums, vectors), first):
+            snapshot.user_ids.append(user_id)
+            self._label_of[user_id] = label
+            self._label_rows.append(len(user_vectors))
+            self._checksums[user_id] = checksum
+        counts = [len(user_vectors) for user_vectors in vectors]
+        labels = np.repeat(np.arange(first, first + len(entries), dtype=np.int32), counts)
+        rows = np.concatenate([np.arange(count, dtype=np.int32) for count in counts])
+        self._store(self._buffers, np.concatenate(vectors), labels, rows, np.concatenate(assignments))
+
+        # Replaced users disappear and their new rows appear in the same snapshot
+        alive = np.concatenate([snapshot.alive, np.ones(len(entries), dtype=bool)])
+        alive[[label for label in dropped if label is not None]] = False
+        self._snapshot = snapshot._replace(lists=_lists(self._buffers), alive=alive)
+
+    def _store(self, buffers, vectors, labels, rows, assignment):
+        """Append rows to their lists in buffers, growing the list arrays geometrically"""
+        order = np.argsort(assignment, kind='stable')
+        list_ids, starts = np.unique(assignment[order], return_index=True)
+        bounds = list(starts[1:]) + [len(order)]
+        for list_id, start, end in zip(list_ids.tolist(), starts, bounds):
+            selected = order[start:end]
+            list_vectors = np.asarray(vectors[selected], dtype=np.float32)
+            stored = list_vectors.astype(self._dtype)
+            if self._dtype == np.uint8 and not np.array_equal(stored, list_vectors):
+                # Not integral or out of range: keep every list as float32 from now on
+                self._dtype, stored = np.float32, list_vectors
+                for other in buffers.values():
+                    other[0] = other[0].astype(np.float32)
+            buffer = buffers.get(list_id)
+            count = 0 if buffer is None else buffer[4]
+            needed = count + len(selected)
+            if buffer is None or needed > len(buffer[1]):
+                # Searches may still read the old arrays, so growing copies into new ones
+                capacity = max(needed, int(count * 1.5))
+                grown = [np.empty((capacity, vectors.shape[1]), dtype=self._dtype),
+                         np.empty(capacity, dtype=np.int32), np.empty(capacity, dtype=np.int32),
+                         np.empty(capacity, dtype=np.float32)]
+                if buffer is not None:
+                    for old, new in zip(buffer[:4], grown):
+                        new[:count] = old[:count]
+                buffer = buffers[list_id] = grown + [count]
+            # Rows past count are not part of any snapshot yet, so they are written in place
+            buffer[0][count:needed] = stored
+            buffer[1][count:needed] = labels[selected]
+            buffer[2][count:needed] = rows[selected]
+            buffer[3][count:needed] = np.einsum('ij,ij->i', list_vectors, list_vectors)
+            buffer[4] = needed
+        self.total_rows += len(vectors)
+
+    def _trim(self):
+        # Appending in batches leaves spare capacity at the end of the lists
+        for buffer in self._buffers.values():
+            if buffer[4] < len(buffer[1]):
+                buffer[:4] = [array[:buffer[4]].copy() for array in buffer[:4]]
+        self._snapshot = self._snapshot._replace(lists=_lists(self._buffers))
+
+    def _all_rows(self):
+        """(vectors, labels, rows, list ids) of every live row, ordered by label and template row"""
+        snapshot = self._snapshot
+        parts = [(list_id, snapshot.lists[list_id]) for list_id in sorted(snapshot.lists)]
+        if not parts:
+            return (np.zeros((0, 0), self._dtype), np.zeros(0, np.int32), np.zeros(0, np.int32),
+                    np.zeros(0, np.int32))
+        labels = np.concatenate([part[1] for _, part in parts])
+        rows = np.concatenate([part[2] for _, part in parts])
+        list_ids = np.repeat(np.array([list_id for list_id, _ in parts], dtype=np.int32),
+                             [len(part[1]) for _, part in parts])
+        live = np.flatnonzero(snapshot.alive[labels])
+        order = live[np.lexsort((rows[live], labels[live]))]
+        vectors = np.concatenate([part[0] for _, part in parts])[order]
+        return vectors, labels[order], rows[order], list_ids[order]
+
+    def _rebuild(self, vectors, labels, rows, assignment, quantizer=None):
+        """Replace all lists with exactly sized ones, renumbering labels densely, and publish them"""
+        snapshot = self._snapshot
+        quantizer = quantizer if quantizer is not None else snapshot.quantizer
+        live_labels, labels = np.unique(labels, return_inverse=True)
+        user_ids = [snapshot.user_ids[label] for label in live_labels.tolist()]
+        buffers = {}
+        self.total_rows, self.dead_rows = 0, 0
+        if len(labels):
+            self._store(buffers, vectors, labels.astype(np.int32), rows, assignment)
+        self._label_of = {user_id: label for label, user_id in enumerate(user_ids)}
+        self._label_rows = np.bincount(labels, minlength=len(user_ids)).tolist()
+        self._buffers = buffers
+        self._snapshot = _Snapshot(quantizer, _lists(buffers), user_ids, np.ones(len(user_ids), dtype=bool))
+
+    def _target_nlist(self, rows):
+        if self.nlist:
+            return self.nlist
+        return 1 << max(0, int(np.ceil(np.log2(max(rows, 1) / self.rows_per_list))))
+
+    def _maybe_train(self):
+        """Train the quantizer once there is enough data and retrain it whenever the corpus has doubled
+
+        Returns True if it (re)trained.
+        """
+        rows = self.total_rows - self.dead_rows
+        quantizer = self._snapshot.quantizer
+        nlist = self._target_nlist(rows)
+        if quantizer is None:
+            if nlist < 4 or rows < nlist * self.train_size_per_list:
+                return False
+        elif self.nlist or rows <= 2 * quantizer.trained_rows:
+            return False
+        self._train(nlist)
+        return True
+
+    def _train(self, nlist):
+        vectors, labels, rows, _ = self._all_rows()
+        sample = vectors
+        max_sample = min(nlist * self.train_size_per_list, MAX_TRAIN_SAMPLE)
+        if len(sample) > max_sample:
+            sample = sample[np.sort(np.random.default_rng(0).choice(len(sample), max_sample, replace=False))]
+        quantizer = train_quantizer(sample.astype(np.float32), nlist, trained_rows=len(vectors))
+        _save_quantizer(self.quantizer_path, quantizer)
+        logger.info("Trained descriptor index with %s lists in %s groups on %s descriptors.",
+                    len(quantizer.centroids), len(quantizer.group_centers), len(sample))
+
+        # Redistribute every row over the new lists and persist all assignments in one snapshot
+        assignment = self._assign(quantizer, vectors)
+        self._rebuild(vectors, labels, rows, assignment, quantizer)
+        user_ids = self._snapshot.user_ids
+        bounds = np.cumsum(self._label_rows)[:-1]
+        self.assignment_store.rewrite({
+            user_id: _assignment_record(user_assignment, self._checksums[user_id], quantizer.checksum)
+            for user_id, user_assignment in zip(user_ids, np.split(assignment, bounds))})
+
+    def _maybe_compact(self):
+        # Rows of removed or re-enrolled users are dropped once they outnumber the live ones
+        if self.dead_rows > max(self.total_rows - self.dead_rows, self.rows_per_list):
+            self._rebuild(*self._all_rows())
+
+    def _load_quantizer(self):
+        legacy_path = os.path.join(self.data_dir, f'{self.name}.centroids.npy')
+        if os.path.exists(legacy_path):
+            # Single-level centroids of the first release; the index is retrained from the templates
+            os.remove(legacy_path)
+        if os.path.exists(self.quantizer_path):
+            with np.load(self.quantizer_path) as saved:
+                quantizer = _make_quantizer(saved['centroids'], saved['group_centers'], saved['group_starts'],
+                                            int(saved['trained_rows']))
+            self._snapshot = self._snapshot._replace(quantizer=quantizer)
+
+    def _assign(self, quantizer, vectors):
+        """Nearest list for every row of (transformed) vectors, searched within the row's nearest group"""
+        assignment = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), ASSIGN_BLOCK_ROWS):
+            block = np.asarray(vectors[start:start + ASSIGN_BLOCK_ROWS], dtype=np.float32)
+            groups = np.argmin(quantizer.group_norms[None, :] - 2.0 * (block @ quantizer.group_centers.T), axis=1)
+            order = np.argsort(groups, kind='stable')
+            group_ids, firsts = np.unique(groups[order], return_index=True)
+            for group, begin, end in zip(group_ids.tolist(), firsts, list(firsts[1:]) + [len(order)]):
+                rows = order[begin:end]
+                first, last = int(quantizer.group_starts[group]), int(quantizer.group_starts[group + 1])
+                distances = quantizer.centroid_norms[None, first:last] - 2.0 * (
+                    block[rows] @ quantizer.centroids[first:last].T)
+                assignment[start + rows] = first + np.argmin(distances, axis=1)
+        return assignment
+
+    def search(self, queries, k=2):
+        """Approximate k nearest neighbours of every query row.
+
+        Returns (squared distances, labels), both shaped (len(queries), k).
+        Missing neighbours have distance inf and label -1.
+        """
+        return self._search(self._snapshot, self._vectors(queries), k)
+
+    def _search(self, snapshot, queries, k):
+        n = len(queries)
+        best_d = np.full((n, k), np.inf, dtype=np.float32)
+        best_l = np.full((n, k), -1, dtype=np.int32)
+        if n == 0 or not snapshot.lists:
+            return best_d, best_l
+
+        if snapshot.quantizer is not None:
+            probes = probe_lists(snapshot.quantizer, queries, self.nprobe, self.group_probe)
+        else:
+            probes = np.zeros((n, 1), dtype=np.int32)
+        nprobe = probes.shape[1]
+
+        # Visit every probed list once with all the queries probing it; each (query, probe) pair
+        # owns k columns of the candidate arrays, merged into the top k at the end
+        query_norms = np.einsum('ij,ij->i', queries, queries)
+        pairs = probes.ravel()
+        order = np.argsort(pairs, kind='stable')
+        list_ids, starts = np.unique(pairs[order], return_index=True)
+        bounds = list(starts[1:]) + [len(order)]
+        candidate_d = np.full((n, nprobe * k), np.inf, dtype=np.float32)
+        candidate_l = np.full((n, nprobe * k), -1, dtype=np.int32)
+        alive = snapshot.alive
+        all_alive = bool(alive.all())
+        for list_id, start, end in zip(list_ids.tolist(), starts, bounds):
+            entry = snapshot.lists.get(list_id)
+            if list_id < 0 or entry is None or len(entry[0]) == 0:
+                continue
+            vectors, labels, _, norms = entry
+            selected = order[start:end]
+            query_rows, slots = selected // nprobe, selected % nprobe
+            distances = query_norms[query_rows, None] + norms[None, :] - 2.0 * (
+                queries[query_rows] @ vectors.astype(np.float32, copy=False).T)
+            if not all_alive:
+                distances[:, ~alive[labels]] = np.inf
+            kk = min(k, distances.shape[1])
+            part = np.argpartition(distances, kk - 1, axis=1)[:, :kk] if kk < distances.shape[1] else \
+                np.broadcast_to(np.arange(kk), (len(selected), kk))
+            columns = slots[:, None] * k + np.arange(kk)
+            candidate_d[query_rows[:, None], columns] = np.take_along_axis(distances, part, axis=1)
+            candidate_l[query_rows[:, None], columns] = labels[part]
+
+        keep = np.argsort(candidate_d, axis=1)[:, :k]
+        width = keep.shape[1]
+        best_d[:, :width] = np.take_along_axis(candidate_d, keep, axis=1)
+        best_l[:, :width] = np.take_along_axis(candidate_l, keep, axis=1)
+        best_l[~np.isfinite(best_d)] = -1
+        return np.maximum(best_d, 0), best_l
+
+    def vote(self, queries, k=8, ratio=0.75):
+        """Vote for owners of the query descriptors with a single batched kNN query.
+
+        A query row votes for the user owning its nearest neighbour when that
+        neighbour passes the ratio test against the nearest neighbour that
+        belongs to a different user. Returns [(user_id, votes)] best first.
+        """
+        snapshot = self._snapshot
+        distances, labels = self._search(snapshot, self._vectors(queries), k)
+        if len(distances) == 0:
+            return []
+        first = labels[:, 0]
+        other = (labels != first[:, None]) & (labels >= 0)
+        has_other = other.any(axis=1)
+        second_d = np.where(has_other,
+                            distances[np.arange(len(labels)), np.argmax(other, axis=1)],
+                            np.inf)
+        # Distances are squared, so the ratio is squared as well
+        accepted = (first >= 0) & (distances[:, 0] < (ratio ** 2) * second_d)
+        counts = np.bincount(first[accepted], minlength=len(snapshot.alive))
+        ranked = np.argsort(counts)[::-1]
+        return [(snapshot.user_ids[label], int(counts[label])) for label in ranked if counts[label] > 0]
+
+
+def _lists(buffers):
+    """Snapshot view of list buffers: list id -> (vectors, labels, rows, squared norms)"""
+    return {list_id: tuple(array[:buffer[4]] for array in buffer[:4]) for list_id, buffer in buffers.items()}
+
+
+def template_checksum(descriptors):
+    """CRC32 of a template's bytes, saved with its assignment to detect re-enrollment"""
+    return zlib.crc32(np.ascontiguousarray(descriptors))
+
+
+def _assignment_record(assignment, template_crc, quantizer_crc):
+    header = np.array([template_crc, quantizer_crc], dtype=np.uint32).view(np.int32)
+    return np.concatenate([header, assignment.astype(np.int32)]).reshape(-1, 1)
+
+
+def _saved_assignment(record, rows, template_crc, quantizer_crc):
+    """List ids of a saved assignment, or None if it belongs to another template or quantizer"""
+    if record is None or len(record) != rows + ASSIGNMENT_HEADER_ROWS or record.dtype != np.int32:
+        return None
+    header = record[:ASSIGNMENT_HEADER_ROWS, 0].view(np.uint32)
+    if int(header[0]) != template_crc or int(header[1]) != quantizer_crc:
+        return None
+    return np.array(record[ASSIGNMENT_HEADER_ROWS:, 0])
+
+
+def _kmeans(points, k, iterations=8):
+    if k >= len(points):
+        return points.copy(), np.arange(len(points), dtype=np.int32)
+    if k == 1:
+        return points.mean(axis=0, keepdims=True), np.zeros(len(points), dtype=np.int32)
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, iterations, 1e-3)
+    _, labels, centers = cv2.kmeans(points, k, None, criteria, 1, cv2.KMEANS_PP_CENTERS)
+    return centers, labels.ravel()
+
+
+def train_quantizer(sample, nlist, trained_rows):
+    """Two-level k-means: about sqrt(nlist) groups, then each group's share of nlist centroids inside it"""
+    groups = max(1, min(int(round(np.sqrt(nlist))), len(sample)))
+    group_centers, group_labels = _kmeans(sample, groups)
+    centroids, starts = [], [0]
+    for group in range(len(group_centers)):
+        points = sample[group_labels == group]
+        if len(points) == 0:
+            points = group_centers[group:group + 1]
+        share = max(1, int(round(nlist * len(points) / len(sample))))
+        centers, _ = _kmeans(points, share)
+        centroids.append(centers)
+        starts.append(starts[-1] + len(centers))
+    return _make_quantizer(np.concatenate(centroids).astype(np.float32), group_centers.astype(np.float32),
+                           np.array(starts, dtype=np.int64), trained_rows)
+
+
+def _make_quantizer(centroids, group_centers, group_starts, trained_rows):
+    checksum = zlib.crc32(group_starts.tobytes(), zlib.crc32(centroids.tobytes()))
+    return Quantizer(centroids, np.einsum('ij,ij->i', centroids, centroids), group_centers,
+                     np.einsum('ij,ij->i', group_centers, group_centers), group_starts, trained_rows, checksum)
+
+
+def _save_quantizer(path, quantizer):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, centroids=quantizer.centroids, group_centers=quantizer.group_centers,
+             group_starts=quantizer.group_starts, trained_rows=quantizer.trained_rows)
+    os.replace(tmp_path, path)
+
+
+def probe_lists(quantizer, queries, nprobe, group_probe):
+    """Ids of the nprobe nearest lists of every query, (len(queries), nprobe); -1 pads short rows
+
+    Only the centroids of each query's group_probe nearest groups are compared.
+    """
+    n = len(queries)
+    starts = quantizer.group_starts
+    sizes = np.diff(starts)
+    group_probe = min(group_probe, len(sizes))
+    group_d = quantizer.group_norms[None, :] - 2.0 * (queries @ quantizer.group_centers.T)
+    if group_probe < len(sizes):
+        groups = np.argpartition(group_d, group_probe - 1, axis=1)[:, :group_probe]
+    else:
+        groups = np.broadcast_to(np.arange(len(sizes)), (n, len(sizes)))
+
+    width = int(sizes.max())
+    candidate_d = np.full((n, group_probe * width), np.inf, dtype=np.float32)
+    candidate_id = np.full((n, group_probe * width), -1, dtype=np.int32)
+    pairs = groups.ravel()
+    order = np.argsort(pairs, kind='stable')
+    group_ids, first = np.unique(pairs[order], return_index=True)
+    bounds = list(first[1:]) + [len(order)]
+    for group, begin, end in zip(group_ids.tolist(), first, bounds):
+        selected = order[begin:end]
+        query_rows, slots = selected // group_probe, selected % group_probe
+        start, stop = int(starts[group]), int(starts[group + 1])
+        distances = quantizer.centroid_norms[None, start:stop] - 2.0 * (
+            queries[query_rows] @ quantizer.centroids[start:stop].T)
+        columns = slots[:, None] * width + np.arange(stop - start)
+        candidate_d[query_rows[:, None], columns] = distances
+        candidate_id[query_rows[:, None], columns] = np.arange(start, stop, dtype=np.int32)
+
+    nprobe = min(nprobe, candidate_d.shape[1])
+    if nprobe < candidate_d.shape[1]:
+        best = np.argpartition(candidate_d, nprobe - 1, axis=1)[:, :nprobe]
+    else:
+        best = np.broadcast_to(np.arange(nprobe), (n, nprobe))
+    probes = np.take_along_axis(candidate_id, best, axis=1)
+    probes[~np.isfinite(np.take_along_axis(candidate_d, best, axis=1))] = -1
+    return probes
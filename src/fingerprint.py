@@ -1,205 +1,1058 @@
 import cv2
+import functools
+import logging
 import numpy as np
 import os
-import json
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from template_store import TemplateStore, migrate_json_templates
+from descriptor_index import DescriptorIndex
+from matcher_cache import MatcherCache, MATCHER_BACKENDS, build_matcher
+from user_registry import UserRegistry
+from template_cache import TemplateCache
+from quality import QualityGate
+from preprocess import PreprocessPipeline, PREPROCESS_MODES
+from capture_stream import FrameExtractor, StreamResult
+from metrics import SCORE_BUCKETS, COUNT_BUCKETS
+
+# Template formats: stored descriptor type and the distance used to match them.
+#   sift      float32 SIFT, 512 bytes per keypoint, L2 (FLANN)
+#   sift_u8   SIFT quantized to uint8, 128 bytes per keypoint, L2 (FLANN)
+#   sift_bin  SIFT binarized against each descriptor's median, 16 bytes, Hamming
+#   orb       ORB keypoints and descriptors, 32 bytes, Hamming
+TEMPLATE_FORMATS = {
+    'sift': {'dtype': np.float32, 'cols': 128, 'norm': 'l2'},
+    'sift_u8': {'dtype': np.uint8, 'cols': 128, 'norm': 'l2'},
+    'sift_bin': {'dtype': np.uint8, 'cols': 16, 'norm': 'hamming'},
+    'orb': {'dtype': np.uint8, 'cols': 32, 'norm': 'hamming'},
+}
+
+
+# Scoring modes for match_fingerprints:
+#   ratio   matches passing Lowe's ratio test (original behaviour)
+#   mutual  ratio-test matches that are also mutual nearest neighbours
+#   ransac  ratio-test matches consistent with one similarity transform of the keypoints
+SCORE_MODES = ('ratio', 'mutual', 'ransac')
+
+# Returned by FingerprintProcessor.stage() when no stage timer is attached
+_NO_STAGE_TIMER = nullcontext()
+
+# Diagnostics go through logging; per-match messages are DEBUG, so they cost
+# a level check unless logging.getLogger('fingerprint') is set to DEBUG
+logger = logging.getLogger('fingerprint')
+
+
+def timed_stage(name):
+    """Decorator timing a whole FingerprintProcessor method as one stage; a no-op without a stage_timer"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.stage_timer is None:
+                return method(self, *args, **kwargs)
+            with self.stage_timer.time(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def keypoint_coordinates(keypoints):
+    """Return keypoint positions as an (n, 2) float32 array (accepts cv2.KeyPoint lists or arrays)"""
+    if keypoints is None:
+        return None
+    if isinstance(keypoints, np.ndarray):
+        return keypoints.astype(np.float32, copy=False)
+    return np.array([kp.pt for kp in keypoints], dtype=np.float32).reshape(-1, 2)
+
+
+def binarize_descriptors(descriptors):
+    """Binarize float descriptors against each row's median and pack to bits"""
+    bits = descriptors > np.median(descriptors, axis=1, keepdims=True)
+    return np.packbits(bits, axis=1)
+
 
 class FingerprintProcessor:
-    def __init__(self, data_dir='data'):
+    def __init__(self, data_dir='data', warm_matchers=False, matcher_cache_bytes=256 * 1024 * 1024,
+                 autoload=True, template_format='sift', score_mode='ratio', max_features=1000,
+                 canonical_size=None, check_quality=True, template_memory_bytes=256 * 1024 * 1024,
+                 prefetch_recent=0, matcher_backend='auto', preprocess_mode='full', crop_roi=False,
+                 compare_preprocessing=False, match_threshold=0.5, open_stores=True):
+        if template_format not in TEMPLATE_FORMATS:
+            raise ValueError(f"Unknown template format {template_format!r}, expected one of {list(TEMPLATE_FORMATS)}")
+        if score_mode not in SCORE_MODES:
+            raise ValueError(f"Unknown score mode {score_mode!r}, expected one of {list(SCORE_MODES)}")
+        if matcher_backend not in MATCHER_BACKENDS:
+            raise ValueError(f"Unknown matcher backend {matcher_backend!r}, expected one of {list(MATCHER_BACKENDS)}")
+        if preprocess_mode not in PREPROCESS_MODES:
+            raise ValueError(f"Unknown preprocess mode {preprocess_mode!r}, expected one of {list(PREPROCESS_MODES)}")
         self.data_dir = data_dir
-        self.template_db = {}
-        self.match_threshold = 0.5  # Further lowered threshold
-        self.load_templates()
-        
-    def load_templates(self):
-        """Load fingerprint templates from file and convert descriptors back to numpy arrays"""
-        template_path = os.path.join(self.data_dir, 'templates.json')
-        if os.path.exists(template_path):
-            try:
-                with open(template_path, 'r') as f:
-                    loaded_data = json.load(f)
-                    self.template_db = {}
-                    for user_id, template_list in loaded_data.items():
-                        # Ensure template_list is not None and is a list before converting
-                        if isinstance(template_list, list) and template_list:
-                            self.template_db[user_id] = np.array(template_list, dtype=np.float32)
-                        else:
-                            self.template_db[user_id] = None # Store None if data is invalid or empty list
-                print("Templates loaded successfully.")
-            except Exception as e:
-                print(f"Error loading templates: {e}")
-                self.template_db = {}
+        self.template_format = template_format
+        # Keep at most this many keypoints (strongest response first), 0 for no limit
+        self.max_features = max_features
+        # Shrink images whose longer side exceeds this many pixels before processing (None keeps the size)
+        self.canonical_size = canonical_size
+        # Blank, smudged and partial captures are rejected before SIFT (see quality.py)
+        self.quality_gate = QualityGate() if check_quality else None
+        self.last_quality = None  # QualityReport of the last preprocessed image
+        self.norm = TEMPLATE_FORMATS[template_format]['norm']
+        self.match_threshold = match_threshold  # Minimum score for a match (FINGERPRINT_SETTINGS['match_threshold'])
+        self.ratio = 0.75  # Lowe's ratio test
+        self.score_mode = score_mode
+        self.ransac_threshold = 8.0  # Max reprojection error in pixels for a RANSAC inlier
+        # open_stores=False builds an extraction-only processor (pool workers) that never touches
+        # data_dir: opening a store replays its log and removes stale generations, which only
+        # the owning process may do. Its store, cache, registry and index attributes are None.
+        self.template_store = self.keypoint_store = self.finger_store = None
+        self.template_db = self.keypoint_db = self.finger_db = None
+        self.user_registry = None
+        self.descriptor_index = None
+        if open_stores:
+            self.template_store = TemplateStore(data_dir)
+            self.keypoint_store = TemplateStore(data_dir, name='keypoints')
+            self.finger_store = TemplateStore(data_dir, name='fingers')
+            # Templates are read from the stores on first use and kept in LRU working sets
+            # of at most template_memory_bytes; keypoints and finger labels are far smaller
+            self.template_db = TemplateCache(self.template_store, template_memory_bytes)
+            # user_id -> (n, 2) keypoint positions for the 'ransac' score mode
+            self.keypoint_db = TemplateCache(self.keypoint_store, template_memory_bytes // 16)
+            # user_id -> (n, 1) finger labels of multi-finger templates, else None
+            self.finger_db = TemplateCache(self.finger_store, template_memory_bytes // 16)
+            # Contact details, template references and enrollment times, see user_registry.py
+            self.user_registry = UserRegistry(os.path.join(data_dir, 'users.db'))
+            # Each format gets its own index since descriptor spaces differ
+            index_name = 'descriptor_index' if template_format == 'sift' else f'descriptor_index.{template_format}'
+            self.descriptor_index = DescriptorIndex(data_dir, name=index_name, transform=self.index_view)
+        self.identify_candidates = 10  # Candidates re-ranked with the ratio test in identify()
+        # How templates are searched, see matcher_cache.MATCHER_BACKENDS
+        self.matcher_backend = matcher_backend
+        self.matcher_cache = MatcherCache(max_bytes=matcher_cache_bytes, norm=self.norm, backend=matcher_backend)
+        # Optional object with time(stage_name) and record(stage_name, seconds), see
+        # benchmark.StageTimer and metrics.StageMetrics
+        self.stage_timer = None
+        self.metrics = None  # metrics.MetricsRegistry, set by instrument()
+        # OpenCV objects and preprocessing buffers are created once and reused; like the
+        # rest of the processor they are not meant to be shared between threads.
+        # The 'fast' threshold and foreground cropping are opt-in (see preprocess.py)
+        self.preprocessor = PreprocessPipeline(preprocess_mode, crop_roi=crop_roi, compare=compare_preprocessing)
+        if template_format == 'orb':
+            self._detector = cv2.ORB_create(nfeatures=max_features or 500)
         else:
-            print(f"No templates file found at {template_path}.") # Debugging print
-                
+            self._detector = cv2.SIFT_create(nfeatures=max_features or 0)
+        if autoload and open_stores:
+            self.load_templates(reopen=False)  # The stores have just read their indexes
+            if prefetch_recent:
+                self.prefetch_templates(limit=prefetch_recent)
+        if warm_matchers and open_stores:
+            warmed = self.matcher_cache.warm(self.template_db)
+            logger.info("Warmed matcher cache with %s templates.", warmed)
+        
+    @timed_stage('load_templates')
+    def load_templates(self, reopen=True):
+        """Open the binary template store, migrating templates.json on first run
+
+        Opening a store replays its write-ahead log over the last snapshot;
+        a write interrupted by a crash is discarded, committed ones are kept.
+        """
+        json_path = os.path.join(self.data_dir, 'templates.json')
+        try:
+            if not self.template_store.exists() and os.path.exists(json_path):
+                logger.info("Migrating %s to the binary template store...", json_path)
+                migrated = migrate_json_templates(json_path, self.template_store)
+                logger.info("Migrated %s templates.", migrated)
+
+            if not self.template_store.exists():
+                logger.info("No template store found in %s.", self.data_dir)
+                return
+
+            # Only the indexes are read, templates are loaded on first use
+            if reopen:
+                self.template_store.open()
+                self.keypoint_store.open()
+                self.finger_store.open()
+            for db in (self.template_db, self.keypoint_db, self.finger_db):
+                db.clear()
+            for store in (self.template_store, self.keypoint_store, self.finger_store):
+                if store.torn_bytes:
+                    logger.warning("Discarded %s bytes of an interrupted write in %s", store.torn_bytes,
+                                   store.index_path)
+            self.matcher_cache.clear()
+            # Register users whose templates predate the registry (one-off, skipped once it has caught up)
+            if len(self.user_registry) < len(self.template_store):
+                self.user_registry.record_templates(
+                    ((user_id, self.template_format, self.template_store.rows(user_id))
+                     for user_id in self.template_store.user_ids()),
+                    template_store=self.template_store.name, overwrite=False)
+            logger.info("Opened template store with %s users.", len(self.template_store))
+        except Exception as e:
+            logger.error("Error loading templates: %s", e)
+            self.template_db.clear()
+
+    @timed_stage('save_templates')
     def save_templates(self):
-        """Save fingerprint templates to file (convert numpy arrays to lists)"""
+        """Snapshot the template, keypoint and finger stores
+
+        Enrollment does not need this, store_templates() commits each template
+        to the log as it is enrolled; the stores also compact themselves. The
+        snapshot replaces each store atomically (see TemplateStore.rewrite).
+        """
         # Ensure data directory exists before saving
         if not os.path.exists(self.data_dir):
             os.makedirs(self.data_dir)
-            print(f"Created data directory at {self.data_dir}") # Debugging print
-            
-        template_path = os.path.join(self.data_dir, 'templates.json')
+            logger.info("Created data directory at %s", self.data_dir)
+
         try:
-            with open(template_path, 'w') as f:
-                # Convert numpy array descriptors to list for JSON serialization
-                serializable_template_db = {}
-                for user_id, template in self.template_db.items():
-                    if template is not None:
-                        # Ensure it's a numpy array before converting to list
-                        if isinstance(template, np.ndarray):
-                             serializable_template_db[user_id] = template.tolist()
-                        else:
-                             # If somehow not a numpy array, store as None or handle appropriately
-                             serializable_template_db[user_id] = None 
-                             print(f"Warning: Template for user {user_id} is not a numpy array before saving.")
-                    else:
-                        serializable_template_db[user_id] = None
-                        
-                json.dump(serializable_template_db, f, indent=4)
-            print("Templates saved successfully.")
+            for store in (self.template_store, self.keypoint_store, self.finger_store):
+                if store.exists():
+                    store.compact()
+            logger.info("Templates saved successfully.")
         except Exception as e:
-            print(f"Error saving templates: {e}")
-            
+            logger.error("Error saving templates: %s", e)
+
+    def stage(self, name):
+        """Context manager timing one pipeline stage when a stage_timer is attached"""
+        if self.stage_timer is None:
+            return _NO_STAGE_TIMER
+        return self.stage_timer.time(name)
+
+    def record_stages(self, samples):
+        """Add (stage, seconds) samples timed elsewhere, e.g. in a pool worker, to the stage timer"""
+        if self.stage_timer is None or not samples:
+            return
+        for name, seconds in samples:
+            self.stage_timer.record(name, seconds)
+
+    def instrument(self, metrics):
+        """Report stage latencies, match scores, descriptor counts and matcher cache state to a metrics.MetricsRegistry"""
+        self.metrics = metrics
+        self.stage_timer = metrics.stage_timer('fingerprint_stage_seconds', 'Duration of fingerprint pipeline stages')
+        self._score_histogram = metrics.histogram('fingerprint_match_score', 'Match scores', SCORE_BUCKETS)
+        self._descriptor_histogram = metrics.histogram('fingerprint_descriptors', 'Descriptors per extracted image',
+                                                       COUNT_BUCKETS)
+        cache = self.matcher_cache
+        for key, kind in (('entries', 'gauge'), ('current_bytes', 'gauge'), ('hits', 'counter'),
+                          ('misses', 'counter'), ('evictions', 'counter')):
+            getattr(metrics, kind)(f'fingerprint_matcher_cache_{key}', f'Matcher cache {key.replace("_", " ")}',
+                                   function=lambda key=key: cache.stats()[key])
+        metrics.gauge('fingerprint_templates', 'Enrolled templates', function=lambda: len(self.template_db))
+        templates = self.template_db
+        for key, kind in (('entries', 'gauge'), ('current_bytes', 'gauge'), ('hits', 'counter'),
+                          ('misses', 'counter'), ('evictions', 'counter')):
+            getattr(metrics, kind)(f'fingerprint_template_cache_{key}', f'Template working set {key.replace("_", " ")}',
+                                   function=lambda key=key: templates.stats()[key])
+        return metrics
+
+    def observe_extraction(self, descriptors, quality=None):
+        """Count the descriptors of one extracted image, or its quality rejection, in the metrics"""
+        if self.metrics is None:
+            return
+        self._descriptor_histogram.observe(len(descriptors) if descriptors is not None else 0)
+        if quality is not None and not quality.passed:
+            self.metrics.counter('fingerprint_quality_rejections_total', 'Captures rejected by the quality gate',
+                                 reason=quality.reason).inc()
+
+    @timed_stage('preprocess')
     def preprocess_fingerprint(self, image):
-        """Preprocess fingerprint image for better matching"""
+        """Preprocess fingerprint image for better matching
+
+        Returns None if the quality gate rejects the capture; the reason is
+        in self.last_quality. The result is a buffer of self.preprocessor,
+        overwritten by the next call.
+        """
+        self.last_quality = None
         if len(image.shape) == 3:
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            
-        # Apply CLAHE
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-        enhanced = clahe.apply(image)
-        
-        # Apply Gaussian blur
-        blurred = cv2.GaussianBlur(enhanced, (5, 5), 0)
-        
-        # Apply adaptive thresholding
-        thresh = cv2.adaptiveThreshold(blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-                                     cv2.THRESH_BINARY, 11, 2)
-        
+            with self.stage('grayscale'):
+                image = self.preprocessor.grayscale(image)
+
+        # Bring every scan to the same scale so keypoint counts and sizes are comparable
+        if self.canonical_size:
+            with self.stage('resize'):
+                image = self.normalize_resolution(image)
+
+        # Cheap quality check so bad captures never reach CLAHE, SIFT and FLANN
+        if self.quality_gate is not None:
+            with self.stage('quality'):
+                self.last_quality = self.quality_gate.assess(image)
+            if not self.last_quality.passed:
+                logger.info("Rejected capture: %s (quality score %.2f)",
+                            self.last_quality.reason, self.last_quality.score)
+                return None
+
+        # CLAHE, Gaussian blur and adaptive thresholding (optionally cropped, downsampled threshold)
+        thresh = self.preprocessor.enhance(image, self.stage)
+        if self.preprocessor.compare:
+            logger.debug("Preprocessing agrees with the full-resolution path on %.4f of the pixels",
+                         self.preprocessor.last_agreement)
         return thresh
-        
+
+    def normalize_resolution(self, image):
+        """Shrink image so its longer side is at most canonical_size (into a buffer reused by the next call)"""
+        return self.preprocessor.resize(image, self.canonical_size)
+
+    @timed_stage('extract_features')
     def extract_features(self, image):
         """Extract fingerprint features using SIFT"""
         # Ensure image is in correct format (CV_8U) for SIFT
         if image is None:
-            print("Warning: Input image for feature extraction is None.")
+            logger.warning("Input image for feature extraction is None.")
             return None, None
 
         if image.dtype != np.uint8:
             image = image.astype(np.uint8)
             
-        sift = cv2.SIFT_create()
-        keypoints, descriptors = sift.detectAndCompute(image, None)
+        with self.stage('extract'):
+            keypoints, descriptors = self._detector.detectAndCompute(image, None)
+
+        # The detector may return a few more than max_features (e.g. extra orientations), enforce the cap
+        if self.max_features and descriptors is not None and len(keypoints) > self.max_features:
+            responses = np.array([kp.response for kp in keypoints], dtype=np.float32)
+            strongest = np.sort(np.argsort(-responses, kind='stable')[:self.max_features])
+            keypoints = [keypoints[i] for i in strongest]
+            descriptors = descriptors[strongest]
         
-        # Return descriptors as float32 numpy array
-        return keypoints, descriptors.astype(np.float32) if descriptors is not None else None
+        # Return descriptors in the configured template format
+        return keypoints, self.encode_descriptors(descriptors) if descriptors is not None else None
+
+    def encode_descriptors(self, descriptors):
+        """Convert raw detector output to the configured template format"""
+        if self.template_format == 'sift_u8':
+            # OpenCV SIFT descriptor values are already integers in 0..255
+            return np.clip(np.rint(descriptors), 0, 255).astype(np.uint8)
+        if self.template_format == 'sift_bin':
+            return binarize_descriptors(descriptors.astype(np.float32))
+        if self.template_format == 'orb':
+            return descriptors.astype(np.uint8)
+        return descriptors.astype(np.float32)
+
+    def matching_view(self, template):
+        """Return template in the representation its matcher expects"""
+        if self.norm == 'hamming':
+            return np.ascontiguousarray(template, dtype=np.uint8)
+        return template.astype(np.float32, copy=False)
+
+    def index_view(self, template):
+        """Map a template into the float L2 space of the descriptor index"""
+        if self.norm == 'hamming':
+            # Squared L2 distance between 0/1 vectors equals their Hamming distance
+            return np.unpackbits(np.asarray(template, dtype=np.uint8), axis=1).astype(np.float32)
+        return np.asarray(template, dtype=np.float32)
         
-    def match_fingerprints(self, template1, template2):
-        """Match two fingerprint templates"""
+    @timed_stage('match')
+    def match_fingerprints(self, template1, template2, matcher=None, keypoints1=None, keypoints2=None,
+                           labels2=None):
+        """Match two fingerprint templates
+
+        If matcher is given it must already be trained on template2 (see
+        MatcherCache), otherwise a FLANN index is built for this call.
+        keypoints1/keypoints2 are the (n, 2) keypoint positions of the
+        templates, used by the 'ransac' score mode. labels2 gives the finger
+        of each template2 row for multi-finger templates; every finger is then
+        scored from the same kNN search and the best score is returned.
+        """
         if template1 is None or template2 is None:
-            print("Warning: One of the templates is None for matching.")
+            logger.warning("One of the templates is None for matching.")
             return 0
             
         # template1 is from the current image (already float32 from extract_features)
         # template2 is the stored one (should be float32 numpy array from load_templates)
 
-        # Use FLANN matcher
-        FLANN_INDEX_KDTREE = 1
-        index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
-        search_params = dict(checks=50)
-        flann = cv2.FlannBasedMatcher(index_params, search_params)
-        
         try:
             # Ensure there are enough descriptors to match (SIFT usually needs at least 2)
             if template1.shape[0] < 2 or template2.shape[0] < 2:
-                 print(f"Warning: Not enough descriptors for matching. Template1 count: {template1.shape[0]}, Template2 count: {template2.shape[0]}")
+                 logger.warning("Not enough descriptors for matching. Template1 count: %s, Template2 count: %s",
+                                template1.shape[0], template2.shape[0])
                  return 0
 
-            matches = flann.knnMatch(template1, template2, k=2)
-            
-            # Apply ratio test
-            good_matches = []
-            # Ensure match has at least 2 results before ratio test
-            if len(matches) > 0 and len(matches[0]) == 2:
-                 for m, n in matches:
-                    if m.distance < 0.75 * n.distance:
-                        good_matches.append(m)
-            else:
-                 print("Warning: knnMatch returned fewer than 2 matches, skipping ratio test.")
-
-            # Calculate match score
-            # Avoid division by zero if one template has no descriptors (though checked above)
-            max_len = max(template1.shape[0], template2.shape[0])
-            if max_len == 0:
-                return 0
-            match_score = len(good_matches) / max_len
-            print(f"Calculated Match Score: {match_score}")
-            return match_score
+            # Use FLANN matcher (or a Hamming matcher for binary formats), or brute force for small templates
+            if matcher is None:
+                with self.stage('matcher_build'):
+                    matcher = build_matcher(template2, norm=self.norm, backend=self.matcher_backend)
+            with self.stage('knn_match'):
+                distances, indices = matcher.knn(template1, k=2)
+            return self._score_knn(distances, indices, template1, template2, keypoints1, keypoints2, labels2)
         except Exception as e:
-            print(f"Error during matching: {e}")
+            logger.error("Error during matching: %s", e)
             return 0
+
+    def _score_knn(self, distances, indices, template1, template2, keypoints1=None, keypoints2=None,
+                   labels2=None):
+        """Score of template1 against template2 from the 2-NN of every template1 row in template2"""
+        # Apply ratio test
+        with self.stage('ratio_test'):
+            # LSH may return fewer than 2 neighbours for some rows, those cannot pass the ratio test
+            valid = np.isfinite(distances[:, 1])
+            good = valid & (distances[:, 0] < self.ratio * distances[:, 1])
+        if not valid.any():
+             logger.warning("kNN search returned fewer than 2 neighbours, skipping ratio test.")
+
+        if self.score_mode == 'mutual':
+            with self.stage('mutual_check'):
+                good &= self._mutual_mask(template1, template2, indices[:, 0])
+
+        if labels2 is None:
+            match_score = self._score(good, indices[:, 0], template1.shape[0], template2.shape[0],
+                                      keypoints1, keypoints2)
+        else:
+            # Each finger is scored on the matches that landed on it, against its own size
+            labels2 = np.asarray(labels2).reshape(-1)
+            nearest_labels = np.where(indices[:, 0] >= 0, labels2[indices[:, 0]], -1)
+            match_score = 0
+            for label in np.unique(labels2):
+                match_score = max(match_score, self._score(
+                    good & (nearest_labels == label), indices[:, 0], template1.shape[0],
+                    int(np.count_nonzero(labels2 == label)), keypoints1, keypoints2))
+        logger.debug("Calculated Match Score: %s", match_score)
+        if self.metrics is not None:
+            self._score_histogram.observe(match_score)
+        return match_score
             
+    def _score(self, good, nearest, rows1, rows2, keypoints1, keypoints2):
+        """Good matches (RANSAC inliers in the 'ransac' mode) over the larger template size
+
+        Sizes count at most max_features rows: probes are capped at
+        extraction, so a stored template enrolled before the cap (or merged
+        from several impressions) must not lower every score against it.
+        """
+        if self.score_mode == 'ransac' and keypoints1 is not None and keypoints2 is not None:
+            with self.stage('ransac'):
+                good_count = self._ransac_inliers(keypoints1, keypoints2, good, nearest)
+        else:
+            good_count = int(good.sum())
+
+        if self.max_features:
+            rows1, rows2 = min(rows1, self.max_features), min(rows2, self.max_features)
+        # Avoid division by zero if one template has no descriptors (though checked above)
+        max_len = max(rows1, rows2)
+        if max_len == 0:
+            return 0
+        return good_count / max_len
+
+    def _mutual_mask(self, template1, template2, nearest):
+        """Mask of template1 rows whose nearest neighbour in template2 points back at them"""
+        reverse = build_matcher(template1, norm=self.norm, backend=self.matcher_backend).knn(
+            template2, k=1)[1][:, 0]
+        rows = np.arange(len(nearest))
+        has_match = nearest >= 0
+        mutual = np.zeros(len(nearest), dtype=bool)
+        mutual[has_match] = reverse[nearest[has_match]] == rows[has_match]
+        return mutual
+
+    def _ransac_inliers(self, keypoints1, keypoints2, good, nearest):
+        """Number of good matches consistent with one rotation/scale/translation"""
+        keypoints1 = keypoint_coordinates(keypoints1)
+        keypoints2 = keypoint_coordinates(keypoints2)
+        rows = np.flatnonzero(good)
+        # Keypoints that do not line up with the descriptors cannot be used
+        if (len(rows) < 3 or len(keypoints1) <= rows.max()
+                or len(keypoints2) <= nearest[rows].max()):
+            return len(rows)
+        _, inliers = cv2.estimateAffinePartial2D(keypoints1[rows], keypoints2[nearest[rows]],
+                                                 method=cv2.RANSAC,
+                                                 ransacReprojThreshold=self.ransac_threshold)
+        return int(inliers.sum()) if inliers is not None else 0
+
     def process_image(self, image_path):
         """Process a fingerprint image and return features"""
-        image = cv2.imread(image_path)
+        with self.stage('imread'):
+            image = cv2.imread(image_path)
         if image is None:
-            print(f"Error: Could not read image from {image_path}")
+            logger.error("Could not read image from %s", image_path)
             return None, None
-            
+        return self.process_frame(image)
+        
+    def process_image_bytes(self, data):
+        """Process an encoded image (PNG, JPEG, BMP, TIFF... file contents) and return features"""
+        with self.stage('imread'):
+            image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            logger.error("Could not decode image data")
+            return None, None
+        return self.process_frame(image)
+
+    def process_frame(self, image):
+        """Process a decoded image (BGR or grayscale array, e.g. a camera frame) and return features"""
         processed = self.preprocess_fingerprint(image)
-        return self.extract_features(processed)
+        if processed is None:
+            self.observe_extraction(None, self.last_quality)
+            return None, None
+        keypoints, descriptors = self.extract_features(processed)
+        self.observe_extraction(descriptors, self.last_quality)
+        return keypoints, descriptors
+
+    def store_template(self, user_id, descriptors, keypoints=None, fingers=None):
+        """Store fingerprint template (and optionally its keypoints and finger labels) for a user"""
+        self.store_templates([(user_id, descriptors, keypoints, fingers)])
+
+    def store_templates(self, entries):
+        """Store many (user_id, descriptors, keypoints[, fingers]) templates with one flush and one registry transaction"""
+        templates, coordinates, labels = [], [], []
+        for user_id, descriptors, keypoints, *fingers in entries:
+            fingers = fingers[0] if fingers else None
+            # Ensure descriptors is a numpy array before storing
+            if descriptors is None or not isinstance(descriptors, np.ndarray):
+                logger.warning("Attempted to store invalid descriptors for user %s", user_id)
+                templates.append((user_id, None))
+                coordinates.append((user_id, None))
+                labels.append((user_id, None))
+                continue
+            positions = keypoint_coordinates(keypoints)
+            if positions is not None and len(positions) != len(descriptors):
+                logger.warning("Keypoints for user %s do not match the descriptors, not storing them.", user_id)
+                positions = None
+            if fingers is not None:
+                fingers = np.asarray(fingers, dtype=np.int32).reshape(-1, 1)
+                if len(fingers) != len(descriptors):
+                    raise ValueError(f"Finger labels for user {user_id} do not match the descriptors")
+            templates.append((user_id, descriptors))
+            coordinates.append((user_id, positions))
+            labels.append((user_id, fingers))
+
+        # Append only these users' templates instead of rewriting the whole store
+        self.template_store.put_many(templates)
+        self.keypoint_store.put_many(coordinates)
+        # Most users have a single finger, only touch the finger store when needed
+        if self.finger_store.exists() or any(fingers is not None for _, fingers in labels):
+            self.finger_store.put_many(labels)
+        for user_id, _ in templates:
+            for db in (self.template_db, self.keypoint_db, self.finger_db):
+                db.invalidate(user_id)
+            self.matcher_cache.invalidate(user_id)
+
+        # Keep the identification index in step once it has been built. An index loaded later
+        # recomputes the assignments of templates changed meanwhile (they are keyed by checksum)
+        if self.descriptor_index.loaded:
+            self.descriptor_index.add_many((user_id, self.template_db.get(user_id)) for user_id, _ in templates)
+
+        self.user_registry.record_templates(
+            ((user_id, self.template_format, 0 if descriptors is None else len(descriptors))
+             for user_id, descriptors in templates),
+            template_store=self.template_store.name)
+
         
-    def store_template(self, user_id, descriptors):
-        """Store fingerprint template for a user"""
-        # Ensure descriptors is a numpy array before storing
-        if descriptors is not None and isinstance(descriptors, np.ndarray):
-            self.template_db[user_id] = descriptors
-            self.save_templates()
+    def remove_template(self, user_id):
+        """Delete a user's template, keypoints and finger labels (logged, so it survives a restart)"""
+        for store in (self.template_store, self.keypoint_store, self.finger_store):
+            store.delete(user_id)
+        for db in (self.template_db, self.keypoint_db, self.finger_db):
+            db.invalidate(user_id)
+        self.matcher_cache.invalidate(user_id)
+        if self.descriptor_index.loaded:
+            self.descriptor_index.remove(user_id)
+        self.user_registry.record_templates([(user_id, self.template_format, 0)],
+                                            template_store=self.template_store.name)
+
+    def consolidate_impressions(self, impressions, max_size=None):
+        """Merge several impressions of one finger into a single deduplicated template
+
+        impressions is a list of (keypoints, descriptors) as returned by
+        extract_features. Descriptors that are mutual ratio-test matches between
+        impressions are grouped as observations of the same keypoint; each group
+        is kept once (its medoid) and groups seen in the most impressions come
+        first. Keypoint positions are mapped into the frame of the
+        best-connected impression, so the result also works with the 'ransac'
+        score mode: impressions are registered along the strongest pairwise
+        alignments, so one that only overlaps another non-reference impression
+        is still placed. An impression that aligns with none of the others is
+        dropped (with a warning) since its positions would be meaningless.
+        At most max_size (default: max_features) descriptors are kept.
+
+        Returns (descriptors, keypoint positions), or (None, None).
+        """
+        impressions = [(keypoint_coordinates(keypoints), descriptors) for keypoints, descriptors in impressions
+                       if descriptors is not None and len(descriptors) >= 2]
+        if not impressions:
+            return None, None
+        max_size = max_size or self.max_features or sum(len(d) for _, d in impressions)
+
+        offsets = np.cumsum([0] + [len(descriptors) for _, descriptors in impressions])
+        descriptors = np.concatenate([descriptors for _, descriptors in impressions])
+        source = np.repeat(np.arange(len(impressions)), np.diff(offsets))
+        views = [self.matching_view(d) for _, d in impressions]
+        matchers = [build_matcher(view, norm=self.norm, backend=self.matcher_backend) for view in views]
+
+        # Union-find over all descriptors, joined by mutual ratio-test matches
+        parent = np.arange(len(descriptors))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        # Pairwise similarity transforms: alignments[i][j] = (transform from j's frame into i's, inliers)
+        alignments = [{} for _ in impressions]
+        for i in range(len(impressions)):
+            for j in range(i + 1, len(impressions)):
+                rows_i, rows_j = self._mutual_ratio_matches(views[i], matchers[j], matchers[i])
+                for a, b in zip(rows_i + offsets[i], rows_j + offsets[j]):
+                    root_a, root_b = find(a), find(b)
+                    if root_a != root_b:
+                        parent[root_b] = root_a
+                positions_i, positions_j = impressions[i][0], impressions[j][0]
+                if len(rows_i) >= 3 and positions_i is not None and positions_j is not None:
+                    transform, inliers = cv2.estimateAffinePartial2D(
+                        positions_j[rows_j], positions_i[rows_i], method=cv2.RANSAC,
+                        ransacReprojThreshold=self.ransac_threshold)
+                    if transform is not None and inliers.sum() >= 3:
+                        alignments[i][j] = (transform, int(inliers.sum()))
+                        alignments[j][i] = (cv2.invertAffineTransform(transform), int(inliers.sum()))
+
+        if all(impression_positions is None for impression_positions, _ in impressions):
+            # Without keypoint positions there is no geometry to keep consistent
+            positions = None
+            usable = np.ones(len(descriptors), dtype=bool)
         else:
-            self.template_db[user_id] = None # Store None if descriptors are invalid
-            print(f"Warning: Attempted to store invalid descriptors for user {user_id}")
+            transforms = _register(alignments)
+            # Keypoints of impressions that could not be registered have no usable position
+            positions = np.full((len(descriptors), 2), np.nan, dtype=np.float32)
+            for i, (impression_positions, _) in enumerate(impressions):
+                if transforms[i] is not None and impression_positions is not None:
+                    positions[offsets[i]:offsets[i + 1]] = cv2.transform(
+                        impression_positions.reshape(-1, 1, 2), transforms[i]).reshape(-1, 2)
+                else:
+                    logger.warning("Impression %s of %s could not be registered with the others, "
+                                   "dropping its %s descriptors", i + 1, len(impressions), offsets[i + 1] - offsets[i])
+            usable = ~np.isnan(positions[:, 0])
+
+        groups = {}
+        for row in np.flatnonzero(usable):
+            groups.setdefault(find(row), []).append(row)
+        space = self.index_view(descriptors)
+        ranked = []
+        for members in groups.values():
+            members = np.array(members)
+            if len(members) > 1:
+                # The medoid stands for the group; it keeps the template's dtype unlike a mean
+                group = space[members]
+                distances = ((group[:, None, :] - group[None, :, :]) ** 2).sum(axis=2)
+                representative = members[np.argmin(distances.sum(axis=1))]
+            else:
+                representative = members[0]
+            # Seen in more impressions first, ties in input order (first impression first)
+            ranked.append((-len(np.unique(source[members])), representative))
+        ranked.sort()
+        keep = np.array([row for _, row in ranked[:max_size]], dtype=np.int64)
+        return descriptors[keep], positions[keep] if positions is not None else None
+
+    def _mutual_ratio_matches(self, queries, matcher, query_matcher):
+        """Rows of queries and of matcher's template that are mutual ratio-test matches"""
+        distances, indices = matcher.knn(queries, k=2)
+        good = np.isfinite(distances[:, 1]) & (distances[:, 0] < self.ratio * distances[:, 1])
+        rows = np.flatnonzero(good)
+        nearest = indices[rows, 0]
+        reverse = query_matcher.knn(matcher.template, k=1)[1][:, 0]
+        mutual = reverse[nearest] == rows
+        return rows[mutual], nearest[mutual]
+
+    def enroll_impressions(self, user_id, impressions, max_size=None, quality=None):
+        """Enroll several impressions per finger (and several fingers) as one consolidated template
+
+        impressions is a list of (keypoints, descriptors) of one finger, or a
+        dict {finger name: list of (keypoints, descriptors)}. Each finger is
+        consolidated separately (see consolidate_impressions); fingers are
+        stored together with per-descriptor finger labels so verification
+        scores all of them with one kNN search. quality, the capture quality
+        score, is kept in the user registry. Returns the number of stored
+        descriptors (0 if nothing could be enrolled).
+        """
+        fingers = impressions if isinstance(impressions, dict) else {'default': impressions}
+        names, templates, positions, labels = [], [], [], []
+        for name, finger_impressions in fingers.items():
+            descriptors, finger_positions = self.consolidate_impressions(finger_impressions, max_size)
+            if descriptors is None:
+                logger.warning("No usable impressions of finger %s for user %s", name, user_id)
+                continue
+            labels.append(np.full(len(descriptors), len(names), dtype=np.int32))
+            names.append(name)
+            templates.append(descriptors)
+            positions.append(finger_positions)
+        if not templates:
+            return 0
+
+        positions = None if any(p is None for p in positions) else np.concatenate(positions)
+        self.store_template(user_id, np.concatenate(templates), positions,
+                            fingers=np.concatenate(labels) if len(names) > 1 else None)
+        user = self.user_registry.get_user(user_id)
+        metadata = user['metadata'] if user else {}
+        metadata.update({'fingers': names,
+                         'impressions': {name: len(fingers[name]) for name in names}})
+        self.user_registry.add_user(user_id, metadata=metadata, quality=quality)
+        return sum(len(template) for template in templates)
+
+    def enroll_images(self, user_id, image_paths, max_size=None, workers=0):
+        """enroll_impressions() from image files: a list of paths, or {finger name: list of paths}"""
+        fingers = image_paths if isinstance(image_paths, dict) else {'default': image_paths}
+        pairs = [(name, path) for name, paths in fingers.items() for path in paths]
+        impressions = {name: [] for name in fingers}
+        scores = []
+        for (name, _), (keypoints, descriptors, quality) in self._extract_items(
+                pairs, lambda pair: pair[1], workers, True, None):
+            impressions[name].append((keypoints, descriptors))
+            if descriptors is not None and quality is not None:
+                scores.append(quality.score)
+        return self.enroll_impressions(user_id, impressions if isinstance(image_paths, dict)
+                                       else impressions['default'], max_size,
+                                       quality=float(np.mean(scores)) if scores else None)
 
-        
     def verify_fingerprint(self, user_id, image_path):
         """Verify a fingerprint against stored template"""
-        if user_id not in self.template_db or self.template_db[user_id] is None:
-            print(f"Error: No template found for user {user_id}")
+        user = self.user_registry.get_user(user_id)
+        if user is None:
+            logger.error("User %s is not enrolled", user_id)
             return False
+        if not user['template_rows'] or not self.has_template(user_id):
+            logger.error("No template found for user %s", user_id)
+            return False
+        self.user_registry.touch(user_id)
             
         keypoints, descriptors = self.process_image(image_path)
         if descriptors is None:
-            print(f"Error: Could not extract descriptors from verification image {image_path}")
+            logger.error("Could not extract descriptors from verification image %s", image_path)
             return False
-            
+
+        match_score = self.score_against_template(user_id, descriptors, keypoints)
+        if match_score is None:
+            return False
+
+        # Check if the match score exceeds the threshold
+        is_match = match_score > self.match_threshold
+        logger.info("Verification result for user %s (Image: %s) - Score: %s, Threshold: %s, Match: %s",
+                    user_id, os.path.basename(image_path), match_score, self.match_threshold, is_match)
+        
+        return is_match
+
+    @timed_stage('verify_stream')
+    def verify_stream(self, user_id, frames, accept_frames=2, reject_frames=5, confident_score=None,
+                      max_frames=None, min_frame_change=2.0):
+        """Verify a user from a live frame sequence, stopping as soon as the decision is confident
+
+        frames is a camera index, a video file, a directory of images or any
+        iterable of BGR/grayscale arrays (see capture_stream.frames_from).
+        Frames are extracted in a background thread while the previous one is
+        matched; frames that barely differ from the last processed one and
+        captures rejected by the quality gate are not scored. Evidence is
+        accumulated over the scored frames: the user is accepted once
+        accept_frames frames exceed match_threshold (or one frame reaches
+        confident_score, default twice the threshold) and rejected once
+        reject_frames frames do not. At most max_frames frames are read.
+        Returns a capture_stream.StreamResult; score is the best frame score.
+        """
+        started = time.perf_counter()
+        if confident_score is None:
+            confident_score = 2 * self.match_threshold
+        if not self.has_template(user_id):
+            logger.error("No template found for user %s", user_id)
+            return StreamResult(False, 0, True, 0, 0, 0, 0, time.perf_counter() - started)
+        self.user_registry.touch(user_id)
+
+        accepted = rejected = 0
+        best_score = 0
+        is_match = decided = False
+        with FrameExtractor(self, frames, min_frame_change, max_frames) as extractor:
+            for frame in extractor:
+                if frame.descriptors is None:
+                    continue
+                score = self.score_against_template(user_id, frame.descriptors, frame.keypoints) or 0
+                best_score = max(best_score, score)
+                if score > self.match_threshold:
+                    accepted += 1
+                else:
+                    rejected += 1
+                logger.debug("Stream frame %s for user %s - Score: %s", frame.index, user_id, score)
+                if accepted >= accept_frames or score >= confident_score:
+                    is_match = decided = True
+                    break
+                if rejected >= reject_frames:
+                    decided = True
+                    break
+
+        result = StreamResult(is_match, best_score, decided, extractor.frames_read, extractor.frames_skipped,
+                              extractor.frames_rejected, accepted + rejected, time.perf_counter() - started)
+        if self.metrics is not None:
+            for outcome, count in (('skipped', result.frames_skipped), ('rejected', result.frames_rejected),
+                                   ('scored', result.frames_scored)):
+                self.metrics.counter('fingerprint_stream_frames_total', 'Frames of streamed verifications',
+                                     outcome=outcome).inc(count)
+        logger.info("Stream verification for user %s - Match: %s, Best score: %s, Decided: %s, "
+                    "Frames read/skipped/rejected/scored: %s/%s/%s/%s in %.3fs",
+                    user_id, is_match, best_score, decided, result.frames_read, result.frames_skipped,
+                    result.frames_rejected, result.frames_scored, result.seconds)
+        return result
+
+    def has_template(self, user_id):
+        """True if user_id has a usable stored template (checked in the index, nothing is read)"""
+        return self.template_store.rows(user_id) > 0
+
+    def prefetch_templates(self, user_ids=None, limit=100):
+        """Load the templates of user_ids (default: the limit most recently seen users) ahead of use
+
+        Stops once the template working set is full. Returns how many templates were loaded.
+        """
+        if user_ids is None:
+            user_ids = self.user_registry.recent_users(limit)
+        user_ids = list(user_ids)
+        loaded = self.template_db.prefetch(user_ids)
+        self.keypoint_db.prefetch(user_ids)
+        self.finger_db.prefetch(user_ids)
+        logger.info("Prefetched %s templates.", loaded)
+        return loaded
+
+    def score_against_template(self, user_id, descriptors, keypoints=None):
+        """Match extracted descriptors against a user's stored template
+
+        Returns the match score, or None if the stored template is unusable.
+        """
         # Retrieve stored template (should be a numpy array)
         stored_template = self.template_db[user_id]
 
         # Double-check if stored_template is indeed a numpy array before matching
         if not isinstance(stored_template, np.ndarray):
-             print(f"Error: Stored template for user {user_id} is not a numpy array, it is {type(stored_template)}.")
+             logger.error("Stored template for user %s is not a numpy array, it is %s.",
+                          user_id, type(stored_template))
              # Attempt to convert here as a fallback, though it should be handled in load_templates
              if isinstance(stored_template, list):
-                  print("Attempting fallback conversion from list to numpy array...")
+                  logger.info("Attempting fallback conversion from list to numpy array...")
                   stored_template = np.array(stored_template, dtype=np.float32)
                   # Update the template in the db to prevent future errors?
                   self.template_db[user_id] = stored_template
              else:
-                 return False # Cannot proceed if template is not a valid type
+                 return None # Cannot proceed if template is not a valid type
 
-        # Ensure both descriptors are float32 and numpy arrays before passing to match_fingerprints
-        if descriptors.dtype != np.float32:
-             descriptors = descriptors.astype(np.float32)
-             print("Warning: Descriptors from current image not float32, converting.")
-             
-        if stored_template.dtype != np.float32:
-             stored_template = stored_template.astype(np.float32)
-             print("Warning: Stored template not float32, converting.")
+        # Templates enrolled under another template format cannot be compared
+        expected_cols = TEMPLATE_FORMATS[self.template_format]['cols']
+        if stored_template.shape[1] != expected_cols or descriptors.shape[1] != expected_cols:
+             logger.error("Template for user %s does not match the '%s' format, re-enroll the user.",
+                          user_id, self.template_format)
+             return None
 
+        # Convert both to the matcher's representation (float32 for L2, uint8 for Hamming)
+        descriptors = self.matching_view(descriptors)
+        stored_template = self.matching_view(stored_template)
 
-        match_score = self.match_fingerprints(descriptors, stored_template)
-        
-        # Check if the match score exceeds the threshold
-        is_match = match_score > self.match_threshold
-        print(f"Verification result for user {user_id} (Image: {os.path.basename(image_path)}) - Score: {match_score}, Threshold: {self.match_threshold}, Match: {is_match}")
-        
-        return is_match 
\ No newline at end of file
+        matcher = self.matcher_cache.get(user_id, stored_template)
+        return self.match_fingerprints(descriptors, stored_template, matcher=matcher,
+                                       keypoints1=keypoints, keypoints2=self.keypoint_db.get(user_id),
+                                       labels2=self.finger_db.get(user_id))
+
+    def score_against_templates(self, user_ids, descriptors, keypoints=None):
+        """Scores of one probe against several users' templates: [(user_id, score)] in input order
+
+        Each template is matched with its cached matcher. Stacking the
+        templates into one distance product was measured slower at every
+        size brute force is used for (python src/benchmark.py --matchers):
+        it rebuilds the stacked vectors and norms the cached matchers keep.
+        """
+        return [(user_id, self.score_against_template(user_id, descriptors, keypoints)) for user_id in user_ids]
+
+    def worker_config(self):
+        """Settings a pool worker needs to extract features exactly like this processor (no data_dir)"""
+        return {'template_format': self.template_format,
+                'score_mode': self.score_mode, 'max_features': self.max_features,
+                'canonical_size': self.canonical_size, 'check_quality': self.quality_gate is not None,
+                'match_threshold': self.match_threshold,
+                'preprocess_mode': self.preprocessor.mode, 'crop_roi': self.preprocessor.crop_roi,
+                'compare_preprocessing': self.preprocessor.compare}
+
+    def extract_many(self, image_paths, workers=None, ordered=True, max_in_flight=None):
+        """Extract descriptors for many images on a process pool
+
+        Yields (image_path, descriptors) pairs, in input order when ordered is
+        True or as each image finishes otherwise. At most max_in_flight images
+        (default: two per worker) are queued at once, which bounds memory use.
+        workers=0 runs serially in this process.
+        """
+        for image_path, (keypoints, descriptors, _) in self._extract_items(
+                image_paths, lambda image_path: image_path, workers, ordered, max_in_flight):
+            yield image_path, descriptors
+
+    def verify_many(self, pairs, workers=None, ordered=True, max_in_flight=None):
+        """Verify many (user_id, image_path) pairs, extracting features on a process pool
+
+        Yields (user_id, image_path, score, is_match) tuples. Scores are the same
+        as verify_fingerprint produces; a missing template or unreadable image
+        scores 0. Matching runs in this process, where the templates live.
+        """
+        for (user_id, image_path), (keypoints, descriptors, _) in self._extract_items(
+                pairs, lambda pair: pair[1], workers, ordered, max_in_flight):
+            score = None
+            if descriptors is not None and self.has_template(user_id):
+                score = self.score_against_template(user_id, descriptors, keypoints)
+            score = score or 0
+            yield user_id, image_path, score, score > self.match_threshold
+
+    def _extract_items(self, items, image_path_of, workers, ordered, max_in_flight):
+        """Yield (item, (keypoint positions, descriptors, quality report)) for each item's image"""
+        if workers == 0:
+            for item in items:
+                yield item, _extract_image(self, image_path_of(item))
+            return
+
+        workers = workers or os.cpu_count() or 1
+        max_in_flight = max_in_flight or 2 * workers
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(self.worker_config(), self.stage_timer is not None)) as executor:
+            for item, (result, samples) in _bounded_map(executor, _extract_worker, items, image_path_of,
+                                                        max_in_flight, ordered):
+                self.record_stages(samples)
+                self.observe_extraction(result[1], result[2])
+                yield item, result
+
+    def identify(self, image_path, top_k=1):
+        """Identify whose fingerprint an image is (1:N search over all enrolled users)
+
+        Returns up to top_k (user_id, score) pairs, best first, for candidates
+        whose score exceeds match_threshold.
+        """
+        keypoints, descriptors = self.process_image(image_path)
+        if descriptors is None:
+            logger.error("Could not extract descriptors from identification image %s", image_path)
+            return []
+
+        results = self.identify_descriptors(descriptors, keypoints, top_k)
+        logger.info("Identification result (Image: %s) - Candidates: %s",
+                    os.path.basename(image_path), results)
+        return results
+
+    def load_descriptor_index(self):
+        """Build the identification index from the stored templates (done by the first identify())
+
+        Must not run concurrently with enrollment; once loaded, searches read
+        a snapshot of the index and need no lock.
+        """
+        # Templates enrolled under another format live in a different descriptor space
+        expected_cols = TEMPLATE_FORMATS[self.template_format]['cols']
+        # Streamed, so only one batch of templates is resident besides the index lists
+        self.descriptor_index.load((user_id, template) for user_id, template in self.template_db.items()
+                                   if template is not None and template.shape[1] == expected_cols)
+
+    def identify_descriptors(self, descriptors, keypoints=None, top_k=1):
+        """identify() for descriptors that have already been extracted"""
+        if not self.descriptor_index.loaded:
+            self.load_descriptor_index()
+
+        # One batched kNN query against the global index picks the candidates...
+        votes = self.descriptor_index.vote(descriptors)
+        candidates = [user_id for user_id, _ in votes[:max(top_k, self.identify_candidates)]]
+
+        # ...and only those are re-ranked with the full ratio-test match, in one batch
+        candidates = [user_id for user_id in candidates if self.has_template(user_id)]
+        scores = self.score_against_templates(candidates, descriptors, keypoints)
+        results = [(user_id, score) for user_id, score in scores if (score or 0) > self.match_threshold]
+
+        results.sort(key=lambda result: result[1], reverse=True)
+        return results[:top_k]
+
+
+def _register(alignments):
+    """Transforms of every impression into the frame of the best-connected one (None where unreachable)
+
+    alignments[i][j] is (2x3 transform from j's frame into i's, inlier count).
+    The reference is the impression with the most inliers over all its
+    alignments; the others are attached along the strongest alignment to an
+    already registered impression (a maximum spanning tree), composing the
+    transforms on the way.
+    """
+    count = len(alignments)
+    reference = max(range(count), key=lambda i: (sum(inliers for _, inliers in alignments[i].values()), -i))
+    transforms = [None] * count
+    transforms[reference] = np.array([[1, 0, 0], [0, 1, 0]], dtype=np.float64)
+    while True:
+        edges = [(inliers, -j, i, j) for i in range(count) if transforms[i] is not None
+                 for j, (_, inliers) in alignments[i].items() if transforms[j] is None]
+        if not edges:
+            return transforms
+        _, _, i, j = max(edges)
+        # j's frame -> i's frame -> the reference frame
+        into_i = np.vstack([alignments[i][j][0], [0, 0, 1]])
+        transforms[j] = (np.vstack([transforms[i], [0, 0, 1]]) @ into_i)[:2]
+
+
+# Process pool helpers for extract_many / verify_many. Each worker builds its
+# own extraction-only processor (open_stores=False) so OpenCV objects are per
+# process and the stores in data_dir are only ever opened by their owner.
+# Worker functions return (result, stage samples) so the parent can merge the
+# stage timings into its own timer.
+_worker_processor = None
+
+
+class _StageRecorder:
+    """Stage timer of a pool worker, buffering (stage, seconds) samples until they are shipped back"""
+
+    def __init__(self):
+        self.samples = []
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples.append((stage, time.perf_counter() - start))
+
+    def record(self, stage, seconds):
+        self.samples.append((stage, seconds))
+
+    def drain(self):
+        samples, self.samples = self.samples, []
+        return samples
+
+
+def _init_worker(config, record_stages=False):
+    global _worker_processor
+    _worker_processor = FingerprintProcessor(open_stores=False, **config)
+    if record_stages:
+        _worker_processor.stage_timer = _StageRecorder()
+
+
+def _worker_samples():
+    timer = _worker_processor.stage_timer
+    return timer.drain() if timer is not None else None
+
+
+def _extract_image(processor, image_path):
+    # cv2.KeyPoint objects cannot be pickled, so only their positions are returned
+    keypoints, descriptors = processor.process_image(image_path)
+    return keypoint_coordinates(keypoints) if descriptors is not None else None, descriptors, processor.last_quality
+
+
+def _extract_worker(image_path):
+    return _extract_image(_worker_processor, image_path), _worker_samples()
+
+
+def _extract_bytes(processor, data):
+    keypoints, descriptors = processor.process_image_bytes(data)
+    return keypoint_coordinates(keypoints) if descriptors is not None else None, descriptors, processor.last_quality
+
+
+def _extract_bytes_worker(data):
+    return _extract_bytes(_worker_processor, data), _worker_samples()
+
+
+def _bounded_map(executor, fn, items, arg_of, max_in_flight, ordered):
+    """Submit fn(arg_of(item)) for each item, never holding more than max_in_flight results
+
+    Yields (item, result) in submission order if ordered, else as completed.
+    """
+    items = iter(items)
+    if ordered:
+        pending = deque()
+        for item in items:
+            pending.append((item, executor.submit(fn, arg_of(item))))
+            if len(pending) >= max_in_flight:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+    else:
+        pending = {}
+        for item in items:
+            pending[executor.submit(fn, arg_of(item))] = item
+            if len(pending) >= max_in_flight:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield pending.pop(future), future.result()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
@@ -1,10 +1,16 @@
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
-import cv2
 from PIL import Image, ImageTk
+import logging
 import os
+import sys
 from fingerprint import FingerprintProcessor
 from otp import OTPHandler
+from otp_delivery import DeliveryError, QueueFullError
+
+# Make the project root importable so config/ can be found when run as src/main.py
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config.settings import FINGERPRINT_SETTINGS, EMAIL_CONFIG, OTP_SETTINGS
 
 class FingerprintOTPSystem:
     def __init__(self, root):
@@ -13,8 +19,19 @@ class FingerprintOTPSystem:
         self.root.geometry("800x600")
         
         # Initialize components
-        self.fp_processor = FingerprintProcessor()
-        self.otp_handler = OTPHandler()
+        self.fp_processor = FingerprintProcessor(
+            match_threshold=FINGERPRINT_SETTINGS['match_threshold'],
+            max_features=FINGERPRINT_SETTINGS['max_features'],
+            canonical_size=FINGERPRINT_SETTINGS['canonical_size'],
+            template_memory_bytes=FINGERPRINT_SETTINGS['template_memory_mb'] * 1024 * 1024,
+            prefetch_recent=FINGERPRINT_SETTINGS['prefetch_recent_users'],
+            matcher_backend=FINGERPRINT_SETTINGS['matcher_backend'],
+            preprocess_mode=FINGERPRINT_SETTINGS['preprocess_mode'],
+            crop_roi=FINGERPRINT_SETTINGS['crop_to_foreground'],
+        )
+        self.otp_handler = OTPHandler(email_config=EMAIL_CONFIG, expiry_minutes=OTP_SETTINGS['expiry_minutes'])
+        # Phone numbers live in the persistent registry next to the templates
+        self.user_registry = self.fp_processor.user_registry
         
         # Create GUI elements
         self.create_gui()
@@ -50,7 +67,7 @@ class FingerprintOTPSystem:
         self.enroll_phone_entry.grid(row=2, column=1, sticky=(tk.W, tk.E), pady=5)
         
         self.enroll_image_path = None
-        self.enroll_browse_btn = ttk.Button(enroll_frame, text="Browse Fingerprint Image", command=self.browse_enroll_image)
+        self.enroll_browse_btn = ttk.Button(enroll_frame, text="Browse Fingerprint Image(s)", command=self.browse_enroll_image)
         self.enroll_browse_btn.grid(row=3, column=0, columnspan=2, pady=10)
         
         self.enroll_status_label = ttk.Label(enroll_frame, text="")
@@ -72,7 +89,11 @@ class FingerprintOTPSystem:
         
         self.verify_image_path = None
         self.verify_browse_btn = ttk.Button(verify_frame, text="Browse Fingerprint Image", command=self.browse_verify_image)
-        self.verify_browse_btn.grid(row=2, column=0, columnspan=2, pady=10)
+        self.verify_browse_btn.grid(row=2, column=0, pady=10)
+        # A scanner recording (video) is verified frame by frame, stopping at the first confident decision
+        self.verify_stream_source = None
+        self.verify_stream_btn = ttk.Button(verify_frame, text="Browse Capture Video", command=self.browse_verify_stream)
+        self.verify_stream_btn.grid(row=2, column=1, pady=10)
         
         ttk.Label(verify_frame, text="Enter OTP:").grid(row=3, column=0, sticky=tk.W)
         self.verify_otp_entry = ttk.Entry(verify_frame)
@@ -89,14 +110,16 @@ class FingerprintOTPSystem:
         
     def browse_enroll_image(self):
         initial_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data', 'datasets')
-        file_path = filedialog.askopenfilename(
+        # Several impressions of the same finger can be selected, they are consolidated into one template
+        file_paths = filedialog.askopenfilenames(
             initialdir=initial_dir,
-            title="Select Fingerprint Image for Enrollment",
+            title="Select Fingerprint Image(s) for Enrollment",
             filetypes=[("Image files", "*.png *.jpg *.jpeg *.bmp *.tif")] # Added .tif
         )
-        if file_path:
-            self.enroll_image_path = file_path
-            self.enroll_status_label.config(text=f"Image selected: {os.path.basename(file_path)}")
+        if file_paths:
+            self.enroll_image_path = list(file_paths)
+            names = ', '.join(os.path.basename(path) for path in file_paths)
+            self.enroll_status_label.config(text=f"Image(s) selected: {names}")
             
     def browse_verify_image(self):
         initial_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data', 'datasets')
@@ -107,7 +130,18 @@ class FingerprintOTPSystem:
         )
         if file_path:
             self.verify_image_path = file_path
+            self.verify_stream_source = None
             self.verify_status_label.config(text=f"Image selected: {os.path.basename(file_path)}")
+
+    def browse_verify_stream(self):
+        file_path = filedialog.askopenfilename(
+            title="Select Fingerprint Capture Video for Verification",
+            filetypes=[("Video files", "*.avi *.mp4 *.mov *.mkv")]
+        )
+        if file_path:
+            self.verify_stream_source = file_path
+            self.verify_image_path = None
+            self.verify_status_label.config(text=f"Capture selected: {os.path.basename(file_path)}")
             
     def enroll_user(self):
         user_id = self.enroll_user_id_entry.get()
@@ -122,36 +156,12 @@ class FingerprintOTPSystem:
              messagebox.showerror("Error", "Please enter a valid phone number with country code (e.g., +1234567890).")
              return
              
-        # Process image and get descriptors
-        image = cv2.imread(self.enroll_image_path)
-        if image is None:
-            messagebox.showerror("Error", "Failed to read image.")
-            return
-        
-        processed_image = self.fp_processor.preprocess_fingerprint(image)
-        keypoints, descriptors = self.fp_processor.extract_features(processed_image)
-        
-        if descriptors is None:
-            messagebox.showerror("Error", "Could not extract features from image. Please try another image.")
+        # Process the image(s) and store the (consolidated) template
+        if not self.fp_processor.enroll_images(user_id, self.enroll_image_path):
+            messagebox.showerror("Error", f"Could not extract features from image{self.quality_hint()}. Please try another image.")
             return
             
-        # Store user and template
-        # In a real system, you'd have a user database here. For now, let's simulate storage.
-        # We need a simple way to associate user_id and phone with the template.
-        # Let's add a simple user storage in FingerprintProcessor or main.
-        
-        # For now, let's assume we store user data directly with templates or in a simple dict
-        # Let's modify FingerprintProcessor to handle user data too, or add a user_db here.
-        # Adding a simple user_db here for demonstration.
-        if not hasattr(self, 'user_data_db'):
-            self.user_data_db = {}
-            
-        self.user_data_db[user_id] = {
-            'phone': phone,
-            # Add other potential user data here later
-        }
-        
-        self.fp_processor.store_template(user_id, descriptors)
+        self.user_registry.add_user(user_id, phone=phone)
         
         messagebox.showinfo("Success", f"User {user_id} enrolled successfully!")
         self.enroll_status_label.config(text=f"Enrollment successful for {user_id}")
@@ -162,49 +172,99 @@ class FingerprintOTPSystem:
             messagebox.showerror("Error", "Please enter User ID to generate OTP.")
             return
             
-        # Retrieve phone number from stored user data
-        if not hasattr(self, 'user_data_db') or user_id not in self.user_data_db:
+        # Retrieve phone number from the user registry
+        user = self.user_registry.get_user(user_id)
+        if user is None or not user['phone']:
              messagebox.showerror("Error", "User not found. Please enroll the user first.")
              return
              
-        phone_number = self.user_data_db[user_id]['phone']
+        phone_number = user['phone']
 
-        # Generate and send OTP
-        success = self.otp_handler.create_otp(user_id, phone=phone_number)
-        
-        if success:
+        # Generate and queue the OTP, delivery happens in the background
+        try:
+            delivery = self.otp_handler.create_otp(user_id, phone=phone_number)
+        except QueueFullError:
+            self.verify_status_label.config(text="Failed to send OTP: delivery queue is full")
+            messagebox.showerror("OTP Failed", "Too many OTPs are being sent right now. Please try again shortly.")
+            return
+        except (DeliveryError, ValueError) as e:
+            # The delivery queue is shut down or the transport is not configured
+            self.verify_status_label.config(text="Failed to send OTP")
+            messagebox.showerror("OTP Failed", f"Could not send OTP: {e}")
+            return
+        if delivery is None:
+            self.verify_status_label.config(text="Failed to send OTP")
+            messagebox.showerror("OTP Failed", "No phone number to send the OTP to.")
+            return
+        self.verify_status_label.config(text=f"Sending OTP to WhatsApp for User ID: {user_id}...")
+        self.root.after(200, self.check_otp_delivery, user_id, delivery)
+
+    def check_otp_delivery(self, user_id, delivery):
+        # Poll from the Tk main loop, widgets must not be touched from delivery threads
+        if not delivery.done():
+            self.root.after(200, self.check_otp_delivery, user_id, delivery)
+            return
+
+        if delivery.result().delivered:
+            self.verify_status_label.config(text=f"OTP sent for User ID: {user_id}")
             messagebox.showinfo("OTP Sent", f"OTP sent to WhatsApp for User ID: {user_id}")
         else:
+            self.verify_status_label.config(text="Failed to send OTP")
             messagebox.showerror("OTP Failed", "Failed to send OTP. Ensure WhatsApp Web is open and phone number is correct.")
         
     def verify_user(self):
         user_id = self.verify_user_id_entry.get()
         entered_otp = self.verify_otp_entry.get()
         
-        if not user_id or not entered_otp or not self.verify_image_path:
+        if not user_id or not entered_otp or not (self.verify_image_path or self.verify_stream_source):
             messagebox.showerror("Error", "Please fill all verification fields and select an image.")
             return
             
-        # Verify OTP first
-        if not self.otp_handler.verify_otp(user_id, entered_otp):
+        # Check the OTP first; it is consumed only after the fingerprint matches, so a
+        # rejected capture or a mismatch can be retried with the same OTP
+        if not self.otp_handler.verify_otp(user_id, entered_otp, consume=False):
             messagebox.showerror("Error", "Invalid or expired OTP.")
             self.verify_status_label.config(text="Verification failed: Invalid OTP")
             return
             
         # Verify fingerprint
-        fingerprint_match = self.fp_processor.verify_fingerprint(user_id, self.verify_image_path)
+        if self.verify_stream_source:
+            fingerprint_match = self.fp_processor.verify_stream(
+                user_id, self.verify_stream_source,
+                accept_frames=FINGERPRINT_SETTINGS['stream_accept_frames'],
+                reject_frames=FINGERPRINT_SETTINGS['stream_reject_frames'],
+                max_frames=FINGERPRINT_SETTINGS['stream_max_frames']).is_match
+        else:
+            fingerprint_match = self.fp_processor.verify_fingerprint(user_id, self.verify_image_path)
         
-        if fingerprint_match:
+        if fingerprint_match and not self.otp_handler.verify_otp(user_id, entered_otp):
+            messagebox.showerror("Error", "Invalid or expired OTP.")
+            self.verify_status_label.config(text="Verification failed: Invalid OTP")
+        elif fingerprint_match:
             messagebox.showinfo("Success", "Fingerprint and OTP verification successful!")
             self.verify_status_label.config(text="Verification successful!")
+        elif self.fp_processor.last_quality is not None and not self.fp_processor.last_quality.passed:
+            messagebox.showerror("Error", f"Fingerprint capture rejected{self.quality_hint()}. Please scan again.")
+            self.verify_status_label.config(text="Verification failed: Poor capture quality")
         else:
             messagebox.showerror("Error", "Fingerprint verification failed.")
             self.verify_status_label.config(text="Verification failed: Fingerprint mismatch")
+
+    def quality_hint(self):
+        # Reason code of the quality gate for the last image, if it rejected it
+        quality = self.fp_processor.last_quality
+        if quality is None or quality.passed:
+            return ""
+        return f" ({quality.reason.replace('_', ' ')})"
             
     def run(self):
-        self.root.mainloop()
+        try:
+            self.root.mainloop()
+        finally:
+            self.fp_processor.user_registry.flush()  # Last-seen times buffered by verifications
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     root = tk.Tk()
     app = FingerprintOTPSystem(root)
     app.run() 
\ No newline at end of file
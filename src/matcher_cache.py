@@ -0,0 +1,296 @@
+import time
+import threading
+from collections import OrderedDict
+import cv2
+import numpy as np
+
+FLANN_INDEX_KDTREE = 1
+DEFAULT_INDEX_PARAMS = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
+DEFAULT_SEARCH_PARAMS = dict(checks=50)
+FLANN_INDEX_LSH = 6
+LSH_INDEX_PARAMS = dict(algorithm=FLANN_INDEX_LSH, table_number=6, key_size=12, multi_probe_level=1)
+
+# Matcher backends:
+#   flann  FLANN index (KD-trees for L2, LSH for Hamming) trained on the template
+#   brute  exact search with distance-matrix products (BruteForceIndex)
+#   auto   brute for templates of at most BRUTE_FORCE_MAX_ROWS[norm] descriptors, flann above
+MATCHER_BACKENDS = ('auto', 'brute', 'flann')
+# Crossover measured with python src/benchmark.py --matchers (probe as large as the
+# template): below it the exact product beats even a cached KD-tree index. LSH over
+# packed binary descriptors is cheaper than unpacking them at every size.
+BRUTE_FORCE_MAX_ROWS = {'l2': 2500, 'hamming': 0}
+# Distance-matrix entries computed at once (16 MB of float32), bounds the memory of a search
+BLOCK_ELEMENTS = 1 << 22
+
+
+class TrainedIndex:
+    """FLANN index trained on one template, queried straight into NumPy arrays
+
+    Unlike FlannBasedMatcher.knnMatch, knn() returns distance and index
+    arrays directly, so no per-match DMatch objects are created.
+    """
+
+    def __init__(self, template, index_params, search_params, norm='l2'):
+        self.norm = norm
+        dtype = np.uint8 if norm == 'hamming' else np.float32
+        # FLANN keeps a pointer to the training data, so hold on to it
+        self.template = np.ascontiguousarray(template, dtype=dtype)
+        self.search_params = search_params
+        self.index = cv2.flann_Index(self.template, index_params)
+
+    def knn(self, queries, k=2):
+        """Return (distances, indices) shaped (len(queries), k)
+
+        Missing neighbours (possible with LSH) have distance inf and index -1.
+        """
+        dtype = np.uint8 if self.norm == 'hamming' else np.float32
+        queries = np.ascontiguousarray(queries, dtype=dtype)
+        found = min(k, len(self.template))
+        indices, distances = self.index.knnSearch(queries, found, params=self.search_params)
+        distances = distances.astype(np.float32, copy=False).reshape(len(queries), found)
+        indices = indices.reshape(len(queries), found)
+        if self.norm != 'hamming':
+            # The KD-tree reports squared L2 distances
+            distances = np.sqrt(np.maximum(distances, 0))
+        if found < k:
+            distances = np.pad(distances, ((0, 0), (0, k - found)), constant_values=np.inf)
+            indices = np.pad(indices, ((0, 0), (0, k - found)), constant_values=-1)
+        missing = indices < 0
+        if missing.any():
+            distances[missing] = np.inf
+        return distances, indices
+
+
+class BruteForceIndex:
+    """Exact kNN over one template with blocked distance-matrix products
+
+    Squared L2 distances come from ||a||^2 + ||b||^2 - 2ab, where ab is a
+    single float32 matrix product (BLAS, vectorized), and the k nearest are
+    picked with argpartition instead of a full sort. Packed binary
+    descriptors are unpacked to +-1 vectors, whose squared L2 distance is
+    four times the Hamming distance, so both norms share the product.
+    There is nothing to train, which is what makes it faster than FLANN for
+    templates of a few hundred descriptors. knn() returns the same arrays
+    as TrainedIndex.knn.
+    """
+
+    def __init__(self, template, norm='l2'):
+        self.norm = norm
+        self.template = template
+        self.vectors = _product_view(template, norm)
+        self.squared_norms = np.einsum('ij,ij->i', self.vectors, self.vectors)
+
+    @property
+    def nbytes(self):
+        return self.vectors.nbytes + self.squared_norms.nbytes
+
+    def knn(self, queries, k=2):
+        """Return (distances, indices) shaped (len(queries), k)"""
+        queries = _product_view(queries, self.norm)
+        query_norms = np.einsum('ij,ij->i', queries, queries)
+        distances = np.empty((len(queries), k), dtype=np.float32)
+        indices = np.empty((len(queries), k), dtype=np.int64)
+        step = max(1, BLOCK_ELEMENTS // max(1, len(self.vectors)))
+        for start in range(0, len(queries), step):
+            block = slice(start, start + step)
+            squared = _squared_distances(queries[block], query_norms[block], self.vectors, self.squared_norms)
+            distances[block], indices[block] = _nearest(squared, k)
+        return _to_norm(distances, self.norm), indices
+
+
+def _product_view(descriptors, norm):
+    # float32 vectors whose squared L2 distances give the matcher's distances
+    if norm == 'hamming':
+        bits = np.unpackbits(np.asarray(descriptors, dtype=np.uint8), axis=1)
+        return bits.astype(np.float32) * 2 - 1
+    return np.ascontiguousarray(descriptors, dtype=np.float32)
+
+
+def _squared_distances(queries, query_norms, vectors, squared_norms):
+    squared = queries @ vectors.T
+    squared *= -2
+    squared += query_norms[:, None]
+    squared += squared_norms[None, :]
+    # Rounding can leave tiny negatives for (near) identical descriptors
+    return np.maximum(squared, 0, out=squared)
+
+
+def _nearest(squared, k):
+    """k smallest entries of every row, sorted, as (values, columns); missing neighbours are inf/-1"""
+    rows, columns = squared.shape
+    found = min(k, columns)
+    distances = np.full((rows, k), np.inf, dtype=np.float32)
+    indices = np.full((rows, k), -1, dtype=np.int64)
+    if found == 0:
+        return distances, indices
+    if found == 1:
+        # A single neighbour (the mutual check): argmin is cheaper than argpartition
+        nearest = squared.argmin(axis=1)[:, None]
+    elif found < columns:
+        nearest = np.argpartition(squared, found - 1, axis=1)[:, :found]
+    else:
+        nearest = np.broadcast_to(np.arange(columns), (rows, columns))
+    values = np.take_along_axis(squared, nearest, axis=1)
+    order = np.argsort(values, axis=1, kind='stable')
+    distances[:, :found] = np.take_along_axis(values, order, axis=1)
+    indices[:, :found] = np.take_along_axis(nearest, order, axis=1)
+    return distances, indices
+
+
+def _to_norm(squared, norm):
+    if norm == 'hamming':
+        return np.rint(squared / 4)
+    return np.sqrt(squared, out=squared)
+
+
+def choose_backend(rows, backend='auto', norm='l2', brute_force_max_rows=None):
+    """Backend ('brute' or 'flann') that matches a template of this many descriptors"""
+    if backend not in MATCHER_BACKENDS:
+        raise ValueError(f"Unknown matcher backend {backend!r}, expected one of {list(MATCHER_BACKENDS)}")
+    if backend == 'auto':
+        if brute_force_max_rows is None:
+            brute_force_max_rows = BRUTE_FORCE_MAX_ROWS[norm]
+        return 'brute' if rows <= brute_force_max_rows else 'flann'
+    return backend
+
+
+def build_matcher(template, index_params=None, search_params=None, norm='l2', backend='flann',
+                  brute_force_max_rows=None):
+    """Create a matcher whose index is trained on the given template
+
+    With the flann backend, norm='l2' builds a FLANN KD-tree index over
+    float32 descriptors, norm='hamming' a FLANN LSH index over packed
+    binary ones. backend='brute' gives a BruteForceIndex, backend='auto'
+    picks by template size (see choose_backend).
+    """
+    if choose_backend(len(template), backend, norm, brute_force_max_rows) == 'brute':
+        return BruteForceIndex(template, norm)
+    if norm == 'hamming':
+        index_params = LSH_INDEX_PARAMS
+    return TrainedIndex(template, index_params or DEFAULT_INDEX_PARAMS,
+                        search_params or DEFAULT_SEARCH_PARAMS, norm)
+
+
+class MatcherCache:
+    """LRU cache of trained FLANN indexes keyed by user_id.
+
+    Building the KD-trees dominates the cost of matching against a stored
+    template, so keeping the trained matcher around means repeat
+    verifications of the same user only pay for the query. The cache is
+    bounded by an estimate of the memory held by the cached indexes.
+    Templates the backend matches by brute force (see choose_backend) are
+    cached as their float32 product view and squared norms.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, index_params=None, search_params=None, norm='l2',
+                 backend='flann', brute_force_max_rows=None):
+        choose_backend(0, backend)  # Validates the name
+        self.max_bytes = max_bytes
+        self.norm = norm
+        self.backend = backend
+        self.brute_force_max_rows = brute_force_max_rows
+        self.index_params = index_params or DEFAULT_INDEX_PARAMS
+        self.search_params = search_params or DEFAULT_SEARCH_PARAMS
+        self._entries = OrderedDict()  # user_id -> (matcher, estimated bytes)
+        self._lock = threading.Lock()
+        # Bumped on invalidation so a build racing with re-enrollment is not cached
+        self._generation = 0
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.builds = 0
+        self.build_seconds = 0.0
+
+    def estimate_bytes(self, template):
+        """Approximate memory of a trained index: the float32 copy plus the KD-trees"""
+        if choose_backend(len(template), self.backend, self.norm, self.brute_force_max_rows) == 'brute':
+            columns = template.shape[1] * 8 if self.norm == 'hamming' else template.shape[1]
+            return template.shape[0] * (columns + 1) * 4
+        if self.norm == 'hamming':
+            # LSH tables hold one bucket entry per descriptor per table
+            return template.nbytes + template.shape[0] * LSH_INDEX_PARAMS['table_number'] * 8
+        rows = template.shape[0]
+        trees = self.index_params.get('trees', 1)
+        return rows * template.shape[1] * 4 + rows * trees * 16
+
+    def get(self, user_id, template):
+        """Return a trained matcher for user_id, building it on a miss"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            generation = self._generation
+        return self._build(user_id, template, generation)
+
+    def _build(self, user_id, template, generation):
+        start = time.perf_counter()
+        matcher = build_matcher(template, self.index_params, self.search_params, self.norm, self.backend,
+                                self.brute_force_max_rows)
+        elapsed = time.perf_counter() - start
+
+        size = self.estimate_bytes(template)
+        with self._lock:
+            self.builds += 1
+            self.build_seconds += elapsed
+            if size <= self.max_bytes and generation == self._generation:
+                self._insert(user_id, matcher, size)
+        return matcher
+
+    def _insert(self, user_id, matcher, size):
+        previous = self._entries.pop(user_id, None)
+        if previous is not None:
+            self.current_bytes -= previous[1]
+        while self._entries and self.current_bytes + size > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.current_bytes -= evicted_size
+            self.evictions += 1
+        self._entries[user_id] = (matcher, size)
+        self.current_bytes += size
+
+    def invalidate(self, user_id):
+        """Drop the cached matcher for user_id (e.g. after re-enrollment)"""
+        with self._lock:
+            self._generation += 1
+            entry = self._entries.pop(user_id, None)
+            if entry is not None:
+                self.current_bytes -= entry[1]
+
+    def clear(self):
+        """Drop every cached matcher"""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def warm(self, templates):
+        """Pre-build matchers for {user_id: template} until the memory budget is used"""
+        warmed = 0
+        for user_id, template in templates.items():
+            if template is None or template.shape[0] < 2:
+                continue
+            size = self.estimate_bytes(template)
+            if self.current_bytes + size > self.max_bytes:
+                break
+            self._build(user_id, template, self._generation)
+            warmed += 1
+        return warmed
+
+    def stats(self):
+        """Counters for sizing the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'current_bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'builds': self.builds,
+                'build_seconds': self.build_seconds,
+            }
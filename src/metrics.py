@@ -0,0 +1,234 @@
+import bisect
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Default histogram bucket upper bounds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SCORE_BUCKETS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+COUNT_BUCKETS = (0, 10, 50, 100, 250, 500, 1000, 2000, 5000)
+PERCENTILES = (50, 90, 99)
+
+
+class Counter:
+    """Monotonic count; with function= the value is read from it at export time"""
+    kind = 'counter'
+
+    def __init__(self, function=None):
+        self.function = function
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self.function() if self.function is not None else self._value
+
+
+class Gauge(Counter):
+    """Value that goes up and down (queue depth, cache bytes...)"""
+    kind = 'gauge'
+
+    def set(self, value):
+        with self._lock:
+            self._value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class Histogram:
+    """Bucketed distribution with sum, count and max"""
+    kind = 'histogram'
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)  # Last slot is +Inf
+        self._sum = 0.0
+        self._count = 0
+        self._max = None
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        slot = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[slot] += 1
+            self._sum += value
+            self._count += 1
+            if self._max is None or value > self._max:
+                self._max = value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def state(self):
+        """(bucket counts, sum, count, max), read consistently"""
+        with self._lock:
+            return list(self._counts), self._sum, self._count, self._max
+
+    def percentile(self, p, counts=None, count=None):
+        """Estimate of the p-th percentile, interpolated inside the bucket that holds it"""
+        if counts is None:
+            counts, _, count, _ = self.state()
+        if not count:
+            return None
+        rank = count * p / 100
+        seen, lower = 0, 0.0
+        for upper, bucket_count in zip(self.buckets + (math.inf,), counts):
+            if bucket_count and seen + bucket_count >= rank:
+                if math.isinf(upper):
+                    return lower  # Beyond the last bucket, the bound is all we know
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+            lower = upper
+        return lower
+
+
+class StageMetrics:
+    """Adapter with the stage timer interface of FingerprintProcessor (time(stage) and record(stage, seconds)).
+
+    Every stage becomes a label value of one histogram family.
+    """
+
+    def __init__(self, registry, name, help='', label='stage', buckets=LATENCY_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self._histograms = {}
+
+    def histogram(self, stage):
+        histogram = self._histograms.get(stage)
+        if histogram is None:
+            histogram = self.registry.histogram(self.name, self.help, self.buckets, **{self.label: stage})
+            self._histograms[stage] = histogram
+        return histogram
+
+    def time(self, stage):
+        return self.histogram(stage).time()
+
+    def record(self, stage, seconds):
+        self.histogram(stage).observe(seconds)
+
+
+class MetricsRegistry:
+    """Named counters, gauges and histograms with Prometheus text and JSON export.
+
+    Metrics are created on first use and identified by name plus labels
+    (keyword arguments); asking again returns the same object, so hot paths
+    should keep a reference instead of looking metrics up per call.
+    """
+
+    def __init__(self):
+        self._families = {}  # name -> {'kind', 'help', 'metrics': {labels: metric}}
+        self._lock = threading.Lock()
+
+    def _get(self, factory, name, help, labels, **kwargs):
+        key = tuple(sorted((str(k), str(v)) for k, v in labels.items()))
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = {'kind': factory.kind, 'help': help, 'metrics': {}}
+            elif family['kind'] != factory.kind:
+                raise ValueError(f"Metric {name} is a {family['kind']}, not a {factory.kind}")
+            metric = family['metrics'].get(key)
+            if metric is None:
+                metric = family['metrics'][key] = factory(**kwargs)
+            elif kwargs.get('function') is not None:
+                metric.function = kwargs['function']  # Re-registered callbacks replace the old source
+            return metric
+
+    def counter(self, name, help='', function=None, **labels):
+        return self._get(Counter, name, help, labels, function=function)
+
+    def gauge(self, name, help='', function=None, **labels):
+        return self._get(Gauge, name, help, labels, function=function)
+
+    def histogram(self, name, help='', buckets=LATENCY_BUCKETS, **labels):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def stage_timer(self, name, help='', label='stage', buckets=LATENCY_BUCKETS):
+        """StageMetrics writing to the histogram family name, one label value per stage"""
+        return StageMetrics(self, name, help, label, buckets)
+
+    def _collect(self):
+        with self._lock:
+            return [(name, family['kind'], family['help'], list(family['metrics'].items()))
+                    for name, family in sorted(self._families.items())]
+
+    def snapshot(self):
+        """JSON-serializable view of every metric; histograms include estimated percentiles"""
+        snapshot = {'timestamp': time.time(), 'metrics': {}}
+        for name, kind, help, metrics in self._collect():
+            samples = []
+            for labels, metric in metrics:
+                sample = {'labels': dict(labels)}
+                if kind == 'histogram':
+                    counts, total, count, maximum = metric.state()
+                    sample.update({'count': count, 'sum': total, 'max': maximum,
+                                   'mean': total / count if count else None,
+                                   'buckets': dict(zip([str(b) for b in metric.buckets] + ['+Inf'], counts))})
+                    for p in PERCENTILES:
+                        sample[f'p{p}'] = metric.percentile(p, counts, count)
+                else:
+                    sample['value'] = _safe_value(metric)
+                samples.append(sample)
+            snapshot['metrics'][name] = {'type': kind, 'help': help, 'samples': samples}
+        return snapshot
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=4)
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            f.write(self.to_json())
+
+    def to_prometheus(self):
+        """Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+        for name, kind, help, metrics in self._collect():
+            if help:
+                lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in metrics:
+                if kind == 'histogram':
+                    counts, total, count, _ = metric.state()
+                    cumulative = 0
+                    for upper, bucket_count in zip(metric.buckets + (math.inf,), counts):
+                        cumulative += bucket_count
+                        le = '+Inf' if math.isinf(upper) else repr(float(upper))
+                        lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(labels)} {total!r}")
+                    lines.append(f"{name}_count{_labels(labels)} {count}")
+                else:
+                    value = _safe_value(metric)
+                    if value is not None:
+                        lines.append(f"{name}{_labels(labels)} {float(value)!r}")
+        return '\n'.join(lines) + '\n'
+
+
+def _safe_value(metric):
+    # A failing callback must not break the whole export
+    try:
+        return metric.value
+    except Exception:
+        return None
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (key + '="' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+               for key, value in labels)
+    return '{' + ','.join(escaped) + '}'
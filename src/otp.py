@@ -1,65 +1,96 @@
-import random
+import secrets
 import string
-from datetime import datetime, timedelta
-import pywhatkit as kit
 import os
-import json
+import logging
+from contextlib import nullcontext
+from otp_delivery import DeliveryError, DeliveryQueue, WhatsAppTransport, SMTPTransport, FileTransport
+from otp_store import OTPStore
+
+logger = logging.getLogger('otp')
 
 class OTPHandler:
-    def __init__(self, data_dir='data'):
+    def __init__(self, data_dir='data', email_config=None, delivery_queue=None,
+                 expiry_minutes=5, max_pending_otps=100000):
         self.data_dir = data_dir
-        self.otp_db = {}
+        # Expiring, size-capped OTP storage; OTPs are single use
+        self.otp_store = OTPStore(ttl_seconds=expiry_minutes * 60, capacity=max_pending_otps)
+        # OTPs are sent in the background; the loopback 'file' transport writes to data/otp_outbox.txt
+        if delivery_queue is None:
+            transports = [WhatsAppTransport(), FileTransport(os.path.join(data_dir, 'otp_outbox.txt'))]
+            if email_config:
+                transports.append(SMTPTransport(email_config))
+            delivery_queue = DeliveryQueue(transports)
+        self.delivery_queue = delivery_queue
+        self._operation_timer = None  # metrics.StageMetrics labelled by operation, set by instrument()
+
+    def instrument(self, metrics):
+        """Report OTP issue/verify latency, the OTP store and delivery to a metrics.MetricsRegistry"""
+        self._operation_timer = metrics.stage_timer('otp_operation_seconds', 'Duration of OTP operations',
+                                                    label='operation')
+        store = self.otp_store
+        metrics.gauge('otp_store_size', 'OTPs waiting to be verified', function=lambda: len(store))
+        for key in ('issued', 'verified', 'rejected', 'expired', 'evicted'):
+            metrics.counter(f'otp_{key}_total', f'OTPs {key}', function=lambda key=key: store.stats()[key])
+        self.delivery_queue.instrument(metrics)
+
+    def _timer(self, operation):
+        if self._operation_timer is None:
+            return nullcontext()
+        return self._operation_timer.time(operation)
         
     def generate_otp(self):
-        """Generate a random 6-digit OTP"""
-        return ''.join(random.choices(string.digits, k=6))
+        """Generate a random 6-digit OTP from the OS CSPRNG (random is predictable from its outputs)"""
+        return ''.join(secrets.choice(string.digits) for _ in range(6))
         
+    def format_message(self, otp):
+        """Text of the OTP message"""
+        minutes = round(self.otp_store.ttl_seconds / 60)
+        return f"Your OTP for fingerprint verification is: {otp}. Valid for {minutes} minutes."
+
     def send_otp_whatsapp(self, phone_number, otp):
-        """Send OTP via WhatsApp"""
+        """Send OTP via WhatsApp (blocks for the whole browser round trip, create_otp queues instead)"""
         try:
-            # Remove any spaces or special characters from phone number
-            phone_number = phone_number.replace('+', '').replace(' ', '')
-            
-            # Send WhatsApp message
-            kit.sendwhatmsg_instantly(
-                phone_no=f"+{phone_number}",
-                message=f"Your OTP for fingerprint verification is: {otp}. Valid for 5 minutes.",
-                wait_time=10
-            )
+            WhatsAppTransport().send(phone_number, self.format_message(otp))
             return True
         except Exception as e:
-            print(f"Error sending WhatsApp message: {e}")
+            logger.error("Error sending WhatsApp message: %s", e)
             return False
             
-    def create_otp(self, user_id, phone=None):
-        """Create and send OTP to user via WhatsApp"""
-        otp = self.generate_otp()
-        expiry = datetime.now() + timedelta(minutes=5)
-        
-        # Store OTP
-        self.otp_db[user_id] = {
-            'otp': otp,
-            'expiry': expiry.isoformat()
-        }
-        
-        # Send OTP via WhatsApp
-        success = False
-        if phone:
-            if self.send_otp_whatsapp(phone, otp):
-                success = True
-                
-        return success
-        
-    def verify_otp(self, user_id, entered_otp):
-        """Verify the entered OTP"""
-        if user_id not in self.otp_db:
-            return False
-            
-        stored_data = self.otp_db[user_id]
-        expiry = datetime.fromisoformat(stored_data['expiry'])
+    def create_otp(self, user_id, phone=None, email=None, transport=None, callback=None):
+        """Create an OTP and queue it for delivery (WhatsApp to phone, or e-mail)
+
+        Returns immediately with a Future resolving to a DeliveryStatus, or
+        None if there is nowhere to send the OTP. callback, if given, is called
+        with the DeliveryStatus from a delivery thread. No OTP is issued unless
+        it could be queued: an unknown transport raises ValueError, a full or
+        shut down queue raises DeliveryError.
+        """
+        # Queue the OTP for delivery, WhatsApp unless another transport is requested
+        if transport is None:
+            transport = 'whatsapp' if phone else 'email'
+        recipient = email if transport == 'email' else phone
+        if not recipient:
+            return None
+        self.delivery_queue.check_transport(transport)
+
+        with self._timer('issue'):
+            otp = self.generate_otp()
+
+            # Store OTP
+            self.otp_store.issue(user_id, otp)
+        try:
+            return self.delivery_queue.submit(transport, recipient, self.format_message(otp), callback=callback)
+        except DeliveryError:
+            self.otp_store.revoke(user_id)
+            raise
         
-        if datetime.now() > expiry:
-            del self.otp_db[user_id]
-            return False
-            
-        return stored_data['otp'] == entered_otp 
\ No newline at end of file
+    def verify_otp(self, user_id, entered_otp, consume=True):
+        """Verify the entered OTP (expired OTPs are rejected)
+
+        A valid OTP is consumed unless consume is False: callers that still
+        have to match a fingerprint check it first and consume it only once
+        the match succeeds, so a rejected capture can be retried.
+        """
+        with self._timer('verify'):
+            return self.otp_store.verify(user_id, entered_otp, consume=consume)
+ 
\ No newline at end of file
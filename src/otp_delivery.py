@@ -0,0 +1,298 @@
+import heapq
+import itertools
+import logging
+import os
+import random
+import smtplib
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import Future
+from contextlib import nullcontext
+from datetime import datetime
+from email.message import EmailMessage
+
+# Outcome of one queued message, the result of the Future returned by DeliveryQueue.submit
+DeliveryStatus = namedtuple('DeliveryStatus', ['delivered', 'transport', 'recipient', 'attempts', 'error'])
+
+logger = logging.getLogger('otp_delivery')
+
+
+class DeliveryError(Exception):
+    """Raised by a transport when a message could not be sent"""
+
+
+class QueueFullError(DeliveryError):
+    """Raised by DeliveryQueue.submit when too many messages are pending"""
+
+
+class Transport:
+    """Base class for OTP transports.
+
+    send() blocks until the message is handed off and raises on failure;
+    the DeliveryQueue takes care of threading and retries. max_concurrency
+    limits how many sends of this transport run at once.
+    """
+    name = 'transport'
+    max_concurrency = 8
+
+    def send(self, recipient, message):
+        raise NotImplementedError
+
+
+class WhatsAppTransport(Transport):
+    """Sends through WhatsApp Web with pywhatkit (drives a browser, one message at a time)"""
+    name = 'whatsapp'
+    max_concurrency = 1
+
+    def __init__(self, wait_time=10):
+        self.wait_time = wait_time
+
+    def send(self, recipient, message):
+        import pywhatkit as kit  # Imported lazily, it opens a connection check on import
+
+        # Remove any spaces or special characters from phone number
+        phone_number = recipient.replace('+', '').replace(' ', '')
+        kit.sendwhatmsg_instantly(
+            phone_no=f"+{phone_number}",
+            message=message,
+            wait_time=self.wait_time
+        )
+
+
+class SMTPTransport(Transport):
+    """Sends e-mail using the EMAIL_CONFIG settings (smtp_server, smtp_port, sender_email, sender_password)"""
+    name = 'email'
+    max_concurrency = 4
+
+    def __init__(self, email_config, subject="Your fingerprint verification OTP", timeout=30):
+        self.email_config = email_config
+        self.subject = subject
+        self.timeout = timeout
+
+    def send(self, recipient, message):
+        config = self.email_config
+        if not config.get('sender_email') or not config.get('sender_password'):
+            raise DeliveryError("E-mail sender is not configured in EMAIL_CONFIG")
+
+        email = EmailMessage()
+        email['From'] = config['sender_email']
+        email['To'] = recipient
+        email['Subject'] = self.subject
+        email.set_content(message)
+
+        with smtplib.SMTP(config['smtp_server'], config['smtp_port'], timeout=self.timeout) as server:
+            server.starttls()
+            server.login(config['sender_email'], config['sender_password'])
+            server.send_message(email)
+
+
+class FileTransport(Transport):
+    """Loopback transport that appends messages to a local file, for testing and offline use"""
+    name = 'file'
+    max_concurrency = 64
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.sent = []  # (recipient, message) pairs, handy in tests
+
+    def send(self, recipient, message):
+        now = datetime.now()
+        entry = (f"Date: {now.day}/{now.month}/{now.year}\n"
+                 f"Time: {now.hour}:{now.minute}\n"
+                 f"Recipient: {recipient}\n"
+                 f"Message: {message}\n"
+                 f"--------------------\n")
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(entry)
+            self.sent.append((recipient, message))
+
+
+class _Job:
+    __slots__ = ('transport', 'recipient', 'message', 'future', 'attempts', 'last_error')
+
+    def __init__(self, transport, recipient, message, future):
+        self.transport = transport
+        self.recipient = recipient
+        self.message = message
+        self.future = future
+        self.attempts = 0
+        self.last_error = None
+
+
+class DeliveryQueue:
+    """Background OTP delivery: worker threads, per-transport concurrency and retry with backoff.
+
+    submit() returns immediately with a Future that resolves to a
+    DeliveryStatus once the message is delivered or all attempts failed.
+    Jobs waiting for a retry sit in a time-ordered heap, due jobs in a FIFO
+    queue per transport; workers take the oldest due job whose transport
+    has a free slot and sleep on a condition otherwise, so a busy transport
+    (e.g. the single WhatsApp browser) neither holds a worker thread nor
+    reorders its messages.
+    """
+
+    def __init__(self, transports, workers=8, max_attempts=3, backoff=1.0, max_backoff=30.0,
+                 max_pending=10000):
+        self.transports = {transport.name: transport for transport in transports}
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_pending = max_pending
+        self._ready = {name: deque() for name in self.transports}  # (sequence, job) due for sending
+        self._active = {name: 0 for name in self.transports}  # sends in flight per transport
+        self._heap = []  # (ready_at, sequence, job) waiting for a retry
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._pending = 0
+        self.delivered = 0
+        self.failed = 0
+        self.retries = 0
+        self._send_timer = None  # metrics.StageMetrics labelled by transport, set by instrument()
+        self._threads = [threading.Thread(target=self._worker, name=f'otp-delivery-{i}', daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def check_transport(self, transport_name):
+        """Raise ValueError unless transport_name is one of the configured transports"""
+        if transport_name not in self.transports:
+            raise ValueError(f"Unknown transport {transport_name!r}, expected one of {list(self.transports)}")
+
+    def submit(self, transport_name, recipient, message, callback=None):
+        """Queue a message; callback(DeliveryStatus) is called from a worker thread when done"""
+        self.check_transport(transport_name)
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(lambda f: callback(f.result()))
+        job = _Job(transport_name, recipient, message, future)
+        with self._cond:
+            if self._closed:
+                raise DeliveryError("Delivery queue is shut down")
+            if self._pending >= self.max_pending:
+                raise QueueFullError(f"{self._pending} OTP messages already pending")
+            self._pending += 1
+            self._schedule(job, time.monotonic())
+        return future
+
+    def instrument(self, metrics):
+        """Report send latency per transport and the queue state to a metrics.MetricsRegistry"""
+        self._send_timer = metrics.stage_timer('otp_send_seconds', 'Duration of one OTP send attempt',
+                                               label='transport')
+        metrics.gauge('otp_delivery_pending', 'OTP messages queued, in flight or waiting for a retry',
+                      function=self.pending)
+        for key in ('delivered', 'failed', 'retries'):
+            metrics.counter(f'otp_delivery_{key}_total', f'OTP messages {key}',
+                            function=lambda key=key: self.stats()[key])
+
+    def _schedule(self, job, ready_at):
+        if ready_at <= time.monotonic():
+            self._ready[job.transport].append((next(self._sequence), job))
+        else:
+            heapq.heappush(self._heap, (ready_at, next(self._sequence), job))
+        self._cond.notify()
+
+    def _next_job(self):
+        """Wait for a due job whose transport has a free slot and take that slot"""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._heap and self._heap[0][0] <= now:
+                    _, sequence, job = heapq.heappop(self._heap)
+                    self._ready[job.transport].append((sequence, job))
+
+                oldest = None
+                for name, ready in self._ready.items():
+                    if ready and self._active[name] < self.transports[name].max_concurrency:
+                        if oldest is None or ready[0][0] < self._ready[oldest][0][0]:
+                            oldest = name
+                if oldest is not None:
+                    self._active[oldest] += 1
+                    if self._heap:
+                        self._cond.notify()  # Hand the wait for the next retry to another worker
+                    return self._ready[oldest].popleft()[1]
+
+                if self._closed and not self._heap and not any(self._ready.values()):
+                    return None
+                # Woken by a new job or a freed slot, or when the next retry is due
+                self._cond.wait(self._heap[0][0] - now if self._heap else None)
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            try:
+                job.attempts += 1
+                with self._send_timer.time(job.transport) if self._send_timer is not None else nullcontext():
+                    self.transports[job.transport].send(job.recipient, job.message)
+            except Exception as e:
+                job.last_error = f"{type(e).__name__}: {e}"
+                self._retry_or_fail(job)
+            else:
+                self._finish(job, True)
+            finally:
+                with self._cond:
+                    self._active[job.transport] -= 1
+                    self._cond.notify()
+
+    def _retry_or_fail(self, job):
+        if job.attempts >= self.max_attempts:
+            logger.error("Error sending OTP via %s after %s attempts: %s",
+                         job.transport, job.attempts, job.last_error)
+            self._finish(job, False)
+            return
+        delay = min(self.max_backoff, self.backoff * 2 ** (job.attempts - 1))
+        delay *= 1 + random.uniform(0, 0.1)  # Jitter so retries do not arrive in lockstep
+        with self._cond:
+            self.retries += 1
+            self._schedule(job, time.monotonic() + delay)
+
+    def _finish(self, job, delivered):
+        with self._cond:
+            self._pending -= 1
+            if delivered:
+                self.delivered += 1
+            else:
+                self.failed += 1
+            self._cond.notify_all()
+        job.future.set_result(DeliveryStatus(delivered, job.transport, job.recipient,
+                                             job.attempts, None if delivered else job.last_error))
+
+    def pending(self):
+        """Number of messages queued, in flight or waiting for a retry"""
+        with self._cond:
+            return self._pending
+
+    def stats(self):
+        with self._cond:
+            return {'pending': self._pending, 'delivered': self.delivered,
+                    'failed': self.failed, 'retries': self.retries}
+
+    def join(self, timeout=None):
+        """Wait until every submitted message has been delivered or failed"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def shutdown(self, wait=True):
+        """Stop accepting messages; with wait=True deliver what is queued first"""
+        if wait:
+            self.join()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
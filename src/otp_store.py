@@ -0,0 +1,97 @@
+import hmac
+import threading
+import time
+from collections import OrderedDict
+
+
+class OTPStore:
+    """Bounded in-memory OTP store with monotonic-clock expiry.
+
+    Every OTP lives for the same ttl, so insertion order is also expiry
+    order: entries are kept in an OrderedDict (re-issuing moves a user to
+    the back) and expired ones are popped from the front on every
+    operation. That makes eviction amortized O(1) without a background
+    thread, and the capacity limit keeps memory flat even if users never
+    verify. A successful verification consumes the OTP unless the caller
+    only checks it (consume=False) and consumes it once the rest of the
+    authentication has succeeded.
+    """
+
+    def __init__(self, ttl_seconds=300, capacity=100000, clock=time.monotonic):
+        self.ttl_seconds = ttl_seconds
+        self.capacity = capacity
+        self.clock = clock
+        self._entries = OrderedDict()  # user_id -> (otp bytes, expires_at)
+        self._lock = threading.Lock()
+        self.issued = 0
+        self.verified = 0
+        self.rejected = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def __contains__(self, user_id):
+        with self._lock:
+            self._evict_expired(self.clock())
+            return user_id in self._entries
+
+    def issue(self, user_id, otp):
+        """Store otp for user_id (replacing any previous one) and return its expiry time"""
+        with self._lock:
+            now = self.clock()
+            self._evict_expired(now)
+            expires_at = now + self.ttl_seconds
+            self._entries.pop(user_id, None)
+            # At capacity the OTP closest to expiring makes room
+            while len(self._entries) >= self.capacity:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+            self._entries[user_id] = (str(otp).encode('utf-8'), expires_at)
+            self.issued += 1
+            return expires_at
+
+    def verify(self, user_id, entered_otp, consume=True):
+        """Check entered_otp for user_id in constant time, consuming it on success if consume is True"""
+        with self._lock:
+            self._evict_expired(self.clock())
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self.rejected += 1
+                return False
+            if not hmac.compare_digest(entry[0], str(entered_otp).encode('utf-8')):
+                self.rejected += 1
+                return False
+            if consume:
+                del self._entries[user_id]
+                self.verified += 1
+            return True
+
+    def revoke(self, user_id):
+        """Drop the OTP of user_id, if any"""
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def evict_expired(self):
+        """Remove all expired OTPs now and return how many were removed"""
+        with self._lock:
+            return self._evict_expired(self.clock())
+
+    def _evict_expired(self, now):
+        removed = 0
+        while self._entries:
+            user_id, (_, expires_at) = next(iter(self._entries.items()))
+            if expires_at > now:
+                break
+            del self._entries[user_id]
+            removed += 1
+        self.expired += removed
+        return removed
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'capacity': self.capacity, 'issued': self.issued,
+                    'verified': self.verified, 'rejected': self.rejected,
+                    'expired': self.expired, 'evicted': self.evicted}
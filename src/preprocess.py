@@ -0,0 +1,174 @@
+from contextlib import nullcontext
+import cv2
+import numpy as np
+
+# Preprocessing modes:
+#   full  CLAHE, Gaussian blur and an adaptive threshold at full resolution (original behaviour)
+#   fast  as full, but the threshold's local mean is computed on a downsampled copy
+PREPROCESS_MODES = ('full', 'fast')
+
+_NO_STAGE = nullcontext()
+
+
+def _no_stage(name):
+    return _NO_STAGE
+
+
+class PreprocessPipeline:
+    """Reusable grayscale -> resize -> CLAHE -> blur -> adaptive threshold pipeline.
+
+    OpenCV objects are created once, and every step, the foreground search
+    included, writes into buffers kept between calls (grown to the largest
+    image seen), so after the first image the pipeline allocates no image
+    buffers of its own. cv2.adaptiveThreshold (mode='full') still allocates
+    its local mean internally on every call; mode='fast' keeps that in a
+    buffer too. The image returned by a step is one of those buffers and is
+    overwritten by the next call: copy it to keep it.
+    Like the processor that owns it, a pipeline must not be shared between
+    threads.
+
+    mode='fast' replaces the 11x11 Gaussian-weighted local mean of
+    cv2.adaptiveThreshold with one computed at fast_scale resolution and
+    interpolated back; at 0.25 and below this amounts to per-tile means.
+    crop_roi=True crops each image to the bounding box of its textured
+    (fingerprint) blocks before CLAHE, so background does not cost
+    anything; keypoint positions are then relative to the crop, which the
+    matcher's scores do not depend on. With compare=True every call also
+    runs the original full-resolution path and stores the fraction of
+    equal output pixels in last_agreement.
+    """
+
+    def __init__(self, mode='full', crop_roi=False, compare=False, clip_limit=2.0, tile_grid_size=(8, 8),
+                 blur_size=5, block_size=11, offset=2, fast_scale=0.5, roi_block=16, roi_min_std=8.0,
+                 roi_margin=16):
+        if mode not in PREPROCESS_MODES:
+            raise ValueError(f"Unknown preprocess mode {mode!r}, expected one of {list(PREPROCESS_MODES)}")
+        self.mode = mode
+        self.crop_roi = crop_roi
+        self.compare = compare
+        self.blur_size = blur_size
+        self.block_size = block_size  # Neighbourhood of the adaptive threshold
+        self.offset = offset  # Subtracted from the local mean before thresholding
+        self.fast_scale = fast_scale
+        self.roi_block = roi_block  # Block size (pixels) of the foreground search
+        self.roi_min_std = roi_min_std  # Minimum block intensity std counted as ridges
+        self.roi_margin = roi_margin  # Pixels kept around the foreground box
+        self._clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_grid_size)
+        # Gaussian of the adaptive threshold (cv2 derives sigma from the block size the same way)
+        self._sigma = 0.3 * ((block_size - 1) * 0.5 - 1) + 0.8
+        self._buffers = {}
+        self.last_roi = None  # (x, y, width, height) of the last crop, None if the image was not cropped
+        self.last_agreement = None  # Fraction of pixels equal to the original path, with compare=True
+
+    def _buffer(self, name, shape, dtype=np.uint8):
+        """Contiguous (shape) array backed by a buffer reused across calls"""
+        size = int(np.prod(shape))
+        flat = self._buffers.get(name)
+        if flat is None or flat.size < size or flat.dtype != dtype:
+            flat = self._buffers[name] = np.empty(size, dtype=dtype)
+        return flat[:size].reshape(shape)
+
+    def grayscale(self, image):
+        if len(image.shape) == 3:
+            return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=self._buffer('gray', image.shape[:2]))
+        return image
+
+    def resize(self, image, longer_side):
+        """Shrink image so its longer side is at most longer_side
+
+        Smaller images are returned as they are: interpolating them up adds
+        no ridge detail, only smoothed keypoints that match worse.
+        """
+        height, width = image.shape[:2]
+        scale = longer_side / max(height, width)
+        if scale >= 1:
+            return image
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        # INTER_AREA avoids aliasing the ridge pattern when shrinking
+        return cv2.resize(image, size, dst=self._buffer('resized', (size[1], size[0])),
+                          interpolation=cv2.INTER_AREA)
+
+    def foreground_box(self, image):
+        """(x, y, width, height) around the blocks with ridge-like variance, or None if there are none"""
+        block = self.roi_block
+        rows, cols = image.shape[0] // block, image.shape[1] // block
+        if rows == 0 or cols == 0:
+            return None
+        # Block means of x and x^2 (INTER_AREA with an integer factor averages whole blocks)
+        values = self._buffer('roi_values', (rows * block, cols * block), np.float32)
+        np.copyto(values, image[:rows * block, :cols * block])
+        mean = cv2.resize(values, (cols, rows), dst=self._buffer('roi_mean', (rows, cols), np.float32),
+                          interpolation=cv2.INTER_AREA)
+        squares = cv2.multiply(values, values, dst=values)
+        variance = cv2.resize(squares, (cols, rows), dst=self._buffer('roi_variance', (rows, cols), np.float32),
+                              interpolation=cv2.INTER_AREA)
+        # E[x^2] - E[x]^2 compared with the squared threshold, instead of taking the std
+        cv2.subtract(variance, cv2.multiply(mean, mean, dst=mean), dst=variance)
+        textured = cv2.compare(variance, float(self.roi_min_std) ** 2, cv2.CMP_GT,
+                               dst=self._buffer('roi_textured', (rows, cols)))
+        block_x, block_y, block_cols, block_rows = cv2.boundingRect(textured)
+        if block_cols == 0:
+            return None
+        y0 = max(0, block_y * block - self.roi_margin)
+        x0 = max(0, block_x * block - self.roi_margin)
+        y1 = min(image.shape[0], (block_y + block_rows) * block + self.roi_margin)
+        x1 = min(image.shape[1], (block_x + block_cols) * block + self.roi_margin)
+        return x0, y0, x1 - x0, y1 - y0
+
+    def enhance(self, image, stage=_no_stage):
+        """CLAHE, blur and adaptive threshold of a grayscale image (cropped first with crop_roi)
+
+        stage(name) returns a context manager timing each step, e.g. FingerprintProcessor.stage.
+        """
+        self.last_roi = None
+        source = image
+        if self.crop_roi:
+            with stage('crop'):
+                box = self.foreground_box(image)
+            if box is not None and (box[2], box[3]) != (image.shape[1], image.shape[0]):
+                x, y, width, height = box
+                self.last_roi = box
+                image = image[y:y + height, x:x + width]  # A view, OpenCV reads it in place
+        shape = image.shape[:2]
+        with stage('clahe'):
+            enhanced = self._clahe.apply(image, dst=self._buffer('enhanced', shape))
+        with stage('blur'):
+            blurred = cv2.GaussianBlur(enhanced, (self.blur_size, self.blur_size), 0,
+                                       dst=self._buffer('blurred', shape))
+        thresh = self._buffer('thresh', shape)
+        with stage('threshold'):
+            if self.mode == 'fast':
+                self._fast_threshold(blurred, thresh)
+            else:
+                cv2.adaptiveThreshold(blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,
+                                      self.block_size, self.offset, dst=thresh)
+        if self.compare:
+            reference = reference_enhance(source, self)
+            if self.last_roi is not None:
+                x, y, width, height = self.last_roi
+                reference = reference[y:y + height, x:x + width]
+            self.last_agreement = float(np.mean(thresh == reference))
+        return thresh
+
+    def _fast_threshold(self, blurred, thresh):
+        # Local mean at reduced resolution: the Gaussian shrinks with the image, and
+        # ridge-scale detail is already in the comparison with the full image
+        height, width = blurred.shape
+        small_size = (max(1, round(width * self.fast_scale)), max(1, round(height * self.fast_scale)))
+        small = cv2.resize(blurred, small_size, dst=self._buffer('small', (small_size[1], small_size[0])),
+                           interpolation=cv2.INTER_AREA)
+        sigma = max(self._sigma * self.fast_scale, 0.3)
+        small_mean = cv2.GaussianBlur(small, (0, 0), sigma, dst=self._buffer('small_mean', small.shape))
+        mean = cv2.resize(small_mean, (width, height), dst=self._buffer('mean', blurred.shape),
+                          interpolation=cv2.INTER_LINEAR)
+        # 255 where pixel > mean - offset, like THRESH_BINARY (the subtraction saturates at 0)
+        cv2.subtract(mean, self.offset, dst=mean)
+        cv2.compare(blurred, mean, cv2.CMP_GT, dst=thresh)
+
+
+def reference_enhance(image, pipeline):
+    """The original allocation-per-step full-resolution path (no crop), for comparing outputs"""
+    enhanced = pipeline._clahe.apply(image)
+    blurred = cv2.GaussianBlur(enhanced, (pipeline.blur_size, pipeline.blur_size), 0)
+    return cv2.adaptiveThreshold(blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,
+                                 pipeline.block_size, pipeline.offset)
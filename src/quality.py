@@ -0,0 +1,98 @@
+from collections import namedtuple
+import cv2
+import numpy as np
+
+# Reason codes, in the order the checks run (cheapest and most common failures first)
+QUALITY_OK = 'ok'
+LOW_CONTRAST = 'low_contrast'          # blank or washed-out capture
+SMALL_FOREGROUND = 'small_foreground'  # partial finger, most of the image is background
+BLURRY = 'blurry'                      # smudged or out of focus, ridges are not resolved
+LOW_COHERENCE = 'low_coherence'        # no consistent ridge flow (noise, smears, latent residue)
+
+QualityReport = namedtuple('QualityReport', ['passed', 'reason', 'score', 'contrast', 'foreground',
+                                             'sharpness', 'coherence'])
+
+
+class QualityGate:
+    """Cheap fingerprint quality check run before feature extraction.
+
+    All measures are taken on a copy of the grayscale image shrunk to
+    analysis_size pixels on its longer side, split into block_size blocks:
+      contrast    spread between the 5th and 95th intensity percentiles (0..1)
+      foreground  fraction of blocks with ridge-like local variance (0..1)
+      sharpness   mean Laplacian magnitude of the textured (non-flat) blocks
+                  relative to their standard deviation, independent of contrast
+      coherence   mean ridge-orientation coherence of the foreground blocks
+                  from the structure tensor (0: isotropic, 1: parallel ridges)
+    The overall score is foreground * coherence, the share of the image
+    covered by clean ridge flow. A capture is rejected with the reason code
+    of the first check that fails; on a 512 px image this takes one or two
+    milliseconds, against tens of milliseconds for SIFT.
+    """
+
+    def __init__(self, min_contrast=0.15, min_foreground=0.35, min_sharpness=1.6, min_coherence=0.2,
+                 analysis_size=256, block_size=16, foreground_std=8.0, flat_std=2.0):
+        self.min_contrast = min_contrast
+        self.min_foreground = min_foreground
+        self.min_sharpness = min_sharpness
+        self.min_coherence = min_coherence
+        self.analysis_size = analysis_size
+        self.block_size = block_size
+        self.foreground_std = foreground_std  # Minimum block intensity std (0..255) counted as ridges
+        self.flat_std = flat_std  # Blocks below this std are flat background, ignored by the sharpness check
+
+    def assess(self, image):
+        """Return a QualityReport for a grayscale uint8 image"""
+        image = self._shrink(image)
+        low, high = np.percentile(image, (5, 95))
+        contrast = float(high - low) / 255
+        if contrast < self.min_contrast:
+            return QualityReport(False, LOW_CONTRAST, 0.0, contrast, 0.0, 0.0, 0.0)
+
+        # Crop to whole blocks so block statistics are plain reshapes
+        block = self.block_size
+        rows, cols = image.shape[0] // block, image.shape[1] // block
+        if rows == 0 or cols == 0:
+            return QualityReport(False, SMALL_FOREGROUND, 0.0, contrast, 0.0, 0.0, 0.0)
+        image = image[:rows * block, :cols * block].astype(np.float32)
+
+        blocks = image.reshape(rows, block, cols, block)
+        block_std = blocks.std(axis=(1, 3))
+
+        # Blur flattens ridges everywhere, a partial capture only leaves background flat,
+        # so sharpness is judged on every textured block before the foreground is counted
+        textured = block_std > self.flat_std
+        if not textured.any():
+            return QualityReport(False, LOW_CONTRAST, 0.0, contrast, 0.0, 0.0, 0.0)
+        laplacian = np.abs(cv2.Laplacian(image, cv2.CV_32F, ksize=3))
+        block_laplacian = laplacian.reshape(rows, block, cols, block).mean(axis=(1, 3))
+        sharpness = float(np.mean(block_laplacian[textured] / block_std[textured]))
+        if sharpness < self.min_sharpness:
+            return QualityReport(False, BLURRY, 0.0, contrast, 0.0, sharpness, 0.0)
+
+        foreground_mask = block_std > self.foreground_std
+        foreground = float(foreground_mask.mean())
+        if foreground < self.min_foreground:
+            return QualityReport(False, SMALL_FOREGROUND, 0.0, contrast, foreground, sharpness, 0.0)
+
+        gx = cv2.Sobel(image, cv2.CV_32F, 1, 0, ksize=3)
+        gy = cv2.Sobel(image, cv2.CV_32F, 0, 1, ksize=3)
+        gxx = (gx * gx).reshape(rows, block, cols, block).sum(axis=(1, 3))
+        gyy = (gy * gy).reshape(rows, block, cols, block).sum(axis=(1, 3))
+        gxy = (gx * gy).reshape(rows, block, cols, block).sum(axis=(1, 3))
+        energy = gxx + gyy
+        block_coherence = np.sqrt((gxx - gyy) ** 2 + 4 * gxy ** 2) / np.maximum(energy, 1e-6)
+        coherence = float(block_coherence[foreground_mask].mean())
+
+        score = foreground * coherence
+        if coherence < self.min_coherence:
+            return QualityReport(False, LOW_COHERENCE, score, contrast, foreground, sharpness, coherence)
+        return QualityReport(True, QUALITY_OK, score, contrast, foreground, sharpness, coherence)
+
+    def _shrink(self, image):
+        height, width = image.shape[:2]
+        scale = self.analysis_size / max(height, width)
+        if scale >= 1:
+            return image
+        return cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                          interpolation=cv2.INTER_AREA)
@@ -0,0 +1,638 @@
+import argparse
+import asyncio
+import base64
+import binascii
+import http.client
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http import HTTPStatus
+import numpy as np
+from fingerprint import (FingerprintProcessor, _init_worker, _extract_image, _extract_worker,
+                         _extract_bytes, _extract_bytes_worker)
+from otp import OTPHandler
+from otp_delivery import DeliveryError, QueueFullError
+from metrics import MetricsRegistry
+
+MAX_BODY_BYTES = 16 * 1024 * 1024
+LATENCY_WINDOW = 1000  # Latest requests per endpoint kept for the percentiles in /stats
+PERCENTILES = (50, 90, 99)
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+IDEMPOTENT_METHODS = ('GET', 'HEAD')  # Requests ServiceClient may send twice
+
+logger = logging.getLogger('service')
+
+
+class HTTPError(Exception):
+    """Raised by a handler to answer with an error status and message"""
+
+    def __init__(self, status, message, headers=None, details=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers or {}
+        self.details = details or {}  # Extra fields for the JSON error body
+
+
+class FingerprintService:
+    """Headless HTTP/JSON front end for FingerprintProcessor and OTPHandler.
+
+    The asyncio event loop only parses requests; feature extraction runs on
+    a process pool and matching/storage on a small thread pool, so one slow
+    image does not hold up the other terminals. At most max_concurrency
+    requests that use the pools (enroll, verify, identify) are processed at
+    once, up to max_queue more wait for a slot and anything beyond that is
+    turned away with 503 so latency stays bounded under overload. A request
+    takes its slot on arrival and keeps it until it is answered, so an
+    admitted request is never turned away halfway through.
+
+    Endpoints (JSON bodies; images are base64 'image' contents, or an
+    'image_path' relative to image_root when the service is given one):
+        POST /enroll    {user_id, image | images | fingers, phone?, email?}
+        POST /otp       {user_id, transport?}
+        POST /verify    {user_id, image, otp?}
+        POST /identify  {image, top_k?}
+        GET  /health, GET /stats
+        GET  /metrics (Prometheus text format), GET /metrics.json
+
+    Request latencies, pipeline stages (including those timed in the
+    extraction processes), match scores, OTP delivery and the queue state
+    are collected in a metrics.MetricsRegistry.
+    """
+
+    def __init__(self, processor, otp_handler, workers=None, max_concurrency=None, max_queue=64,
+                 match_threads=2, require_otp=False, max_body_bytes=MAX_BODY_BYTES, metrics=None,
+                 image_root=None):
+        self.processor = processor
+        self.otp_handler = otp_handler
+        # workers=0 extracts on a thread in this process (no process pool)
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.max_concurrency = max_concurrency or 2 * max(self.workers, 1)
+        self.max_queue = max_queue
+        self.match_threads = match_threads
+        self.require_otp = require_otp
+        self.max_body_bytes = max_body_bytes
+        # Folder 'image_path' requests may read from; None accepts uploaded images only
+        self.image_root = os.path.realpath(image_root) if image_root is not None else None
+        # Contact details for OTP delivery are kept in the processor's user registry
+        self.user_registry = processor.user_registry
+        self.routes = {
+            ('GET', '/health'): self.handle_health,
+            ('GET', '/stats'): self.handle_stats,
+            ('GET', '/metrics'): self.handle_metrics,
+            ('GET', '/metrics.json'): self.handle_metrics_json,
+            ('POST', '/enroll'): self.handle_enroll,
+            ('POST', '/otp'): self.handle_otp,
+            ('POST', '/verify'): self.handle_verify,
+            ('POST', '/identify'): self.handle_identify,
+        }
+        # Routes whose requests hold a concurrency slot while they are processed
+        self.admitted_routes = {('POST', '/enroll'), ('POST', '/verify'), ('POST', '/identify')}
+        # Serializes writers of the template store and descriptor index; readers use their snapshots
+        self._store_lock = threading.Lock()
+        self._extract_pool = None
+        self._match_pool = None
+        self._slots = None
+        self._server = None
+        self._waiting = 0
+        self._in_flight = 0
+        self.rejected = 0
+        self.errors = 0
+        self._latencies = {}  # path -> deque of seconds
+        self._counts = {}
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        if processor.metrics is None:
+            processor.instrument(self.metrics)
+        otp_handler.instrument(self.metrics)
+        self._request_timer = self.metrics.stage_timer('service_request_seconds', 'Request latency per endpoint',
+                                                       label='path')
+        self.metrics.gauge('service_in_flight', 'Requests holding a concurrency slot', function=lambda: self._in_flight)
+        self.metrics.gauge('service_waiting', 'Requests queued for a concurrency slot', function=lambda: self._waiting)
+        self.metrics.counter('service_rejected_total', 'Requests turned away with 503',
+                             function=lambda: self.rejected)
+        self.metrics.counter('service_errors_total', 'Requests that failed with an internal error',
+                             function=lambda: self.errors)
+
+    async def start(self, host='127.0.0.1', port=8080):
+        """Start the worker pools and listen; port=0 picks a free port (see self.port)"""
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        self._match_pool = ThreadPoolExecutor(max_workers=self.match_threads, thread_name_prefix='fp-match')
+        if self.workers > 0:
+            self._extract_pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                                     initargs=(self.processor.worker_config(),
+                                                               self.processor.stage_timer is not None))
+        else:
+            # The processor's OpenCV objects are not thread-safe, so in-process extraction gets one thread
+            self._extract_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fp-extract')
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        self.host, self.port = self._server.sockets[0].getsockname()[:2]
+        logger.info("Fingerprint service listening on http://%s:%s (%s extraction workers, %s concurrent requests)",
+                    self.host, self.port, self.workers, self.max_concurrency)
+        return self
+
+    async def serve_forever(self, host='127.0.0.1', port=8080):
+        await self.start(host, port)
+        try:
+            async with self._server:
+                await self._server.serve_forever()
+        finally:
+            await self.close()
+
+    async def close(self):
+        """Stop listening and shut the worker pools down"""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._extract_pool is not None:
+            self._extract_pool.shutdown(wait=True, cancel_futures=True)
+            self._extract_pool = None
+        if self._match_pool is not None:
+            self._match_pool.shutdown(wait=True)
+            self._match_pool = None
+        self.user_registry.flush()  # Last-seen times buffered by _score
+
+    # HTTP plumbing
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except HTTPError as e:
+                    # The request could not be framed, so the connection cannot be reused
+                    await self._write_response(writer, e.status, {'error': e.message, **e.details},
+                                               False, e.headers)
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status, payload, extra_headers = await self._dispatch(method, path, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                await self._write_response(writer, status, payload, keep_alive, extra_headers)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(self, reader):
+        """Return (method, path, headers, body), or None when the client closed the connection"""
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, _ = line.decode('latin-1').split(' ', 2)
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Malformed request line")
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid Content-Length")
+        if length > self.max_body_bytes:
+            raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                            f"Request body larger than {self.max_body_bytes} bytes")
+        body = await reader.readexactly(length) if length else b''
+        return method.upper(), target.split('?', 1)[0], headers, body
+
+    async def _write_response(self, writer, status, payload, keep_alive, extra_headers=None):
+        # Handlers return JSON-serializable payloads, or text for the Prometheus endpoint
+        if isinstance(payload, str):
+            body, content_type = payload.encode('utf-8'), PROMETHEUS_CONTENT_TYPE
+        else:
+            body, content_type = json.dumps(payload).encode('utf-8'), 'application/json'
+        status = HTTPStatus(status)
+        lines = [f"HTTP/1.1 {status.value} {status.phrase}",
+                 f"Content-Type: {content_type}",
+                 f"Content-Length: {len(body)}",
+                 f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        lines += [f"{name}: {value}" for name, value in (extra_headers or {}).items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+    async def _dispatch(self, method, path, body):
+        handler = self.routes.get((method, path))
+        if handler is None:
+            known = any(route_path == path for _, route_path in self.routes)
+            status = HTTPStatus.METHOD_NOT_ALLOWED if known else HTTPStatus.NOT_FOUND
+            return status, {'error': f"No route for {method} {path}"}, None
+
+        start = time.perf_counter()
+        try:
+            request = json.loads(body) if body else {}
+            if not isinstance(request, dict):
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "Request body must be a JSON object")
+            if (method, path) in self.admitted_routes:
+                async with self._admission():
+                    status, payload = await handler(request)
+            else:
+                status, payload = await handler(request)
+            extra_headers = None
+        except json.JSONDecodeError as e:
+            status, payload, extra_headers = HTTPStatus.BAD_REQUEST, {'error': f"Invalid JSON: {e}"}, None
+        except HTTPError as e:
+            status, payload, extra_headers = e.status, {'error': e.message, **e.details}, e.headers
+        except Exception as e:
+            logger.exception("Error handling %s %s: %s", method, path, e)
+            self.errors += 1
+            status, payload, extra_headers = HTTPStatus.INTERNAL_SERVER_ERROR, {'error': "Internal error"}, None
+
+        elapsed = time.perf_counter() - start
+        self._counts[path] = self._counts.get(path, 0) + 1
+        self._latencies.setdefault(path, deque(maxlen=LATENCY_WINDOW)).append(elapsed)
+        self._request_timer.record(path, elapsed)
+        self.metrics.counter('service_responses_total', 'Responses per endpoint and status',
+                             path=path, status=int(status)).inc()
+        return status, payload, extra_headers
+
+    # Scheduling
+
+    @asynccontextmanager
+    async def _admission(self):
+        """Hold a concurrency slot for the body, or reject with 503 if the queue is full"""
+        if self._slots.locked():
+            if self._waiting >= self.max_queue:
+                self.rejected += 1
+                raise HTTPError(HTTPStatus.SERVICE_UNAVAILABLE, "Server busy, retry later",
+                                headers={'Retry-After': '1'})
+        self._waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._waiting -= 1
+        self._in_flight += 1
+        try:
+            yield
+        finally:
+            self._in_flight -= 1
+            self._slots.release()
+
+    async def _run(self, executor, fn, *args):
+        """Run fn on an executor; the calling request already holds its concurrency slot"""
+        return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+    async def _extract(self, request):
+        """(keypoint positions, descriptors, quality report) of the request's image
+
+        Raises 422 if the capture fails the quality gate (with its reason code)
+        or has no features.
+        """
+        image_path = request.get('image_path')
+        encoded = request.get('image')
+        in_process = self.workers == 0
+        if encoded is not None:
+            try:
+                data = base64.b64decode(encoded, validate=True)
+            except (binascii.Error, TypeError, ValueError):
+                raise HTTPError(HTTPStatus.BAD_REQUEST, "'image' must be base64-encoded image file contents")
+            fn, args = (_extract_bytes, (self.processor, data)) if in_process else (_extract_bytes_worker, (data,))
+        elif image_path is not None:
+            image_path = self._image_file(image_path)
+            fn, args = (_extract_image, (self.processor, image_path)) if in_process else (_extract_worker, (image_path,))
+        else:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Request needs 'image' or 'image_path'")
+
+        if in_process:
+            keypoints, descriptors, quality = await self._run(self._extract_pool, fn, *args)
+        else:
+            (keypoints, descriptors, quality), samples = await self._run(self._extract_pool, fn, *args)
+            self.processor.record_stages(samples)
+            self.processor.observe_extraction(descriptors, quality)
+        if quality is not None and not quality.passed:
+            raise HTTPError(HTTPStatus.UNPROCESSABLE_ENTITY, "Capture rejected by the quality check",
+                            details={'reason': quality.reason, 'quality': quality._asdict()})
+        if descriptors is None:
+            raise HTTPError(HTTPStatus.UNPROCESSABLE_ENTITY, "Could not extract features from image")
+        return keypoints, descriptors, quality
+
+    def _image_file(self, image_path):
+        """Server-side path of a requested image_path, which must be a file under image_root"""
+        if self.image_root is None:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "'image_path' is not accepted by this service, send 'image'")
+        if not isinstance(image_path, str):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "'image_path' must be a string")
+        # realpath resolves '..' and symlinks, so neither can lead out of the root
+        path = os.path.realpath(os.path.join(self.image_root, image_path))
+        if os.path.commonpath([self.image_root, path]) != self.image_root:
+            raise HTTPError(HTTPStatus.FORBIDDEN, f"'image_path' must be inside the image root: {image_path}")
+        if not os.path.isfile(path):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"Image not found: {image_path}")
+        return path
+
+    def _store(self, user_id, descriptors, keypoints, phone, email, quality):
+        with self._store_lock:
+            self.processor.store_template(user_id, descriptors, keypoints)
+        self.user_registry.add_user(user_id, phone=phone, email=email, quality=quality)
+        return len(descriptors)
+
+    def _store_impressions(self, user_id, impressions, phone, email, quality):
+        with self._store_lock:
+            rows = self.processor.enroll_impressions(user_id, impressions, quality=quality)
+        self.user_registry.add_user(user_id, phone=phone, email=email)
+        return rows
+
+    def _score(self, user_id, descriptors, keypoints):
+        # The template is read from disk here, off the event loop, if it is not resident yet
+        score = self.processor.score_against_template(user_id, descriptors, keypoints)
+        self.user_registry.touch(user_id)
+        return score
+
+    def _identify(self, descriptors, keypoints, top_k):
+        index = self.processor.descriptor_index
+        if not index.loaded:
+            with self._store_lock:  # Loading the descriptor index must not race with enrollment
+                if not index.loaded:
+                    self.processor.load_descriptor_index()
+        # The search reads a snapshot of the index, so enrollment is not held up meanwhile
+        return self.processor.identify_descriptors(descriptors, keypoints, top_k)
+
+    # Endpoints
+
+    async def handle_health(self, request):
+        return HTTPStatus.OK, {'status': 'ok'}
+
+    async def handle_stats(self, request):
+        latency = {}
+        for path, samples in self._latencies.items():
+            ms = 1000 * np.asarray(samples)
+            latency[path] = {'count': self._counts[path], 'mean_ms': float(ms.mean())}
+            for p in PERCENTILES:
+                latency[path][f'p{p}_ms'] = float(np.percentile(ms, p))
+        return HTTPStatus.OK, {
+            'in_flight': self._in_flight,
+            'waiting': self._waiting,
+            'max_concurrency': self.max_concurrency,
+            'max_queue': self.max_queue,
+            'rejected': self.rejected,
+            'errors': self.errors,
+            'enrolled': len(self.user_registry),
+            'latency': latency,
+            'matcher_cache': self.processor.matcher_cache.stats(),
+            'template_cache': self.processor.template_db.stats(),
+            'otp_store': self.otp_handler.otp_store.stats(),
+            'otp_delivery': self.otp_handler.delivery_queue.stats(),
+        }
+
+    async def handle_metrics(self, request):
+        return HTTPStatus.OK, self.metrics.to_prometheus()
+
+    async def handle_metrics_json(self, request):
+        return HTTPStatus.OK, self.metrics.snapshot()
+
+    async def handle_enroll(self, request):
+        """One image, several impressions ('images') or several fingers ({'fingers': {name: images}})
+
+        Images in 'images'/'fingers' are base64 strings or {'image_path': ...} objects (with image_root).
+        """
+        user_id = _require(request, 'user_id')
+        contact = (request.get('phone') or None, request.get('email') or None)
+        fingers = request.get('fingers')
+        if fingers is None and request.get('images') is None:
+            keypoints, descriptors, quality = await self._extract(request)
+            rows = await self._run(self._match_pool, self._store, user_id, descriptors, keypoints, *contact,
+                                   _quality_score(quality))
+            return HTTPStatus.CREATED, {'user_id': user_id, 'keypoints': rows, 'quality': _quality_score(quality)}
+
+        if fingers is None:
+            fingers = {'default': request['images']}
+        if (not isinstance(fingers, dict) or not fingers
+                or not all(isinstance(images, list) and images for images in fingers.values())):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "'images' must be a non-empty list, "
+                                                    "'fingers' an object of non-empty lists")
+        # All impressions are extracted concurrently on the pool, under this request's one slot
+        impressions, scores = {}, []
+        for name, images in fingers.items():
+            results = await asyncio.gather(*(
+                self._extract(image if isinstance(image, dict) else {'image': image}) for image in images))
+            impressions[name] = [(keypoints, descriptors) for keypoints, descriptors, _ in results]
+            scores += [_quality_score(quality) for _, _, quality in results if quality is not None]
+        if 'fingers' not in request:
+            impressions = impressions['default']
+        quality = float(np.mean(scores)) if scores else None
+        rows = await self._run(self._match_pool, self._store_impressions, user_id, impressions, *contact, quality)
+        if not rows:
+            raise HTTPError(HTTPStatus.UNPROCESSABLE_ENTITY, "Could not build a template from the images")
+        return HTTPStatus.CREATED, {'user_id': user_id, 'keypoints': rows, 'quality': quality}
+
+    async def handle_otp(self, request):
+        user_id = _require(request, 'user_id')
+        user = self.user_registry.get_user(user_id)
+        if user is None or not (user['phone'] or user['email']):
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"No phone number or e-mail enrolled for user {user_id}")
+        transport = request.get('transport')
+        try:
+            delivery = self.otp_handler.create_otp(user_id, phone=user['phone'],
+                                                   email=user['email'], transport=transport)
+        except QueueFullError as e:
+            raise HTTPError(HTTPStatus.SERVICE_UNAVAILABLE, str(e), headers={'Retry-After': '5'})
+        except (DeliveryError, ValueError) as e:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, str(e))
+        if delivery is None:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"No recipient for transport {transport!r}")
+        # Delivery continues in the background, the terminal does not wait for WhatsApp
+        return HTTPStatus.ACCEPTED, {'user_id': user_id, 'queued': True}
+
+    async def handle_verify(self, request):
+        user_id = _require(request, 'user_id')
+        if not self.processor.has_template(user_id):
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"No template found for user {user_id}")
+
+        result = {'user_id': user_id}
+        otp = request.get('otp')
+        if otp is None and self.require_otp:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Request needs 'otp'")
+        if otp is not None:
+            # Only checked here: a rejected capture or a failed match must not use up the OTP
+            result['otp_valid'] = self.otp_handler.verify_otp(user_id, otp, consume=False)
+            if not result['otp_valid']:
+                result['verified'] = False
+                return HTTPStatus.OK, result
+
+        keypoints, descriptors, quality = await self._extract(request)
+        score = await self._run(self._match_pool, self._score, user_id, descriptors, keypoints)
+        result['quality'] = _quality_score(quality)
+        result['score'] = score or 0
+        result['match'] = result['score'] > self.processor.match_threshold
+        if otp is not None and result['match']:
+            # Consumed now; fails if the OTP expired or was used by a concurrent request meanwhile
+            result['otp_valid'] = self.otp_handler.verify_otp(user_id, otp)
+        result['verified'] = result['match'] and result.get('otp_valid', True)
+        return HTTPStatus.OK, result
+
+    async def handle_identify(self, request):
+        try:
+            top_k = int(request.get('top_k', 1))
+        except (TypeError, ValueError):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "'top_k' must be an integer")
+        keypoints, descriptors, _ = await self._extract(request)
+        if not self.processor.template_db:
+            return HTTPStatus.OK, {'candidates': []}
+        results = await self._run(self._match_pool, self._identify, descriptors, keypoints, top_k)
+        return HTTPStatus.OK, {'candidates': [{'user_id': user_id, 'score': score} for user_id, score in results]}
+
+
+def _quality_score(quality):
+    return quality.score if quality is not None else None
+
+
+def _require(request, field):
+    value = request.get(field)
+    if value in (None, ''):
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"Request needs '{field}'")
+    return str(value)
+
+
+class ServiceClient:
+    """Small blocking client for FingerprintService, for terminals, scripts and tests.
+
+    Keeps one HTTP/1.1 connection open, so use one client per thread.
+    Methods return (status, response dict); images are read from local files
+    and sent base64-encoded. Only GET requests are retried when the
+    connection drops: a POST may already have enrolled a user or sent an
+    OTP, so its error is raised for the caller to decide.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8080, timeout=60):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._connection = None
+
+    def request(self, method, path, payload=None):
+        body = json.dumps(payload).encode('utf-8') if payload is not None else None
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        for attempt in range(2):
+            if self._connection is None:
+                self._connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self._connection.request(method, path, body=body, headers=headers)
+                response = self._connection.getresponse()
+                data = response.read()
+            except (ConnectionError, http.client.HTTPException):
+                # The server may have closed an idle keep-alive connection, reconnect once
+                self.close()
+                if attempt or method not in IDEMPOTENT_METHODS:
+                    raise
+                continue
+            if response.getheader('Connection', '').lower() == 'close':
+                self.close()
+            if response.getheader('Content-Type', '').startswith('text/'):
+                return response.status, data.decode('utf-8')
+            return response.status, json.loads(data) if data else {}
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    @staticmethod
+    def _image(image_path):
+        with open(image_path, 'rb') as f:
+            return base64.b64encode(f.read()).decode('ascii')
+
+    def health(self):
+        return self.request('GET', '/health')
+
+    def stats(self):
+        return self.request('GET', '/stats')
+
+    def metrics(self, format='json'):
+        """Metrics snapshot as a dict, or the Prometheus text with format='prometheus'"""
+        return self.request('GET', '/metrics' if format == 'prometheus' else '/metrics.json')
+
+    def enroll(self, user_id, image_path, phone=None, email=None):
+        """image_path is one file, a list of impressions or {finger name: list of impressions}"""
+        if isinstance(image_path, dict):
+            payload = {'user_id': user_id, 'fingers': {name: [self._image(path) for path in paths]
+                                                       for name, paths in image_path.items()}}
+        elif isinstance(image_path, (list, tuple)):
+            payload = {'user_id': user_id, 'images': [self._image(path) for path in image_path]}
+        else:
+            payload = {'user_id': user_id, 'image': self._image(image_path)}
+        if phone:
+            payload['phone'] = phone
+        if email:
+            payload['email'] = email
+        return self.request('POST', '/enroll', payload)
+
+    def request_otp(self, user_id, transport=None):
+        payload = {'user_id': user_id}
+        if transport:
+            payload['transport'] = transport
+        return self.request('POST', '/otp', payload)
+
+    def verify(self, user_id, image_path, otp=None):
+        payload = {'user_id': user_id, 'image': self._image(image_path)}
+        if otp is not None:
+            payload['otp'] = otp
+        return self.request('POST', '/verify', payload)
+
+    def identify(self, image_path, top_k=1):
+        return self.request('POST', '/identify', {'image': self._image(image_path), 'top_k': top_k})
+
+
+def main():
+    # Make the project root importable so config/ can be found when run as src/service.py
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from config.settings import DATA_DIR, FINGERPRINT_SETTINGS, EMAIL_CONFIG, OTP_SETTINGS, SERVICE_SETTINGS
+
+    parser = argparse.ArgumentParser(description="Run the fingerprint + OTP verification service (HTTP/JSON)")
+    parser.add_argument('--host', default=SERVICE_SETTINGS['host'], help="Address to listen on")
+    parser.add_argument('--port', type=int, default=SERVICE_SETTINGS['port'], help="Port to listen on")
+    parser.add_argument('--data-dir', default=DATA_DIR, help="Folder holding templates and the OTP outbox")
+    parser.add_argument('--workers', type=int, default=SERVICE_SETTINGS['workers'],
+                        help="Feature extraction processes (0 extracts in-process, default: CPU count)")
+    parser.add_argument('--max-concurrency', type=int, default=SERVICE_SETTINGS['max_concurrency'],
+                        help="Requests processed at once (default: two per worker)")
+    parser.add_argument('--max-queue', type=int, default=SERVICE_SETTINGS['max_queue'],
+                        help="Requests allowed to wait for a slot before answering 503")
+    parser.add_argument('--log-level', default='INFO', help="Logging level (DEBUG logs every match score)")
+    parser.add_argument('--image-root', default=SERVICE_SETTINGS['image_root'],
+                        help="Folder requests may name images in with 'image_path' (default: uploads only)")
+    parser.add_argument('--require-otp', action='store_true', default=SERVICE_SETTINGS['require_otp'],
+                        help="Reject /verify requests without an OTP")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    processor = FingerprintProcessor(
+        data_dir=args.data_dir,
+        match_threshold=FINGERPRINT_SETTINGS['match_threshold'],
+        max_features=FINGERPRINT_SETTINGS['max_features'],
+        canonical_size=FINGERPRINT_SETTINGS['canonical_size'],
+        template_memory_bytes=FINGERPRINT_SETTINGS['template_memory_mb'] * 1024 * 1024,
+        prefetch_recent=FINGERPRINT_SETTINGS['prefetch_recent_users'],
+        matcher_backend=FINGERPRINT_SETTINGS['matcher_backend'],
+        preprocess_mode=FINGERPRINT_SETTINGS['preprocess_mode'],
+        crop_roi=FINGERPRINT_SETTINGS['crop_to_foreground'],
+    )
+    otp_handler = OTPHandler(data_dir=args.data_dir, email_config=EMAIL_CONFIG,
+                             expiry_minutes=OTP_SETTINGS['expiry_minutes'])
+    service = FingerprintService(processor, otp_handler, workers=args.workers,
+                                 max_concurrency=args.max_concurrency, max_queue=args.max_queue,
+                                 require_otp=args.require_otp, image_root=args.image_root)
+    try:
+        asyncio.run(service.serve_forever(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        otp_handler.delivery_queue.shutdown(wait=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+import threading
+from collections import OrderedDict
+
+
+class TemplateCache:
+    """Lazily loaded, memory-bounded view of a TemplateStore.
+
+    Behaves like the {user_id: template} dict FingerprintProcessor used to
+    build at startup, but only the store's index is read up front. A
+    template is read from disk on first access and kept in an LRU working
+    set bounded by max_bytes, so startup time and memory no longer grow
+    with the number of enrolled users. Iterating with items() streams
+    templates from disk without filling the working set. Templates are
+    read into private arrays rather than memory-mapped, so evicted ones
+    really leave resident memory.
+    """
+
+    def __init__(self, store, max_bytes=256 * 1024 * 1024):
+        self.store = store
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # user_id -> template array
+        self._lock = threading.Lock()
+        # Bumped on invalidation so a read racing with re-enrollment is not cached
+        self._generation = 0
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, user_id):
+        return user_id in self.store
+
+    def __len__(self):
+        return len(self.store)
+
+    def __bool__(self):
+        return len(self.store) > 0
+
+    def __iter__(self):
+        return iter(self.store.user_ids())
+
+    def keys(self):
+        return self.store.user_ids()
+
+    def get(self, user_id, default=None):
+        """Return the template for user_id (None if the user has none), reading it from disk on a miss"""
+        with self._lock:
+            template = self._entries.get(user_id)
+            if template is not None:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return template
+            if user_id not in self.store:
+                return default
+            self.misses += 1
+            generation = self._generation
+        template = self.store.read(user_id)
+        if template is not None:
+            with self._lock:
+                if generation == self._generation:
+                    self._insert(user_id, template)
+        return template
+
+    def __getitem__(self, user_id):
+        if user_id not in self:
+            raise KeyError(user_id)
+        return self.get(user_id)
+
+    def __setitem__(self, user_id, template):
+        """Replace the resident copy of a template (the store is not written)"""
+        with self._lock:
+            self._generation += 1
+            self._insert(user_id, template)
+
+    def _insert(self, user_id, template):
+        previous = self._entries.pop(user_id, None)
+        if previous is not None:
+            self.current_bytes -= previous.nbytes
+        if template is None:
+            return
+        while self._entries and self.current_bytes + template.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.current_bytes -= evicted.nbytes
+            self.evictions += 1
+        self._entries[user_id] = template
+        self.current_bytes += template.nbytes
+
+    def items(self):
+        """Yield (user_id, template) for every stored user; templates not resident are read but not kept"""
+        for user_id in self.store.user_ids():
+            with self._lock:
+                template = self._entries.get(user_id)
+            yield user_id, template if template is not None else self.store.read(user_id)
+
+    def values(self):
+        for _, template in self.items():
+            yield template
+
+    def invalidate(self, user_id):
+        """Drop the resident copy of user_id's template, e.g. after re-enrollment"""
+        with self._lock:
+            self._generation += 1
+            template = self._entries.pop(user_id, None)
+            if template is not None:
+                self.current_bytes -= template.nbytes
+
+    def pop(self, user_id, default=None):
+        """Drop the resident copy; the stored template is removed through TemplateStore.delete"""
+        template = self.get(user_id, default)
+        self.invalidate(user_id)
+        return template
+
+    def clear(self):
+        """Drop every resident template"""
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def prefetch(self, user_ids):
+        """Read the templates of user_ids into the working set until it is full; returns how many were loaded"""
+        loaded = 0
+        for user_id in user_ids:
+            with self._lock:
+                if user_id in self._entries or user_id not in self.store:
+                    continue
+                if self.current_bytes >= self.max_bytes:
+                    break
+                generation = self._generation
+            template = self.store.read(user_id)
+            if template is None:
+                continue
+            with self._lock:
+                # Prefetching must not push out templates that are actually in use
+                if self.current_bytes + template.nbytes > self.max_bytes:
+                    break
+                if generation == self._generation:
+                    self._insert(user_id, template)
+                    loaded += 1
+        return loaded
+
+    def stats(self):
+        """Counters for sizing the working set"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'current_bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'stored': len(self.store),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,516 @@
+import os
+import json
+import zlib
+from collections import namedtuple
+import numpy as np
+
+# Index file layout: a fixed header followed by fixed-size records. The index
+# is a write-ahead log: every put or delete appends one record, records are
+# never modified in place, and each carries a CRC32 so a record torn by a
+# crash is recognized. Replaying the records in order gives the live
+# templates. The header names the generation of the data file the records
+# point into; compaction writes a new generation (the snapshot) and switches
+# to it by renaming a fresh index over the old one.
+INDEX_MAGIC = b'FPIDX002'
+# First release: no checksums, replaced/deleted records were tombstoned in
+# place. Still readable; converted to the current format on the first write.
+LEGACY_INDEX_MAGIC = b'FPIDX001'
+INDEX_HEADER_SIZE = 16  # magic, then the data file generation (<u8)
+INDEX_DTYPE = np.dtype([
+    ('user_id', 'S64'),   # utf-8 encoded, null padded
+    ('offset', '<i8'),    # byte offset of the descriptor rows in the data file
+    ('rows', '<i4'),      # number of descriptors (0 means "no template")
+    ('cols', '<i4'),      # descriptor length
+    ('dtype', 'u1'),      # key into DTYPE_CODES
+    ('alive', 'u1'),      # 1: put, 0: delete (legacy files: 0 once tombstoned)
+    ('_pad', 'V10'),
+    ('checksum', '<u4'),  # CRC32 of the bytes before it
+])
+CHECKSUM_OFFSET = INDEX_DTYPE.fields['checksum'][1]
+
+DTYPE_CODES = {
+    1: np.dtype(np.float32),
+    2: np.dtype(np.uint8),
+    3: np.dtype(np.int32),
+}
+DTYPE_LOOKUP = {dtype: code for code, dtype in DTYPE_CODES.items()}
+ITEMSIZES = np.zeros(256, dtype=np.int64)  # dtype code -> bytes per value, 0 for unused codes
+for _code, _dtype in DTYPE_CODES.items():
+    ITEMSIZES[_code] = _dtype.itemsize
+
+# Descriptor blocks start on this boundary so float views stay aligned
+DATA_ALIGNMENT = 16
+
+# What readers see: the slots and the data file they point into. open() and
+# rewrite() publish a new one with a single assignment, so a reader never
+# pairs the slots of one generation with the data file of another.
+StoreState = namedtuple('StoreState', ['slots', 'data_path', 'data_size'])
+
+
+class TemplateStore:
+    """Crash-safe binary template store: a write-ahead log over a memory-mapped data file.
+
+    Descriptors for every user live in one contiguous data file
+    (<name>.dat, or <name>.<generation>.dat after a compaction);
+    <name>.idx is the log mapping each user_id to its byte offset and shape.
+    A write appends the descriptors, fsyncs them, then appends and fsyncs
+    the log records, so its cost does not depend on the store size and a
+    template is committed once put_many() returns. Opening replays the log
+    and ignores a torn tail left by a crash. When dead records or bytes
+    outweigh the live ones the store compacts itself into a new snapshot.
+    Loading only reads the small index, descriptor pages are faulted in by
+    the OS when a template is actually used.
+
+    One process writes a store; others may open it read-only. Within the
+    writing process, reads may run in other threads while it writes.
+    """
+
+    def __init__(self, data_dir='data', name='templates', auto_compact=True,
+                 compact_min_records=1024, compact_min_bytes=16 * 1024 * 1024):
+        self.data_dir = data_dir
+        self.name = name
+        self.index_path = os.path.join(data_dir, f'{name}.idx')
+        self.auto_compact = auto_compact
+        # Compaction waits until at least this much is dead, so small stores are not rewritten constantly
+        self.compact_min_records = compact_min_records
+        self.compact_min_bytes = compact_min_bytes
+        self.generation = 0
+        self.torn_bytes = 0   # Bytes of an interrupted write ignored by the last open()
+        # slots: user_id -> (offset, rows, cols, dtype code, nbytes) of its latest put
+        self._state = StoreState({}, self._data_path(0), 0)
+        self._data = None     # (path, read-only uint8 memmap) of the last mapped data file
+        self._index_size = 0  # End of the last valid record; the next record is written there
+        self._record_count = 0
+        self._live_bytes = 0
+        self._legacy = False
+        # Checksums already verified: the first _verified_count records of the index file
+        # identified by _index_key (device, inode, generation). Records are never modified in
+        # place, so reopening the same file only checks the records appended since.
+        self._index_key = None
+        self._verified_count = 0
+        self.open()
+
+    def _data_path(self, generation):
+        if generation == 0:
+            return os.path.join(self.data_dir, f'{self.name}.dat')
+        return os.path.join(self.data_dir, f'{self.name}.{generation}.dat')
+
+    @property
+    def data_path(self):
+        return self._state.data_path
+
+    @property
+    def _slots(self):
+        return self._state.slots
+
+    def exists(self):
+        """Return True if the store has been created on disk"""
+        return os.path.exists(self.index_path)
+
+    def open(self):
+        """(Re)read the index file, replaying its records, and map the data file
+
+        The replayed state is built aside and swapped in at the end, so
+        readers in other threads see either the old or the new store.
+        Checksums are verified for the records this store has not verified
+        or written itself, so only the first open of an index file checks
+        every record (about 0.5 us each).
+        """
+        self._close_data()
+        if not self.exists():
+            self._record_count = 0
+            self._live_bytes = 0
+            self._index_size = 0
+            self.torn_bytes = 0
+            self._state = StoreState({}, self._data_path(self.generation), 0)
+            self._index_key, self._verified_count = None, 0
+            return
+
+        with open(self.index_path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            header = f.read(INDEX_HEADER_SIZE)
+            raw = f.read()
+        magic = header[:len(INDEX_MAGIC)]
+        if magic not in (INDEX_MAGIC, LEGACY_INDEX_MAGIC):
+            raise ValueError(f"{self.index_path} is not a template index file")
+        legacy = magic == LEGACY_INDEX_MAGIC
+        generation = int.from_bytes(header[len(INDEX_MAGIC):INDEX_HEADER_SIZE], 'little')
+        data_path = self._data_path(generation)
+
+        # Replay up to the first incomplete or corrupt record: only the tail can be torn
+        count = len(raw) // INDEX_DTYPE.itemsize
+        records = np.frombuffer(raw, dtype=INDEX_DTYPE, count=count)
+        index_key = (stat.st_dev, stat.st_ino, generation)
+        if not legacy:
+            verified = min(self._verified_count, count) if index_key == self._index_key else 0
+            unverified = records[verified:]
+            bad = np.flatnonzero(_checksums(unverified) != unverified['checksum'])
+            if len(bad):
+                count = verified + int(bad[0])
+                records = records[:count]
+        self._index_key, self._verified_count = index_key, count
+        slots, live_bytes = _load(records)
+        data_size = os.path.getsize(data_path) if os.path.exists(data_path) else 0
+
+        self._state = StoreState(slots, data_path, data_size)
+        self._legacy = legacy
+        self.generation = generation
+        self._live_bytes = live_bytes
+        self._record_count = count
+        self._index_size = INDEX_HEADER_SIZE + count * INDEX_DTYPE.itemsize
+        self.torn_bytes = len(raw) - count * INDEX_DTYPE.itemsize
+        self._remove_old_generations()
+
+    def _replay(self, records):
+        sizes = records['rows'].astype(np.int64) * records['cols'] * ITEMSIZES[records['dtype']]
+        columns = zip(records['user_id'].tolist(), records['offset'].tolist(), records['rows'].tolist(),
+                      records['cols'].tolist(), records['dtype'].tolist(), records['alive'].tolist(),
+                      sizes.tolist())
+        slots = self._slots
+        live_bytes = self._live_bytes
+        for user_id, offset, rows, cols, code, alive, size in columns:
+            user_id = user_id.decode('utf-8')
+            previous = slots.get(user_id)
+            if previous is not None:
+                live_bytes -= previous[4]
+            # Legacy files tombstoned old records in place, so their dead puts are skipped the same way
+            if alive:
+                slots[user_id] = (offset, rows, cols, code, size)
+                live_bytes += size
+            elif previous is not None:
+                del slots[user_id]
+        self._live_bytes = live_bytes
+
+    def _data_files(self):
+        """{generation: path} of every data file of this store on disk"""
+        files = {}
+        prefix, suffix = f'{self.name}.', '.dat'
+        for filename in os.listdir(self.data_dir) if os.path.isdir(self.data_dir) else ():
+            if filename == f'{self.name}.dat':
+                files[0] = os.path.join(self.data_dir, filename)
+            elif filename.startswith(prefix) and filename.endswith(suffix):
+                generation = filename[len(prefix):-len(suffix)]
+                if generation.isdigit():
+                    files[int(generation)] = os.path.join(self.data_dir, filename)
+        return files
+
+    def _remove_old_generations(self):
+        # Data files of older generations are left behind when a compaction is
+        # interrupted after its commit, or when they were still mapped (Windows).
+        # Newer ones may belong to a compaction in progress and are left alone.
+        for generation, path in self._data_files().items():
+            if generation < self.generation:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _close_data(self):
+        # Only drop our reference: arrays handed out by get() keep their own
+        # reference to the mapping, so unmapping here would invalidate them.
+        self._data = None
+
+    def _mapped_data(self, state):
+        """Return a memmap covering the data file of state"""
+        mapped = self._data
+        if mapped is not None and mapped[0] == state.data_path and len(mapped[1]) >= state.data_size:
+            return mapped[1]
+        if state.data_size == 0:
+            return None
+        data = np.memmap(state.data_path, dtype=np.uint8, mode='r', shape=(state.data_size,))
+        self._data = (state.data_path, data)
+        return data
+
+    def __contains__(self, user_id):
+        return user_id in self._slots
+
+    def __len__(self):
+        return len(self._slots)
+
+    def user_ids(self):
+        """Return the ids of all live templates"""
+        return list(self._slots.keys())
+
+    def nbytes(self):
+        """Total size of the live descriptor data in bytes"""
+        return self._live_bytes
+
+    def get(self, user_id):
+        """Return the template for user_id as a read-only array view, or None"""
+        state = self._state
+        slot = state.slots.get(user_id)
+        if slot is None:
+            return None
+        offset, rows, cols, code, _ = slot
+        if rows == 0:
+            return None
+        dtype = DTYPE_CODES[code]
+        try:
+            data = self._mapped_data(state)
+        except FileNotFoundError:
+            if state.data_path == self.data_path:
+                raise
+            return self.get(user_id)  # A compaction switched data files meanwhile
+        return data[offset:offset + rows * cols * dtype.itemsize].view(dtype).reshape(rows, cols)
+
+    def rows(self, user_id):
+        """Number of descriptors stored for user_id (0 if none), without reading them"""
+        slot = self._slots.get(user_id)
+        return slot[1] if slot is not None else 0
+
+    def read(self, user_id):
+        """Return a private in-memory copy of the template for user_id, or None
+
+        Unlike get(), this reads the file instead of mapping it, so the
+        caller decides how long the descriptors stay resident.
+        """
+        state = self._state
+        slot, data_path = state.slots.get(user_id), state.data_path
+        if slot is None or slot[1] == 0:
+            return None
+        offset, rows, cols, code, nbytes = slot
+        template = np.empty((rows, cols), dtype=DTYPE_CODES[code])
+        try:
+            with open(data_path, 'rb') as data_file:
+                data_file.seek(offset)
+                read = data_file.readinto(memoryview(template).cast('B'))
+        except FileNotFoundError:
+            if data_path == self.data_path:
+                raise
+            return self.read(user_id)  # A compaction switched data files meanwhile
+        if read != nbytes:
+            raise ValueError(f"Template for user {user_id} is truncated in {data_path}")
+        return template
+
+    def items(self):
+        """Yield (user_id, template) pairs for all live templates"""
+        for user_id in list(self._slots.keys()):
+            yield user_id, self.get(user_id)
+
+    def put(self, user_id, descriptors):
+        """Append a template for user_id, replacing any previous one"""
+        self.put_many([(user_id, descriptors)])
+
+    def put_many(self, entries):
+        """Append several (user_id, descriptors) pairs with a single flush"""
+        entries = list(entries)
+        if not entries:
+            return
+        self._prepare_write()
+
+        state = self._state
+        with open(state.data_path, 'r+b' if os.path.exists(state.data_path) else 'w+b') as data_file:
+            records, data_size = _write_blocks(data_file, state.data_size, entries)
+        # Readers see the larger data file before any slot points into the new part
+        self._state = state._replace(data_size=data_size)
+        # Appending the log records commits the new templates
+        self._append_records(records)
+        self._replay(records)
+        self._maybe_compact()
+
+    def delete(self, user_id):
+        """Log the removal of the template for user_id"""
+        if user_id not in self._slots:
+            return
+        self._prepare_write()
+        records = np.zeros(1, dtype=INDEX_DTYPE)
+        records['user_id'][0] = self._encode_user_id(user_id)
+        self._append_records(records)
+        self._replay(records)
+        self._maybe_compact()
+
+    def _prepare_write(self):
+        self._ensure_files()
+        if self._legacy:
+            self.compact()
+
+    def _append_records(self, records):
+        _seal(records)
+        # Written at the end of the last valid record, so a torn tail is overwritten
+        with open(self.index_path, 'r+b') as index_file:
+            index_file.seek(self._index_size)
+            index_file.write(records.tobytes())
+            index_file.truncate()
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        self._index_size += records.nbytes
+        if self._verified_count == self._record_count:
+            self._verified_count += len(records)  # Sealed here, nothing to verify
+        self._record_count += len(records)
+        self.torn_bytes = 0
+
+    def _maybe_compact(self):
+        if not self.auto_compact:
+            return
+        dead_records = self._record_count - len(self._slots)
+        dead_bytes = self._state.data_size - self._live_bytes
+        # Each compaction is O(store size) but only runs after as much has died, so writes stay amortized O(1)
+        if (dead_records > max(self.compact_min_records, len(self._slots))
+                or dead_bytes > max(self.compact_min_bytes, self._live_bytes)):
+            self.compact()
+
+    def rewrite(self, templates):
+        """Atomically replace the store contents with the given {user_id: descriptors} dict
+
+        The templates are written as a snapshot to the next data file
+        generation and a temporary index, both fsynced; renaming the index
+        over the old one is the commit point. Until then the old files are
+        untouched (templates may even be views into them), and a crash on
+        either side of the rename leaves one complete store.
+        """
+        os.makedirs(self.data_dir, exist_ok=True)
+        generation = self.generation + 1
+        data_path = self._data_path(generation)
+        tmp_index_path = self.index_path + '.tmp'
+        with open(data_path, 'wb') as data_file:
+            records, _ = _write_blocks(data_file, 0, list(templates.items()))
+        _seal(records)
+        with open(tmp_index_path, 'wb') as index_file:
+            index_file.write(_index_header(generation))
+            index_file.write(records.tobytes())
+            index_file.flush()
+            os.fsync(index_file.fileno())
+            stat = os.fstat(index_file.fileno())
+        _fsync_directory(self.data_dir)
+
+        self._close_data()
+        os.replace(tmp_index_path, self.index_path)
+        _fsync_directory(self.data_dir)
+        # The snapshot was sealed above, so open() does not checksum it again
+        self._index_key, self._verified_count = (stat.st_dev, stat.st_ino, generation), len(records)
+        self.open()
+
+    def compact(self):
+        """Snapshot the live templates into a new data file, dropping replaced and deleted ones"""
+        self.rewrite(dict(self.items()))
+
+    def clear(self):
+        """Remove all templates and start from empty files"""
+        self._close_data()
+        os.makedirs(self.data_dir, exist_ok=True)
+        for path in [self.index_path, self.index_path + '.tmp'] + list(self._data_files().values()):
+            if os.path.exists(path):
+                os.remove(path)
+        self.generation = 0
+        self.open()
+        self._ensure_files()
+
+    def _ensure_files(self):
+        if self.exists():
+            return
+        os.makedirs(self.data_dir, exist_ok=True)
+        with open(self.data_path, 'ab'):
+            pass
+        with open(self.index_path, 'wb') as index_file:
+            index_file.write(_index_header(self.generation))
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        _fsync_directory(self.data_dir)
+        self._legacy = False
+        self._index_size = INDEX_HEADER_SIZE
+        self._state = self._state._replace(data_size=os.path.getsize(self.data_path))
+
+    @staticmethod
+    def _encode_user_id(user_id):
+        encoded = str(user_id).encode('utf-8')
+        if len(encoded) > INDEX_DTYPE['user_id'].itemsize:
+            raise ValueError(f"User id {user_id!r} is longer than {INDEX_DTYPE['user_id'].itemsize} bytes")
+        return encoded
+
+
+def _load(records):
+    """Vectorized replay for open(): return the {user_id: slot} dict and the live bytes
+
+    The last record of each user decides, so only live users reach Python
+    and startup stays a few passes over the index.
+    """
+    _, first = np.unique(records['user_id'][::-1], return_index=True)
+    last = len(records) - 1 - first
+    records = records[last[records['alive'][last] != 0]]
+    sizes = records['rows'].astype(np.int64) * records['cols'] * ITEMSIZES[records['dtype']]
+    user_ids = [user_id.decode('utf-8') for user_id in records['user_id'].tolist()]
+    slots = dict(zip(user_ids, zip(records['offset'].tolist(), records['rows'].tolist(),
+                                   records['cols'].tolist(), records['dtype'].tolist(),
+                                   sizes.tolist())))
+    return slots, int(sizes.sum())
+
+
+def _index_header(generation):
+    return INDEX_MAGIC + int(generation).to_bytes(INDEX_HEADER_SIZE - len(INDEX_MAGIC), 'little')
+
+
+def _write_blocks(data_file, offset, entries):
+    """Write (user_id, descriptors) blocks at offset and fsync; return their put records and the new end"""
+    records = np.zeros(len(entries), dtype=INDEX_DTYPE)
+    data_file.seek(offset)
+    for i, (user_id, descriptors) in enumerate(entries):
+        records['user_id'][i] = TemplateStore._encode_user_id(user_id)
+        records['alive'][i] = 1
+        if descriptors is None or len(descriptors) == 0:
+            continue
+
+        descriptors = np.ascontiguousarray(descriptors)
+        if descriptors.ndim != 2:
+            raise ValueError(f"Template for user {user_id} must be a 2-D array")
+        if descriptors.dtype not in DTYPE_LOOKUP:
+            descriptors = descriptors.astype(np.float32)
+
+        padding = -offset % DATA_ALIGNMENT
+        if padding:
+            data_file.write(b'\0' * padding)
+            offset += padding
+
+        data_file.write(descriptors.tobytes())
+        records['offset'][i] = offset
+        records['rows'][i] = descriptors.shape[0]
+        records['cols'][i] = descriptors.shape[1]
+        records['dtype'][i] = DTYPE_LOOKUP[descriptors.dtype]
+        offset += descriptors.nbytes
+    data_file.flush()
+    os.fsync(data_file.fileno())
+    return records, offset
+
+
+def _checksums(records):
+    """CRC32 of the bytes before the checksum field of each record, as a uint32 array"""
+    raw = records.view(np.uint8).reshape(len(records), INDEX_DTYPE.itemsize)[:, :CHECKSUM_OFFSET]
+    # One zlib call per row without slicing bytes in Python; numpy table-driven CRC measured slower
+    return np.fromiter(map(zlib.crc32, raw), dtype=np.uint32, count=len(records))
+
+
+def _seal(records):
+    """Fill in the checksum of every record"""
+    records['checksum'] = _checksums(records)
+
+
+def _fsync_directory(path):
+    # Makes file creation and renames durable; directories cannot be opened (nor need this) on Windows
+    if os.name == 'nt':
+        return
+    fd = os.open(path or '.', os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def migrate_json_templates(json_path, store):
+    """One-shot import of a legacy templates.json file into a TemplateStore.
+
+    Returns the number of templates migrated. The JSON file is left in place.
+    The templates are written with rewrite(), so the store only appears once
+    all of them are committed: a crash midway leaves no store and the next
+    start migrates again.
+    """
+    with open(json_path, 'r') as f:
+        loaded_data = json.load(f)
+
+    templates = {}
+    for user_id, template_list in loaded_data.items():
+        if isinstance(template_list, list) and template_list:
+            templates[user_id] = np.array(template_list, dtype=np.float32)
+        else:
+            templates[user_id] = None
+
+    store.rewrite(templates)
+    return len(templates)
@@ -0,0 +1,229 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    phone TEXT,
+    email TEXT,
+    template_store TEXT,      -- name of the TemplateStore holding the descriptors
+    template_format TEXT,     -- key into fingerprint.TEMPLATE_FORMATS
+    template_rows INTEGER,    -- number of stored descriptors (0: no usable template)
+    enrolled_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    metadata TEXT,            -- JSON object
+    quality REAL,             -- capture quality score at enrollment (quality.QualityGate)
+    last_seen REAL            -- time of the user's last verification attempt
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS users_phone ON users(phone);
+CREATE INDEX IF NOT EXISTS users_email ON users(email);
+"""
+# Indexes on added columns, created once older databases have been upgraded
+ADDED_INDEXES = """
+CREATE INDEX IF NOT EXISTS users_last_seen ON users(last_seen);
+"""
+
+COLUMNS = ('user_id', 'phone', 'email', 'template_store', 'template_format', 'template_rows',
+           'enrolled_at', 'updated_at', 'metadata', 'quality', 'last_seen')
+# Columns added after the first release, with their types, for upgrading older databases
+ADDED_COLUMNS = {'quality': 'REAL', 'last_seen': 'REAL'}
+
+
+class UserRegistry:
+    """Persistent user registry in an SQLite database (WAL mode).
+
+    Holds contact details for OTP delivery, a reference to each user's
+    stored template and enrollment timestamps. Lookups go through the
+    primary key or the phone/e-mail indexes, so they stay O(log n) and read
+    only a few pages. Each thread (and each process) gets its own
+    connection; with WAL, readers never block on a writer. Bulk writes
+    take one transaction per batch instead of one per user, and last-seen
+    times from touch() are buffered and written together.
+    """
+
+    def __init__(self, path, touch_interval=5.0, touch_batch=1024):
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        # touch() times wait in memory until touch_interval seconds have passed since the
+        # last write or touch_batch users are pending, then go out in one transaction
+        self.touch_interval = touch_interval
+        self.touch_batch = touch_batch
+        self._seen = {}  # user_id -> last_seen time not yet written
+        self._seen_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        # A connection inherited from the parent of a forked process must not be reused
+        if connection is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None,
+                                         check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(SCHEMA)
+            self._upgrade(connection)
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    @staticmethod
+    def _upgrade(connection):
+        existing = {row[1] for row in connection.execute('PRAGMA table_info(users)')}
+        for column, column_type in ADDED_COLUMNS.items():
+            if column not in existing:
+                try:
+                    connection.execute(f'ALTER TABLE users ADD COLUMN {column} {column_type}')
+                except sqlite3.OperationalError:
+                    pass  # Another connection added it first
+        connection.executescript(ADDED_INDEXES)
+
+    @contextmanager
+    def _transaction(self):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def add_user(self, user_id, phone=None, email=None, metadata=None, quality=None):
+        """Create or update a user; fields left as None keep their stored value"""
+        self.add_users([{'user_id': user_id, 'phone': phone, 'email': email, 'metadata': metadata,
+                         'quality': quality}])
+
+    def add_users(self, users):
+        """Create or update many users (dicts with user_id and optional phone, email, metadata, quality) in one transaction"""
+        now = time.time()
+        rows = [(str(user['user_id']), user.get('phone'), user.get('email'),
+                 json.dumps(user['metadata']) if user.get('metadata') is not None else None,
+                 user.get('quality'), now, now)
+                for user in users]
+        with self._transaction() as connection:
+            connection.executemany(
+                """INSERT INTO users (user_id, phone, email, metadata, quality, enrolled_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(user_id) DO UPDATE SET
+                       phone = COALESCE(excluded.phone, phone),
+                       email = COALESCE(excluded.email, email),
+                       metadata = COALESCE(excluded.metadata, metadata),
+                       quality = COALESCE(excluded.quality, quality),
+                       updated_at = excluded.updated_at""", rows)
+        return len(rows)
+
+    def record_templates(self, entries, template_store='templates', overwrite=True):
+        """Point users at their stored templates: entries are (user_id, template_format, template_rows)
+
+        With overwrite=False only users missing from the registry are added,
+        which is how templates enrolled before the registry existed are picked up.
+        """
+        now = time.time()
+        rows = [(str(user_id), template_store, template_format, int(template_rows), now, now)
+                for user_id, template_format, template_rows in entries]
+        conflict = """ON CONFLICT(user_id) DO UPDATE SET
+                          template_store = excluded.template_store,
+                          template_format = excluded.template_format,
+                          template_rows = excluded.template_rows,
+                          updated_at = excluded.updated_at""" if overwrite else "ON CONFLICT(user_id) DO NOTHING"
+        with self._transaction() as connection:
+            connection.executemany(
+                f"""INSERT INTO users (user_id, template_store, template_format, template_rows,
+                                       enrolled_at, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?) {conflict}""", rows)
+        return len(rows)
+
+    def touch(self, user_id, when=None):
+        """Record that user_id has just been seen (a verification attempt), for recent_users()
+
+        Verifications do not pay for an SQLite write each: the time is
+        buffered and written with the others pending (see flush()). Times
+        still buffered when the process dies are lost, which only changes
+        which templates are prefetched at the next start.
+        """
+        with self._seen_lock:
+            self._seen[str(user_id)] = time.time() if when is None else when
+            due = (len(self._seen) >= self.touch_batch
+                   or time.monotonic() - self._last_flush >= self.touch_interval)
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered touch() times in one transaction"""
+        with self._seen_lock:
+            seen, self._seen = self._seen, {}
+            self._last_flush = time.monotonic()
+        if not seen:
+            return
+        # MAX keeps the later time if a concurrent flush wrote a newer one first
+        with self._transaction() as connection:
+            connection.executemany('UPDATE users SET last_seen = MAX(COALESCE(last_seen, 0), ?) WHERE user_id = ?',
+                                   [(when, user_id) for user_id, when in seen.items()])
+
+    def recent_users(self, limit=100):
+        """user_ids most recently seen first, e.g. to prefetch their templates"""
+        self.flush()
+        return [row[0] for row in self._connection().execute(
+            'SELECT user_id FROM users WHERE last_seen IS NOT NULL ORDER BY last_seen DESC LIMIT ?', (limit,))]
+
+    def get_user(self, user_id):
+        """The user's row as a dict (metadata decoded), or None if the user is not registered"""
+        row = self._connection().execute('SELECT * FROM users WHERE user_id = ?', (str(user_id),)).fetchone()
+        user = _to_dict(row)
+        pending = self._seen.get(str(user_id))
+        if user is not None and pending is not None:
+            user['last_seen'] = max(user['last_seen'] or 0, pending)
+        return user
+
+    def find_by_phone(self, phone):
+        """user_ids registered with this phone number"""
+        return [row[0] for row in self._connection().execute(
+            'SELECT user_id FROM users WHERE phone = ?', (phone,))]
+
+    def find_by_email(self, email):
+        """user_ids registered with this e-mail address"""
+        return [row[0] for row in self._connection().execute(
+            'SELECT user_id FROM users WHERE email = ?', (email,))]
+
+    def remove_user(self, user_id):
+        with self._transaction() as connection:
+            connection.execute('DELETE FROM users WHERE user_id = ?', (str(user_id),))
+
+    def user_ids(self):
+        return [row[0] for row in self._connection().execute('SELECT user_id FROM users ORDER BY user_id')]
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    def __contains__(self, user_id):
+        return self._connection().execute(
+            'SELECT 1 FROM users WHERE user_id = ?', (str(user_id),)).fetchone() is not None
+
+    def close(self):
+        """Write buffered touch() times and close the connections of every thread"""
+        self.flush()
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+        self._local = threading.local()
+
+
+def _to_dict(row):
+    if row is None:
+        return None
+    user = {column: row[column] for column in COLUMNS}
+    user['metadata'] = json.loads(user['metadata']) if user['metadata'] else {}
+    return user
@@ -0,0 +1,75 @@
+"""Shared test fixtures: src/ on the import path, temporary directories, a generated dataset and a running service"""
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from benchmark import generate_synthetic_dataset, load_dataset  # noqa: E402
+
+
+class TempDirTestCase(unittest.TestCase):
+    """Gives the class a temporary directory, cls.tmp, removed after its last test"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, cls.tmp, ignore_errors=True)
+
+
+class DatasetTestCase(TempDirTestCase):
+    """Adds cls.dataset: {finger: [image paths]} of a synthetic set of `fingers` x `impressions` images"""
+    fingers = 2
+    impressions = 2
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.dataset = load_dataset(generate_synthetic_dataset(os.path.join(cls.tmp, 'dataset'),
+                                                              cls.fingers, cls.impressions))
+
+
+def file_otp_service(data_dir, processor=None, **options):
+    """(FingerprintService, FileTransport) over data_dir, extracting in-process and sending OTPs to a file"""
+    from fingerprint import FingerprintProcessor
+    from otp import OTPHandler
+    from otp_delivery import DeliveryQueue, FileTransport
+    from service import FingerprintService
+
+    transport = FileTransport(os.path.join(data_dir, 'otp_outbox.txt'))
+    otp_handler = OTPHandler(data_dir, delivery_queue=DeliveryQueue([transport]))
+    options.setdefault('workers', 0)
+    processor = processor if processor is not None else FingerprintProcessor(data_dir)
+    return FingerprintService(processor, otp_handler, **options), transport
+
+
+class ServiceThread:
+    """Serves a FingerprintService from an event loop in a daemon thread, on a free port"""
+
+    def __init__(self, service, host='127.0.0.1'):
+        self.service = service
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(service.start(host, 0))
+            started.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        started.wait()
+        self.port = service.port
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.service.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.service.otp_handler.delivery_queue.shutdown()
@@ -0,0 +1,29 @@
+import os
+import unittest
+
+from support import DatasetTestCase
+from benchmark import evaluate
+from fingerprint import FingerprintProcessor
+
+
+class EvaluateTest(DatasetTestCase):
+    """evaluate() enrolls into the stores and verifies through the caches"""
+
+    fingers = 3
+
+    def test_templates_go_through_the_store(self):
+        processor = FingerprintProcessor(os.path.join(self.tmp, 'data'), autoload=False)
+        report = evaluate(processor, self.dataset)
+        for finger in self.dataset:
+            self.assertTrue(processor.has_template(finger))
+        self.assertEqual(report['stages']['store']['count'], 3)
+        self.assertEqual(report['stages']['template_load']['count'], 3)
+        # Every verification finds the matcher built after the cold load
+        cache = processor.matcher_cache.stats()
+        attempts = report['genuine_attempts'] + report['impostor_attempts']
+        self.assertEqual((cache['misses'], cache['hits']), (3, attempts))
+        self.assertLess(report['mean_impostor_score'], report['mean_genuine_score'])
+
+
+if __name__ == '__main__':
+    unittest.main()
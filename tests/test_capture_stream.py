@@ -0,0 +1,54 @@
+import time
+import unittest
+
+import numpy as np
+
+import support  # noqa: F401 (puts src/ on the path)
+from capture_stream import FrameExtractor
+
+
+class CountingProcessor:
+    """Stands in for FingerprintProcessor.process_frame"""
+
+    last_quality = None
+
+    def __init__(self):
+        self.extracted = 0
+
+    def process_frame(self, frame):
+        self.extracted += 1
+        return np.zeros((1, 2), dtype=np.float32), np.zeros((1, 128), dtype=np.float32)
+
+
+class ReadAheadTest(unittest.TestCase):
+    """The reader thread stops close to the frame the caller decided on"""
+
+    def frames(self, count):
+        # One distinct frame, then a finger resting still on the scanner
+        first = np.zeros((64, 64), dtype=np.uint8)
+        still = np.full((64, 64), 128, dtype=np.uint8)
+        self.yielded = 0
+        for frame in [first] + [still] * (count - 1):
+            self.yielded += 1
+            yield frame
+
+    def test_skipped_frames_are_bounded(self):
+        processor = CountingProcessor()
+        with FrameExtractor(processor, self.frames(20), max_buffered=2) as extractor:
+            first = next(iter(extractor))
+            time.sleep(0.2)  # Slow matching of the first frame, then a decision
+        self.assertEqual(first.index, 0)
+        self.assertLessEqual(extractor.frames_read, 5)
+        self.assertLessEqual(self.yielded, 5)
+        self.assertEqual(processor.extracted, 2)
+
+    def test_reads_to_the_end_without_decision(self):
+        processor = CountingProcessor()
+        with FrameExtractor(processor, self.frames(20), max_buffered=2) as extractor:
+            items = list(extractor)
+        self.assertEqual([item.index for item in items], [0, 1])
+        self.assertEqual((extractor.frames_read, extractor.frames_skipped), (20, 18))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import unittest
+
+import numpy as np
+
+from support import DatasetTestCase, TempDirTestCase
+from fingerprint import FingerprintProcessor
+
+
+class FeatureCapTest(DatasetTestCase):
+    """Templates stored without the keypoint cap still match capped probes"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.uncapped = FingerprintProcessor(os.path.join(cls.tmp, 'uncapped'), autoload=False, max_features=0)
+        cls.processor = FingerprintProcessor(os.path.join(cls.tmp, 'data'), autoload=False, max_features=100)
+
+    def test_uncapped_template(self):
+        path = self.dataset['1'][0]
+        _, stored = self.uncapped.process_image(path)
+        _, probe = self.processor.process_image(path)
+        self.assertGreater(len(stored), 10 * len(probe))
+        self.assertGreater(self.processor.match_fingerprints(probe, stored), self.processor.match_threshold)
+        _, impostor = self.uncapped.process_image(self.dataset['2'][0])
+        self.assertLess(self.processor.match_fingerprints(probe, impostor), self.processor.match_threshold)
+
+
+class ConsolidateTest(TempDirTestCase):
+    """Impressions are registered through each other, not only against the first"""
+
+    def setUp(self):
+        self.processor = FingerprintProcessor(os.path.join(self.tmp, 'data'), autoload=False, max_features=0)
+        rng = np.random.default_rng(0)
+        self.descriptors = rng.random((600, 128), dtype=np.float32)
+        self.positions = rng.uniform(0, 300, (600, 2)).astype(np.float32)
+
+    def impression(self, rows, angle, shift):
+        # The same keypoints seen rotated and shifted, with a little descriptor noise
+        rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]], dtype=np.float32)
+        rng = np.random.default_rng(len(rows) + rows[0])
+        descriptors = self.descriptors[rows] + rng.normal(0, 0.01, (len(rows), 128)).astype(np.float32)
+        return self.positions[rows] @ rotation.T + shift, descriptors
+
+    def test_chained_registration(self):
+        # Impressions 0 and 2 share nothing, impression 1 overlaps both
+        impressions = [self.impression(np.arange(0, 300), 0.0, 0),
+                       self.impression(np.arange(150, 450), 0.2, 40),
+                       self.impression(np.arange(300, 600), -0.3, -25)]
+        with self.assertNoLogs('fingerprint', level='WARNING'):
+            descriptors, positions = self.processor.consolidate_impressions(impressions)
+        self.assertEqual(len(descriptors), 600)
+        # All positions are in one frame: distances between keypoints are preserved
+        rows = [np.argmin(((self.descriptors - d) ** 2).sum(axis=1)) for d in descriptors]
+        self.assertEqual(len(set(rows)), 600)
+        expected = np.linalg.norm(self.positions[rows] - self.positions[rows[0]], axis=1)
+        np.testing.assert_allclose(np.linalg.norm(positions - positions[0], axis=1), expected, atol=0.5)
+
+    def test_unregistered_dropped_with_warning(self):
+        impressions = [self.impression(np.arange(0, 300), 0.0, 0),
+                       self.impression(np.arange(150, 450), 0.2, 40),
+                       self.impression(np.arange(450, 600), -0.3, -25)]
+        with self.assertLogs('fingerprint', level='WARNING') as logs:
+            descriptors, positions = self.processor.consolidate_impressions(impressions)
+        self.assertEqual(len(descriptors), 450)
+        self.assertFalse(np.isnan(positions).any())
+        self.assertIn('Impression 3 of 3', logs.output[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import json
+import os
+import unittest
+
+from support import DatasetTestCase
+from fingerprint import FingerprintProcessor
+from metrics import MetricsRegistry
+
+
+class HistogramTest(unittest.TestCase):
+    def setUp(self):
+        self.histogram = MetricsRegistry().histogram('latency_seconds', buckets=(0.1, 0.2, 0.4))
+
+    def test_percentiles(self):
+        self.assertIsNone(self.histogram.percentile(50))
+        for value in (0.05, 0.15, 0.15, 0.3):
+            self.histogram.observe(value)
+        counts, total, count, maximum = self.histogram.state()
+        self.assertEqual(counts, [1, 2, 1, 0])
+        self.assertEqual((count, maximum), (4, 0.3))
+        self.assertAlmostEqual(total, 0.65)
+        # The median (rank 2) lies halfway through the 0.1-0.2 bucket
+        self.assertAlmostEqual(self.histogram.percentile(50), 0.15)
+        self.assertAlmostEqual(self.histogram.percentile(100), 0.4)
+
+    def test_overflow_bucket(self):
+        self.histogram.observe(5.0)
+        self.assertEqual(self.histogram.state()[0], [0, 0, 0, 1])
+        self.assertEqual(self.histogram.percentile(99), 0.4)
+
+
+class RegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_same_labels_same_metric(self):
+        counter = self.registry.counter('requests_total', endpoint='/verify')
+        self.assertIs(self.registry.counter('requests_total', endpoint='/verify'), counter)
+        self.assertIsNot(self.registry.counter('requests_total', endpoint='/enroll'), counter)
+        with self.assertRaises(ValueError):
+            self.registry.gauge('requests_total')
+
+    def test_stage_timer(self):
+        timer = self.registry.stage_timer('stage_seconds', label='stage')
+        timer.record('sift', 0.003)
+        with timer.time('match'):
+            pass
+        samples = self.registry.snapshot()['metrics']['stage_seconds']['samples']
+        self.assertEqual(sorted(sample['labels']['stage'] for sample in samples), ['match', 'sift'])
+        self.assertTrue(all(sample['count'] == 1 for sample in samples))
+
+    def test_prometheus(self):
+        self.registry.counter('requests_total', 'Requests', endpoint='/verify').inc(3)
+        self.registry.gauge('depth', function=lambda: 1 / 0)  # A failing callback is skipped
+        histogram = self.registry.histogram('latency_seconds', buckets=(0.1, 1.0), endpoint='a"b')
+        histogram.observe(0.05)
+        histogram.observe(2.0)
+        lines = self.registry.to_prometheus().splitlines()
+        self.assertIn('# HELP requests_total Requests', lines)
+        self.assertIn('requests_total{endpoint="/verify"} 3.0', lines)
+        self.assertIn('# TYPE depth gauge', lines)
+        self.assertFalse(any(line.startswith('depth') for line in lines))
+        self.assertIn('latency_seconds_bucket{endpoint="a\\"b",le="0.1"} 1', lines)
+        self.assertIn('latency_seconds_bucket{endpoint="a\\"b",le="1.0"} 1', lines)
+        self.assertIn('latency_seconds_bucket{endpoint="a\\"b",le="+Inf"} 2', lines)
+        self.assertIn('latency_seconds_count{endpoint="a\\"b"} 2', lines)
+
+    def test_json(self):
+        self.registry.gauge('cache_bytes').set(1024)
+        self.registry.histogram('latency_seconds').observe(0.002)
+        metrics = json.loads(self.registry.to_json())['metrics']
+        self.assertEqual(metrics['cache_bytes']['samples'], [{'labels': {}, 'value': 1024}])
+        sample = metrics['latency_seconds']['samples'][0]
+        self.assertEqual((sample['count'], sample['max']), (1, 0.002))
+        self.assertLessEqual({'p50', 'p90', 'p99'}, set(sample))
+
+
+class InstrumentedProcessorTest(DatasetTestCase):
+    def test_pipeline_metrics(self):
+        registry = MetricsRegistry()
+        processor = FingerprintProcessor(os.path.join(self.tmp, 'data'), autoload=False)
+        processor.instrument(registry)
+        keypoints, descriptors = processor.process_image(self.dataset['1'][0])
+        processor.store_template('1', descriptors, keypoints)
+        processor.match_fingerprints(descriptors, processor.template_db['1'])
+        metrics = registry.snapshot()['metrics']
+        stages = {sample['labels']['stage'] for sample in metrics['fingerprint_stage_seconds']['samples']}
+        self.assertLessEqual({'imread', 'preprocess', 'extract_features', 'knn_match', 'match'}, stages)
+        self.assertEqual(metrics['fingerprint_descriptors']['samples'][0]['count'], 1)
+        self.assertEqual(metrics['fingerprint_match_score']['samples'][0]['count'], 1)
+        self.assertEqual(metrics['fingerprint_templates']['samples'][0]['value'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
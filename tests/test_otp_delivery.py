@@ -0,0 +1,113 @@
+import threading
+import time
+import unittest
+
+import support  # noqa: F401 (puts src/ on the path)
+from otp import OTPHandler
+from otp_delivery import DeliveryError, DeliveryQueue, Transport
+
+
+class RecordingTransport(Transport):
+    """Records messages in send order, holding each send until released"""
+
+    def __init__(self, name, max_concurrency):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.sent = []
+        self.in_flight = 0
+        self.peak = 0
+        self.release = threading.Event()
+        self._lock = threading.Lock()
+
+    def send(self, recipient, message):
+        with self._lock:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        self.release.wait()
+        with self._lock:
+            self.in_flight -= 1
+            self.sent.append(message)
+
+
+class FailingTransport(Transport):
+    name = 'failing'
+
+    def __init__(self):
+        self.calls = []
+
+    def send(self, recipient, message):
+        self.calls.append(time.monotonic())
+        raise DeliveryError("unreachable")
+
+
+class DeliveryQueueTest(unittest.TestCase):
+    def test_busy_transport_keeps_fifo_order(self):
+        slow = RecordingTransport('slow', max_concurrency=1)
+        fast = RecordingTransport('fast', max_concurrency=4)
+        fast.release.set()
+        queue = DeliveryQueue([slow, fast], workers=4)
+        scheduled = []
+        schedule = queue._schedule
+        queue._schedule = lambda job, ready_at: (scheduled.append(job), schedule(job, ready_at))
+        try:
+            futures = [queue.submit('slow', 'r', str(i)) for i in range(10)]
+            time.sleep(0.2)  # Waiting jobs sleep on the condition instead of being polled
+            futures += [queue.submit('slow', 'r', str(i)) for i in range(10, 20)]
+            # The other transport is not held up by the busy one
+            self.assertTrue(queue.submit('fast', 'r', 'x').result(timeout=5).delivered)
+            slow.release.set()
+            self.assertTrue(queue.join(timeout=10))
+        finally:
+            queue.shutdown()
+        self.assertTrue(all(future.result().delivered for future in futures))
+        self.assertEqual(slow.sent, [str(i) for i in range(20)])
+        self.assertEqual(slow.peak, 1)
+        self.assertEqual(len(scheduled), 21)
+
+    def test_retries_with_backoff(self):
+        transport = FailingTransport()
+        queue = DeliveryQueue([transport], workers=2, max_attempts=3, backoff=0.05)
+        try:
+            status = queue.submit('failing', 'r', 'm').result(timeout=5)
+        finally:
+            queue.shutdown()
+        self.assertFalse(status.delivered)
+        self.assertEqual(status.attempts, 3)
+        self.assertGreaterEqual(transport.calls[2] - transport.calls[1], 0.1)
+        self.assertEqual(queue.stats()['retries'], 2)
+
+
+class CreateOTPTest(unittest.TestCase):
+    def setUp(self):
+        self.transport = RecordingTransport('file', max_concurrency=1)
+        self.transport.release.set()
+        self.handler = OTPHandler(delivery_queue=DeliveryQueue([self.transport], workers=1, max_pending=1))
+
+    def tearDown(self):
+        self.handler.delivery_queue.shutdown()
+
+    def test_unknown_transport_issues_nothing(self):
+        with self.assertRaises(ValueError):
+            self.handler.create_otp('1', phone='+10000000000', transport='sms')
+        self.assertNotIn('1', self.handler.otp_store)
+        self.assertEqual(self.handler.otp_store.stats()['issued'], 0)
+
+    def test_missing_recipient_issues_nothing(self):
+        self.assertIsNone(self.handler.create_otp('1', email='a@example.com', transport='file'))
+        self.assertNotIn('1', self.handler.otp_store)
+
+    def test_refused_delivery_revokes_otp(self):
+        self.handler.delivery_queue.shutdown()
+        with self.assertRaises(DeliveryError):
+            self.handler.create_otp('1', phone='+10000000000', transport='file')
+        self.assertNotIn('1', self.handler.otp_store)
+
+    def test_queued_otp_is_issued(self):
+        status = self.handler.create_otp('1', phone='+10000000000', transport='file').result(timeout=5)
+        self.assertTrue(status.delivered)
+        otp = self.transport.sent[0].split(': ')[1][:6]
+        self.assertTrue(self.handler.verify_otp('1', otp))
+
+
+if __name__ == '__main__':
+    unittest.main()
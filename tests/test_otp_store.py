@@ -0,0 +1,80 @@
+import unittest
+
+import support  # noqa: F401 (puts src/ on the path)
+from otp import OTPHandler
+from otp_store import OTPStore
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class OTPStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.store = OTPStore(ttl_seconds=300, capacity=3, clock=self.clock)
+
+    def test_single_use(self):
+        self.store.issue('1', '123456')
+        self.assertFalse(self.store.verify('1', '654321'))
+        self.assertTrue(self.store.verify('1', '123456'))
+        self.assertFalse(self.store.verify('1', '123456'))
+        self.assertEqual(self.store.stats()['verified'], 1)
+        self.assertEqual(self.store.stats()['rejected'], 2)
+
+    def test_check_without_consuming(self):
+        self.store.issue('1', '123456')
+        self.assertTrue(self.store.verify('1', '123456', consume=False))
+        self.assertTrue(self.store.verify('1', '123456'))
+        self.assertNotIn('1', self.store)
+
+    def test_expiry(self):
+        self.assertEqual(self.store.issue('1', '111111'), 1300.0)
+        self.clock.now += 200
+        self.store.issue('2', '222222')
+        self.clock.now += 99.9
+        self.assertTrue(self.store.verify('1', '111111', consume=False))
+        self.clock.now += 0.1
+        self.assertFalse(self.store.verify('1', '111111'))
+        self.assertEqual(len(self.store), 1)
+        self.clock.now += 200
+        self.assertEqual(self.store.evict_expired(), 1)
+        self.assertEqual(self.store.stats()['expired'], 2)
+
+    def test_reissue_replaces_and_extends(self):
+        self.store.issue('1', '111111')
+        self.clock.now += 200
+        self.store.issue('1', '222222')
+        self.clock.now += 200
+        self.assertFalse(self.store.verify('1', '111111'))
+        self.assertTrue(self.store.verify('1', '222222'))
+
+    def test_capacity_evicts_oldest(self):
+        for user_id in '1234':
+            self.store.issue(user_id, user_id * 6)
+            self.clock.now += 1
+        self.assertEqual(len(self.store), 3)
+        self.assertNotIn('1', self.store)
+        self.assertTrue(self.store.verify('4', '444444'))
+        self.assertEqual(self.store.stats()['evicted'], 1)
+
+    def test_revoke(self):
+        self.store.issue('1', '123456')
+        self.store.revoke('1')
+        self.assertFalse(self.store.verify('1', '123456'))
+
+
+class GenerateOTPTest(unittest.TestCase):
+    def test_six_digits(self):
+        handler = OTPHandler.__new__(OTPHandler)  # generate_otp needs no store or delivery queue
+        codes = {handler.generate_otp() for _ in range(50)}
+        self.assertTrue(all(len(code) == 6 and code.isdigit() for code in codes))
+        self.assertGreater(len(codes), 40)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+import cv2
+import numpy as np
+
+from support import DatasetTestCase
+from preprocess import PreprocessPipeline, reference_enhance
+
+
+class ResizeTest(unittest.TestCase):
+    def test_shrinks_large_images(self):
+        image = np.zeros((1200, 900), np.uint8)
+        self.assertEqual(PreprocessPipeline().resize(image, 512).shape, (512, 384))
+
+    def test_keeps_small_images(self):
+        image = np.zeros((300, 200), np.uint8)
+        self.assertIs(PreprocessPipeline().resize(image, 512), image)
+
+
+class EnhanceTest(DatasetTestCase):
+    fingers = 1
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.image = cv2.imread(cls.dataset['1'][0], cv2.IMREAD_GRAYSCALE)
+
+    def test_full_matches_reference(self):
+        pipeline = PreprocessPipeline(compare=True)
+        output = pipeline.enhance(self.image)
+        np.testing.assert_array_equal(output, reference_enhance(self.image, pipeline))
+        self.assertEqual(pipeline.last_agreement, 1.0)
+
+    def test_fast_agrees_with_full(self):
+        pipeline = PreprocessPipeline('fast', compare=True)
+        output = pipeline.enhance(self.image)
+        self.assertEqual(output.shape, self.image.shape)
+        self.assertEqual(set(np.unique(output)), {0, 255})
+        self.assertGreater(pipeline.last_agreement, 0.97)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            PreprocessPipeline('turbo')
+
+    def test_buffers_are_reused(self):
+        pipeline = PreprocessPipeline('fast', crop_roi=True)
+        first = pipeline.enhance(self.image)
+        buffers = {name: buffer.__array_interface__['data'][0] for name, buffer in pipeline._buffers.items()}
+        second = pipeline.enhance(self.image[:200, :250].copy())
+        self.assertTrue(np.shares_memory(first, second))
+        self.assertEqual({name: buffer.__array_interface__['data'][0] for name, buffer in pipeline._buffers.items()},
+                         buffers)
+
+    def test_crop_to_foreground(self):
+        # The capture pasted into a flat scanner background
+        canvas = np.full((500, 600), int(np.median(self.image)), np.uint8)
+        canvas[100:400, 200:500] = self.image
+        pipeline = PreprocessPipeline(crop_roi=True, compare=True)
+        output = pipeline.enhance(canvas)
+        x, y, width, height = pipeline.last_roi
+        self.assertEqual(output.shape, (height, width))
+        self.assertTrue(x <= 200 and y <= 100 and x + width >= 500 and y + height >= 400)
+        self.assertLess(width * height, 0.5 * canvas.size)
+        self.assertGreater(pipeline.last_agreement, 0.97)
+
+    def test_no_crop_without_background(self):
+        pipeline = PreprocessPipeline(crop_roi=True)
+        self.assertEqual(pipeline.enhance(self.image).shape, self.image.shape)
+        self.assertIsNone(pipeline.last_roi)
+        self.assertIsNone(pipeline.foreground_box(np.full((256, 256), 127, np.uint8)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+import cv2
+import numpy as np
+
+from support import DatasetTestCase
+from quality import BLURRY, LOW_COHERENCE, LOW_CONTRAST, QUALITY_OK, SMALL_FOREGROUND, QualityGate
+
+
+class QualityGateTest(DatasetTestCase):
+    """Degraded copies of a synthetic capture are rejected with the reason of the check that fails"""
+    fingers = 1
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.image = cv2.imread(cls.dataset['1'][0], cv2.IMREAD_GRAYSCALE)
+        cls.gate = QualityGate()
+
+    def assertReason(self, image, reason):
+        report = self.gate.assess(image)
+        self.assertEqual(report.reason, reason, report)
+        self.assertEqual(report.passed, reason == QUALITY_OK)
+        return report
+
+    def test_clean(self):
+        report = self.assertReason(self.image, QUALITY_OK)
+        self.assertAlmostEqual(report.score, report.foreground * report.coherence)
+
+    def test_light_blur_passes(self):
+        self.assertReason(cv2.GaussianBlur(self.image, (0, 0), 1), QUALITY_OK)
+
+    def test_blank(self):
+        report = self.assertReason(np.full_like(self.image, 200), LOW_CONTRAST)
+        self.assertEqual(report.score, 0.0)
+
+    def test_blurry(self):
+        self.assertReason(cv2.GaussianBlur(self.image, (0, 0), 4), BLURRY)
+
+    def test_partial_finger(self):
+        image = np.full_like(self.image, int(np.median(self.image)))
+        quarter = self.image.shape[1] // 4
+        image[:, :quarter] = self.image[:, :quarter]
+        report = self.assertReason(image, SMALL_FOREGROUND)
+        self.assertLess(report.foreground, self.gate.min_foreground)
+
+    def test_noise(self):
+        noise = np.random.default_rng(0).integers(0, 256, self.image.shape, dtype=np.uint8)
+        self.assertReason(noise, LOW_COHERENCE)
+
+    def test_large_images_are_shrunk(self):
+        image = cv2.resize(self.image, None, fx=4, fy=4, interpolation=cv2.INTER_CUBIC)
+        self.assertReason(image, QUALITY_OK)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import threading
+import time
+import unittest
+from unittest import mock
+
+from support import DatasetTestCase, ServiceThread, file_otp_service
+import service
+from service import ServiceClient
+
+
+class AdmissionTest(DatasetTestCase):
+    """One concurrency slot per request, held from arrival to response"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        fp_service, _ = file_otp_service(os.path.join(cls.tmp, 'data'), max_concurrency=1, max_queue=0)
+        cls.server = ServiceThread(fp_service)
+        cls.service = fp_service
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def client(self):
+        client = ServiceClient(port=self.server.port)
+        self.addCleanup(client.close)
+        return client
+
+    def test_multi_image_enroll_uses_one_slot(self):
+        # Its impressions are extracted concurrently without queueing against each other
+        status, response = self.client().enroll('multi', self.dataset['1'])
+        self.assertEqual(status, 201, response)
+        self.assertEqual(self.service.rejected, 0)
+
+    def test_verify_keeps_its_slot(self):
+        self.assertEqual(self.client().enroll('1', self.dataset['1'][0])[0], 201)
+        self.service.max_queue = 1
+        self.addCleanup(setattr, self.service, 'max_queue', 0)
+        events = []
+        extract, score = service._extract_bytes, self.service._score
+
+        def slow_extract(processor, data):
+            events.append('extract')
+            time.sleep(0.2)
+            return extract(processor, data)
+
+        def logged_score(*args):
+            events.append('score')
+            return score(*args)
+
+        responses = []
+        with mock.patch('service._extract_bytes', slow_extract), \
+                mock.patch.object(self.service, '_score', logged_score):
+            threads = [threading.Thread(target=lambda: responses.append(self.client().verify('1', path)))
+                       for path in self.dataset['1']]
+            for thread in threads:
+                thread.start()
+                time.sleep(0.05)  # The second request arrives while the first is extracting
+            for thread in threads:
+                thread.join()
+        self.assertEqual([status for status, _ in responses], [200, 200])
+        # Without a slot between extraction and scoring, the second extraction would cut in
+        self.assertEqual(events, ['extract', 'score', 'extract', 'score'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import unittest
+from unittest import mock
+
+import support  # noqa: F401 (puts src/ on the path)
+from service import ServiceClient
+
+
+class DroppedConnectionTest(unittest.TestCase):
+    """Only idempotent requests are sent again after the connection drops"""
+
+    def setUp(self):
+        patcher = mock.patch('service.http.client.HTTPConnection')
+        self.connection_class = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.connection = self.connection_class.return_value
+        self.connection.request.side_effect = ConnectionResetError
+        self.client = ServiceClient()
+
+    def test_get_is_retried(self):
+        with self.assertRaises(ConnectionResetError):
+            self.client.health()
+        self.assertEqual(self.connection.request.call_count, 2)
+
+    def test_post_is_not_retried(self):
+        with self.assertRaises(ConnectionResetError):
+            self.client.request_otp('1')
+        self.assertEqual(self.connection.request.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
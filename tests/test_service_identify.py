@@ -0,0 +1,43 @@
+import os
+import threading
+import unittest
+
+from support import DatasetTestCase, file_otp_service
+
+
+class IdentifyTest(DatasetTestCase):
+    """Identification searches without holding the lock enrollment writes under"""
+    fingers = 3
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.service, _ = file_otp_service(os.path.join(cls.tmp, 'data'))
+        cls.processor = cls.service.processor
+        cls.probes = {}
+        for finger, paths in cls.dataset.items():
+            keypoints, descriptors = cls.processor.process_image(paths[0])
+            cls.processor.store_template(finger, descriptors, keypoints)
+            cls.probes[finger] = (descriptors, keypoints)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.service.otp_handler.delivery_queue.shutdown()
+
+    def identify(self, finger):
+        descriptors, keypoints = self.probes[finger]
+        return self.service._identify(descriptors, keypoints, 1)
+
+    def test_search_during_enrollment(self):
+        self.assertEqual(self.identify('1')[0][0], '1')  # Loads the index
+        results = []
+        with self.service._store_lock:  # An enrollment in progress
+            thread = threading.Thread(target=lambda: results.append(self.identify('2')))
+            thread.start()
+            thread.join(timeout=30)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(results[0][0][0], '2')
+
+
+if __name__ == '__main__':
+    unittest.main()
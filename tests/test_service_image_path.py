@@ -0,0 +1,51 @@
+import os
+import unittest
+
+from support import DatasetTestCase, ServiceThread, file_otp_service
+from service import ServiceClient
+
+
+class ImagePathTest(DatasetTestCase):
+    """'image_path' only reads files under the configured image root"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.root = os.path.dirname(cls.dataset['1'][0])
+        service, _ = file_otp_service(os.path.join(cls.tmp, 'data'), image_root=cls.root)
+        cls.service = service
+        cls.server = ServiceThread(service)
+        cls.client = ServiceClient(port=cls.server.port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.close()
+        cls.server.stop()
+
+    def identify(self, image_path):
+        return self.client.request('POST', '/identify', {'image_path': image_path})
+
+    def test_inside_root(self):
+        status, response = self.identify(os.path.basename(self.dataset['1'][0]))
+        self.assertEqual(status, 200, response)
+        self.assertEqual(self.identify(self.dataset['1'][0])[0], 200)  # Absolute paths inside the root too
+
+    def test_outside_root(self):
+        self.assertEqual(self.identify('../data/registry.db')[0], 403)
+        self.assertEqual(self.identify(os.path.join(self.tmp, 'data', 'otp_outbox.txt'))[0], 403)
+        self.assertEqual(self.identify('/etc/passwd')[0], 403)
+
+    def test_missing_or_invalid(self):
+        self.assertEqual(self.identify('missing.png')[0], 400)
+        self.assertEqual(self.identify(['a.png'])[0], 400)
+
+    def test_uploads_only_without_root(self):
+        self.service.image_root = None
+        self.addCleanup(setattr, self.service, 'image_root', os.path.realpath(self.root))
+        status, response = self.identify(os.path.basename(self.dataset['1'][0]))
+        self.assertEqual(status, 400)
+        self.assertIn("send 'image'", response['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
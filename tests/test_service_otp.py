@@ -0,0 +1,61 @@
+import os
+import unittest
+import cv2
+import numpy as np
+
+from support import DatasetTestCase, ServiceThread, file_otp_service
+from service import ServiceClient
+
+
+class VerifyOTPTest(DatasetTestCase):
+    """A /verify request consumes its OTP only once the fingerprint has matched"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.blank = os.path.join(cls.tmp, 'blank.png')
+        cv2.imwrite(cls.blank, np.full((300, 300), 128, np.uint8))
+        service, cls.transport = file_otp_service(os.path.join(cls.tmp, 'data'))
+        cls.otp_handler = service.otp_handler
+        cls.server = ServiceThread(service)
+        cls.client = ServiceClient(port=cls.server.port)
+        for finger, paths in cls.dataset.items():
+            status, _ = cls.client.enroll(finger, paths[0], phone='+10000000000')
+            assert status == 201
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.close()
+        cls.server.stop()
+
+    def issue_otp(self, user_id):
+        status, _ = self.client.request_otp(user_id, transport='file')
+        self.assertEqual(status, 202)
+        self.otp_handler.delivery_queue.join()
+        return self.transport.sent[-1][1].split(': ')[1][:6]
+
+    def test_failed_match_keeps_otp(self):
+        otp = self.issue_otp('1')
+        status, result = self.client.verify('1', self.dataset['2'][0], otp=otp)
+        self.assertEqual(status, 200)
+        self.assertFalse(result['match'])
+        self.assertFalse(result['verified'])
+        status, result = self.client.verify('1', self.dataset['1'][0], otp=otp)
+        self.assertTrue(result['otp_valid'])
+        self.assertTrue(result['verified'])
+        # Consumed by the successful verification
+        status, result = self.client.verify('1', self.dataset['1'][0], otp=otp)
+        self.assertFalse(result['otp_valid'])
+        self.assertFalse(result['verified'])
+
+    def test_rejected_capture_keeps_otp(self):
+        otp = self.issue_otp('2')
+        status, result = self.client.verify('2', self.blank, otp=otp)
+        self.assertEqual(status, 422)
+        status, result = self.client.verify('2', self.dataset['2'][0], otp=otp)
+        self.assertTrue(result['otp_valid'])
+        self.assertTrue(result['verified'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+import numpy as np
+
+from support import SRC_DIR
+import template_store
+from template_store import INDEX_DTYPE, INDEX_HEADER_SIZE, TemplateStore, migrate_json_templates
+
+
+def template(i, rows=8):
+    return np.full((rows, 4), i, dtype=np.float32)
+
+
+# Writes templates until killed, printing each user id once put() has returned
+WRITER = """
+import sys
+import numpy as np
+sys.path.insert(0, sys.argv[1])
+from template_store import TemplateStore
+store = TemplateStore(sys.argv[2], auto_compact=False)
+i = 0
+while True:
+    store.put(str(i), np.full((64, 4), i, dtype=np.float32))
+    print(i, flush=True)
+    i += 1
+"""
+
+
+class TemplateStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.store = TemplateStore(self.tmp, auto_compact=False)
+        self.store.put_many((str(i), template(i)) for i in range(10))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def assertTemplates(self, store, user_ids):
+        self.assertEqual(sorted(store.user_ids(), key=int), [str(i) for i in user_ids])
+        for i in user_ids:
+            np.testing.assert_array_equal(store.get(str(i)), template(i))
+            np.testing.assert_array_equal(store.read(str(i)), template(i))
+
+    def test_replay(self):
+        self.store.put('3', template(30))
+        self.store.delete('4')
+        store = TemplateStore(self.tmp)
+        self.assertEqual(store.torn_bytes, 0)
+        np.testing.assert_array_equal(store.get('3'), template(30))
+        self.assertNotIn('4', store)
+        self.assertEqual(len(store), 9)
+
+    def test_truncated_index(self):
+        # A crash halfway through appending the last record
+        size = os.path.getsize(self.store.index_path)
+        with open(self.store.index_path, 'r+b') as f:
+            f.truncate(size - INDEX_DTYPE.itemsize // 2)
+        store = TemplateStore(self.tmp, auto_compact=False)
+        self.assertEqual(store.torn_bytes, INDEX_DTYPE.itemsize - INDEX_DTYPE.itemsize // 2)
+        self.assertTemplates(store, range(9))
+        # The next write replaces the torn tail
+        store.put('9', template(9))
+        store = TemplateStore(self.tmp)
+        self.assertEqual(store.torn_bytes, 0)
+        self.assertTemplates(store, range(10))
+
+    def test_corrupt_record(self):
+        # A torn record of full length: replay stops at its checksum
+        with open(self.store.index_path, 'r+b') as f:
+            f.seek(INDEX_HEADER_SIZE + 7 * INDEX_DTYPE.itemsize + INDEX_DTYPE.fields['offset'][1])
+            f.write(b'\xff')
+        store = TemplateStore(self.tmp, auto_compact=False)
+        self.assertEqual(store.torn_bytes, 3 * INDEX_DTYPE.itemsize)
+        self.assertTemplates(store, range(7))
+
+    def test_reopen_checks_new_records_only(self):
+        checked = []
+        checksums = template_store._checksums
+
+        def counting(records):
+            checked.append(len(records))
+            return checksums(records)
+
+        reader = TemplateStore(self.tmp)
+        with mock.patch('template_store._checksums', counting):
+            reader.open()
+            self.store.put_many((str(i), template(i)) for i in range(10, 13))
+            reader.open()
+            self.store.compact()
+            self.store.open()
+            reader.open()
+        # Sealing the put (3) and the snapshot (13) computes checksums; the writer never verifies
+        # its own records again, the reader only those appended since it last looked (3) and
+        # the new index file after the compaction (13)
+        self.assertEqual(checked, [0, 3, 3, 13, 0, 0, 13])
+        self.assertTemplates(reader, range(13))
+
+    def test_kill_during_writes(self):
+        process = subprocess.Popen([sys.executable, '-c', WRITER, SRC_DIR, self.tmp],
+                                   stdout=subprocess.PIPE, text=True)
+        committed = [int(process.stdout.readline()) for _ in range(50)]
+        process.send_signal(signal.SIGKILL if hasattr(signal, 'SIGKILL') else signal.SIGTERM)
+        process.wait()
+        process.stdout.close()
+        store = TemplateStore(self.tmp)
+        for i in committed:
+            np.testing.assert_array_equal(store.get(str(i)), np.full((64, 4), i, dtype=np.float32))
+
+    def test_readers_during_compaction(self):
+        errors = []
+        done = threading.Event()
+
+        def read():
+            while not done.is_set():
+                try:
+                    for i in range(10):
+                        np.testing.assert_array_equal(self.store.read(str(i)), template(i))
+                        np.testing.assert_array_equal(self.store.get(str(i)), template(i))
+                except Exception as e:
+                    errors.append(e)
+                    return
+
+        reader = threading.Thread(target=read)
+        reader.start()
+        for _ in range(50):
+            self.store.compact()
+            self.store.open()
+        done.set()
+        reader.join()
+        self.assertEqual(errors, [])
+
+
+class MigrationTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.json_path = os.path.join(self.tmp, 'templates.json')
+        with open(self.json_path, 'w') as f:
+            json.dump({'1': template(1).tolist(), '2': template(2).tolist(), '3': []}, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_migrate(self):
+        store = TemplateStore(self.tmp)
+        self.assertEqual(migrate_json_templates(self.json_path, store), 3)
+        store = TemplateStore(self.tmp)
+        np.testing.assert_array_equal(store.get('2'), template(2))
+        self.assertIsNone(store.get('3'))
+        self.assertEqual(len(store), 3)
+
+    def test_interrupted_migration(self):
+        store = TemplateStore(self.tmp)
+        with mock.patch('template_store.os.replace', side_effect=OSError('crash')):
+            with self.assertRaises(OSError):
+                migrate_json_templates(self.json_path, store)
+        # Nothing was committed, so the next start migrates again
+        store = TemplateStore(self.tmp)
+        self.assertFalse(store.exists())
+        migrate_json_templates(self.json_path, store)
+        store = TemplateStore(self.tmp)
+        np.testing.assert_array_equal(store.get('1'), template(1))
+        self.assertEqual(len(store), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
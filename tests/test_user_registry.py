@@ -0,0 +1,56 @@
+import os
+import unittest
+
+from support import TempDirTestCase
+from user_registry import UserRegistry
+
+
+class TouchTest(TempDirTestCase):
+    """Last-seen times are buffered and written in batches"""
+
+    def setUp(self):
+        self.path = os.path.join(self.tmp, f'{self._testMethodName}.db')
+        self.registry = UserRegistry(self.path, touch_interval=3600, touch_batch=3)
+        self.registry.add_users({'user_id': str(i)} for i in range(5))
+        self.addCleanup(self.registry.close)
+
+    def stored_last_seen(self, user_id):
+        # A separate registry reads only what has been written
+        other = UserRegistry(self.path)
+        try:
+            return other.get_user(user_id)['last_seen']
+        finally:
+            other.close()
+
+    def test_buffered_until_batch(self):
+        self.registry.touch('0', when=10.0)
+        self.registry.touch('1', when=11.0)
+        self.assertIsNone(self.stored_last_seen('0'))
+        self.assertEqual(self.registry.get_user('0')['last_seen'], 10.0)  # Pending times are visible
+        self.registry.touch('2', when=12.0)
+        self.assertEqual(self.stored_last_seen('0'), 10.0)
+        self.assertEqual(self.stored_last_seen('2'), 12.0)
+
+    def test_interval(self):
+        self.registry.touch_interval = 0
+        self.registry.touch('0', when=10.0)
+        self.assertEqual(self.stored_last_seen('0'), 10.0)
+
+    def test_reads_and_close_flush(self):
+        self.registry.touch('3', when=20.0)
+        self.registry.touch('1', when=30.0)
+        self.assertEqual(self.registry.recent_users(limit=2), ['1', '3'])
+        self.registry.touch('4', when=40.0)
+        self.registry.close()
+        self.assertEqual(self.stored_last_seen('4'), 40.0)
+
+    def test_later_time_wins(self):
+        self.registry.touch('0', when=50.0)
+        self.registry.flush()
+        self.registry.touch('0', when=40.0)  # An older time flushed after a newer one
+        self.registry.flush()
+        self.assertEqual(self.stored_last_seen('0'), 50.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
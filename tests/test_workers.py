@@ -0,0 +1,57 @@
+import os
+import unittest
+
+from support import DatasetTestCase
+import fingerprint
+from fingerprint import FingerprintProcessor
+
+
+class WorkerProcessorTest(DatasetTestCase):
+    """Pool workers extract features without opening anything in data_dir"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.data_dir = os.path.join(cls.tmp, 'data')
+        cls.processor = FingerprintProcessor(cls.data_dir)
+        keypoints, descriptors = cls.processor.process_image(cls.dataset['1'][0])
+        cls.processor.store_template('1', descriptors, keypoints)
+        cls.processor.template_store.compact()  # Now at generation 1
+
+    def listing(self):
+        return {name: os.stat(os.path.join(self.data_dir, name)).st_mtime_ns for name in os.listdir(self.data_dir)}
+
+    def test_worker_leaves_data_dir_alone(self):
+        # A stale generation-0 file, which opening the store would remove
+        stale = os.path.join(self.data_dir, 'templates.dat')
+        open(stale, 'wb').close()
+        before = self.listing()
+        cwd = os.getcwd()
+        os.chdir(self.tmp)  # Where a worker without data_dir would create the default 'data'
+        try:
+            fingerprint._init_worker(self.processor.worker_config())
+            (keypoints, descriptors, quality), _ = fingerprint._extract_worker(self.dataset['1'][1])
+        finally:
+            os.chdir(cwd)
+            fingerprint._worker_processor = None
+        self.assertIsNotNone(descriptors)
+        self.assertEqual(self.listing(), before)
+        self.assertEqual(sorted(os.listdir(self.tmp)), ['data', 'dataset'])
+
+    def test_extraction_only_processor(self):
+        worker = FingerprintProcessor(os.path.join(self.tmp, 'unused'), open_stores=False)
+        self.assertIsNone(worker.template_store)
+        self.assertIsNone(worker.user_registry)
+        _, descriptors = worker.process_image(self.dataset['2'][0])
+        self.assertIsNotNone(descriptors)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'unused')))
+
+    def test_pool_matches_in_process(self):
+        paths = self.dataset['2']
+        pooled = dict(self.processor.extract_many(paths, workers=1))
+        for path in paths:
+            self.assertEqual(pooled[path].shape, self.processor.process_image(path)[1].shape)
+
+
+if __name__ == '__main__':
+    unittest.main()